@@ -77,7 +77,9 @@ class BuildUnpackSources(object):
     The optional ``target`` parameter gives a directory they should be
     extracted to (default: ``"."``). The ``strip``
     parameter (only applies to tarballs) acts like the
-    `tar` ``--strip-components`` flag.
+    `tar` ``--strip-components`` flag. The ``git_checkout`` parameter
+    (only applies to git sources) is one of ``clone``, ``shared`` or
+    ``archive``, see :meth:`~hashdist.core.source_cache.SourceCache.unpack`.
 
     If there are any conflicting files then an error is reported and
     unpacking stops.
@@ -239,24 +239,60 @@ class GC(object):
     Anything not in use of current profiles will be cleaned out. The list
     of current profiles is kept in a directory of symlinks configured
     in %s.
+
+    With --sources, the source cache is cleaned out afterwards too:
+    sources not used by any artifact left in the build store are
+    removed, least recently used first, until the source cache fits in
+    the quota given by --quota or the source_cache_quota setting (with
+    no quota, all of them are removed).
+
+    Unneeded artifacts are first moved to a trash directory in the build
+    store and then deleted in parallel (see -j). With --dry-run, only the
+    artifacts that would be removed and the space that would be freed are
+    reported.
     """ % DEFAULT_CONFIG_FILENAME_REPR
 
     @staticmethod
     def setup(ap):
+        from .utils import byte_size
         ap.add_argument('--list', action='store_true', help='Show list of GC roots')
+        ap.add_argument('--sources', action='store_true', help='Also clean out the source cache')
+        ap.add_argument('--quota', type=byte_size, default=None,
+                        help='Size the source cache may take, e.g., 500G')
+        ap.add_argument('--dry-run', action='store_true',
+                        help='Only report what would be removed from the build store')
+        ap.add_argument('-j', '--jobs', type=int, default=4,
+                        help='Number of threads deleting artifacts (default: 4)')
 
     @staticmethod
     def run(ctx, args):
         from ..core import BuildStore
         if args.list:
-            gc_roots_dir = ctx.get_config()['gc_roots']
+            build_store = BuildStore.create_from_config(ctx.get_config(), ctx.logger)
             # write header to stderr, list to stdout
             sys.stderr.write("List of GC roots:\n")
-            for gc_root in os.listdir(gc_roots_dir):
-                sys.stdout.write("%s\n" % os.readlink(pjoin(gc_roots_dir, gc_root)))
+            for symlink, artifact_dir in build_store.list_gc_roots():
+                sys.stdout.write("%s\n" % symlink)
         else:
-            build_store = BuildStore.create_from_config(ctx.get_config(), ctx.logger)
-            build_store.gc()
+            config = ctx.get_config()
+            build_store = BuildStore.create_from_config(config, ctx.logger)
+            removed, freed = build_store.gc(dry_run=args.dry_run, jobs=args.jobs)
+            if args.dry_run:
+                ctx.logger.info('Would remove %d artifacts, freeing %.1f MB' % (len(removed), freed / 1e6))
+                return
+            ctx.logger.info('Removed %d artifacts, freeing %.1f MB' % (len(removed), freed / 1e6))
+            if args.sources:
+                from ..core import SourceCache
+                from .utils import byte_size
+                quota = args.quota
+                if quota is None and 'source_cache_quota' in config:
+                    quota = byte_size(str(config['source_cache_quota']))
+                source_cache = SourceCache.create_from_config(config, ctx.logger)
+                try:
+                    removed, freed = source_cache.gc(build_store.get_source_keys(), quota)
+                finally:
+                    source_cache.close()
+                ctx.logger.info('Removed %d sources, freeing %.1f MB' % (len(removed), freed / 1e6))
 
 
 @register_subcommand
@@ -292,18 +328,14 @@ class LoadProfile(object):
     def run(ctx, args):
         if args.print_bash_commands:
             from ..core import BuildStore
-            gc_roots_dir = ctx.get_config()['gc_roots']
-            for gc_root in os.listdir(gc_roots_dir):
-                profile_name = os.path.basename(os.readlink(pjoin(gc_roots_dir,
-                    gc_root)))
+            build_store = BuildStore.create_from_config(ctx.get_config(), ctx.logger)
+            for symlink, profile_path in build_store.list_gc_roots():
+                profile_name = os.path.basename(symlink)
                 if profile_name == args.profile:
                     break
             else:
                 raise Exception("Profile '%s' not installed" % args.profile)
-            try:
-                profile_path = os.readlink(os.readlink(pjoin(gc_roots_dir, gc_root)))
-            except OSError:
-                # FIXME: query our runtime database instead, it should be there
+            if profile_path is None:
                 raise Exception("Profile '%s' was deleted" % args.profile)
             profile_hash = os.path.basename(profile_path)
             profile_name_ui = profile_name + "/" + profile_hash
@@ -322,6 +354,38 @@ class LoadProfile(object):
             sys.stdout.write("You can execute this line by hand or add it to your '.bashrc'. After that,\nrerun your last command.\n")
 
 
+@register_subcommand
+class FixedRootExec(object):
+    """
+    Runs a command with the build store mounted at the fixed artifact
+    root it was built at (the fixed_artifact_root setting), so that
+    artifacts built that way find themselves and their dependencies.
+
+    Example:
+
+        $ hit fixed-root-exec -- bash
+
+    Linux only; see also the documentation of hashdist.core.namespace.
+    """
+
+    command = 'fixed-root-exec'
+
+    @staticmethod
+    def setup(ap):
+        ap.add_argument('cmd', nargs='+', help='command to run, with its arguments')
+
+    @staticmethod
+    def run(ctx, args):
+        from ..core import BuildStore
+        from ..core.namespace import enter_fixed_root
+        build_store = BuildStore.create_from_config(ctx.get_config(), ctx.logger)
+        if build_store.fixed_artifact_root is None:
+            ctx.logger.error('No fixed_artifact_root is configured')
+            return 1
+        enter_fixed_root(build_store.artifact_root, build_store.fixed_artifact_root)
+        os.execvp(args.cmd[0], args.cmd)
+
+
 class MvCpBase(object):
     @classmethod
     def setup(cls, ap):
@@ -436,8 +500,17 @@ class PrintLibs(object):
 
     @staticmethod
     def run(ctx, args):
-        libs = [os.path.join(dirpath, f)
-                for dirpath, dirnames, files in os.walk(args.profile)
-                for f in fnmatch.filter(files, "*.%s*" % args.suffix)]
+        from ..core.manifest import read_manifest
+        pattern = "*.%s*" % args.suffix
+        manifest = read_manifest(args.profile)
+        if manifest is not None:
+            # like os.walk, don't list symlinks to directories
+            libs = [os.path.join(args.profile, entry.path) for entry in manifest
+                    if entry.type != 'd' and fnmatch.fnmatch(os.path.basename(entry.path), pattern)
+                    and not (entry.type == 'l' and os.path.isdir(os.path.join(args.profile, entry.path)))]
+        else:
+            libs = [os.path.join(dirpath, f)
+                    for dirpath, dirnames, files in os.walk(args.profile)
+                    for f in fnmatch.filter(files, pattern)]
         for lib in libs:
             sys.stdout.write(lib + '\n')
@@ -87,6 +87,9 @@ class Purge(object):
 
         $ hit purge python/2qbgsltd4mwz
 
+    A shorter prefix of the ID may be used as long as it matches a
+    single artifact.
+
     Alternatively, to wipe the entire build store::
 
         $ hit purge --force '*'
@@ -109,8 +112,125 @@ class Purge(object):
                 return 1
             store.delete_all()
         else:
-            path = store.delete(args.artifact_id)
+            artifact_id = args.artifact_id
+            matches = store.resolve_prefix(artifact_id) if '/' in artifact_id else []
+            if len(matches) > 1:
+                ctx.logger.error('Artifact ID %s is ambiguous, it matches:' % artifact_id)
+                for match in matches:
+                    ctx.logger.error('    %s' % match)
+                return 1
+            elif len(matches) == 1:
+                artifact_id = matches[0]
+            path = store.delete(artifact_id)
             if path is None:
                 sys.stderr.write('Artifact %s not found\n' % args.artifact_id)
             else:
                 sys.stderr.write('Removed directory: %s\n' % path)
+
+@register_subcommand
+class Dedup(object):
+    """
+    Makes identical files of the artifacts in the build store hard links
+    to a single copy, as done for new builds when the dedup setting is
+    on. Only write-protected files are shared.
+    """
+
+    @staticmethod
+    def setup(ap):
+        ap.add_argument('-j', '--jobs', type=int, default=4, help='Number of threads hashing files (default: 4)')
+
+    @staticmethod
+    def run(ctx, args):
+        from ..core import BuildStore
+        store = BuildStore.create_from_config(ctx.get_config(), ctx.logger)
+        total_count = total_saved = 0
+        for artifact_id, artifact_dir in store.list_artifacts():
+            count, saved = store.dedup_artifact(artifact_dir, jobs=args.jobs)
+            total_count += count
+            total_saved += saved
+        ctx.logger.info('%d files shared, saving %.1f MB' % (total_count, total_saved / 1e6))
+
+@register_subcommand
+class RebuildDB(object):
+    """
+    Rebuilds the index of the build store (in the db directory of the
+    configuration) by scanning the build store and the gc_roots
+    directory. Only needed if the build store was changed by other
+    means than HashDist.
+    """
+    command = 'rebuild-db'
+
+    @staticmethod
+    def setup(ap):
+        pass
+
+    @staticmethod
+    def run(ctx, args):
+        from ..core import BuildStore
+        store = BuildStore.create_from_config(ctx.get_config(), ctx.logger)
+        if store.db is None:
+            ctx.logger.error('No db directory is configured')
+            return 1
+        store.rebuild_db()
+
+@register_subcommand
+class Scrub(object):
+    """
+    Verifies the integrity of the source cache and the build store.
+
+    Every source pack is re-hashed, git repositories are checked with
+    ``git fsck``, and the ``id``, ``artifact.json`` and ``build.json`` of
+    every artifact are checked against each other. A JSON report is
+    written to stdout (or the file given by --report); the exit status
+    is 1 if any problems were found.
+
+    To run it from cron on a shared store, throttle it, e.g.::
+
+        $ hit scrub --rate 20M --max-items 10000
+
+    An interrupted (or --max-items limited) scrub continues where it
+    left off the next time; use --restart to start over.
+    """
+
+    @staticmethod
+    def setup(ap):
+        from .utils import byte_size
+        ap.add_argument('--sources', action='store_true', help='Only check the source cache')
+        ap.add_argument('--artifacts', action='store_true', help='Only check the build store')
+        ap.add_argument('-j', '--jobs', type=int, default=4, help='Number of parallel checks (default: 4)')
+        ap.add_argument('--rate', type=byte_size, default=None,
+                        help='Limit on bytes read per second, e.g., 20M')
+        ap.add_argument('--no-ionice', action='store_true', help='Do not lower IO priority')
+        ap.add_argument('--max-items', type=int, default=None, help='Stop after checking this many items')
+        ap.add_argument('--restart', action='store_true', help='Ignore the position of an earlier scrub')
+        ap.add_argument('--report', default=None, help='Write report to this file rather than stdout')
+
+    @staticmethod
+    def run(ctx, args):
+        import json
+        from ..core import SourceCache, BuildStore
+        from ..core.scrub import Scrubber, set_idle_io_priority
+        config = ctx.get_config()
+        source_cache = build_store = None
+        if not args.artifacts:
+            source_cache = SourceCache.create_from_config(config, ctx.logger)
+        if not args.sources:
+            build_store = BuildStore.create_from_config(config, ctx.logger)
+        if not args.no_ionice and not set_idle_io_priority():
+            ctx.logger.warning('Could not lower IO priority (is ionice installed?)')
+        scrubber = Scrubber.create_from_config(config, source_cache, build_store, ctx.logger,
+                                               jobs=args.jobs, bytes_per_sec=args.rate)
+        if args.restart:
+            scrubber.reset()
+        try:
+            report = scrubber.scrub(max_items=args.max_items)
+        finally:
+            if source_cache is not None:
+                source_cache.close()
+        if args.report is None:
+            json.dump(report, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+        else:
+            with open(args.report, 'w') as f:
+                json.dump(report, f, indent=2)
+        return 1 if report['problems'] else 0
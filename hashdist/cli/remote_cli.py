@@ -336,6 +336,7 @@ class Push(object):
                             SourceCache,
                             RemoteHandlerSSH,
                             RemoteHandlerPCS)
+        from ..core.source_cache import iter_pack_files, archive_types
         remote_config_path = pjoin(DEFAULT_STORE_DIR, "remotes", args.name)
         if not args.dry_run:
             if os.path.isfile(pjoin(remote_config_path, 'sshserver')):
@@ -369,6 +370,8 @@ class Push(object):
                 skipping = ''
                 pushing = ''
                 for package in os.listdir(store.artifact_root):
+                    if package.startswith('.'):
+                        continue
                     for artifact in os.listdir(pjoin(store.artifact_root,
                                                      package)):
                         if (package in local_manifest and
@@ -397,6 +400,8 @@ class Push(object):
                 ctx.logger.info("Calculating which packages to push")
                 push_manifest = {}
                 for package in os.listdir(store.artifact_root):
+                    if package.startswith('.'):
+                        continue
                     if package not in manifest:
                         manifest[package] = {}
                     for artifact in os.listdir(pjoin(store.artifact_root,
@@ -459,10 +464,10 @@ class Push(object):
                 ctx.logger.info(msg)
                 skipping = ''
                 pushing = ''
-                for subdir in [pjoin('packs', pack_type) for
-                               pack_type in ['tar.bz2', 'tar.gz', 'tar.xz', 'zip']]:
-                    for source_pack in os.listdir(pjoin(cache.cache_path,
-                                                        subdir)):
+                for pack_type in archive_types:
+                    subdir = pjoin('packs', pack_type)
+                    for source_pack, _ in iter_pack_files(
+                            pjoin(cache.cache_path, 'packs'), pack_type):
                         if (subdir in local_manifest and
                                 source_pack in local_manifest[subdir]):
                             skipping += subdir + "/" + \
@@ -489,12 +494,16 @@ class Push(object):
                     f.write(json.dumps(manifest))
                 ctx.logger.info("Calculating which packages to push")
                 push_manifest = {}
-                for subdir in [pjoin('packs', pack_type)
-                               for pack_type in ['tar.bz2', 'tar.gz', 'tar.xz', 'zip']]:
+                # remote mirrors keep the flat packs/<type>/<hash>
+                # layout, wherever the pack is stored locally
+                pack_paths = {}
+                for pack_type in archive_types:
+                    subdir = pjoin('packs', pack_type)
                     if subdir not in manifest:
                         manifest[subdir] = []
-                    for source_pack in os.listdir(pjoin(cache.cache_path,
-                                                        subdir)):
+                    for source_pack, source_pack_path in iter_pack_files(
+                            pjoin(cache.cache_path, 'packs'), pack_type):
+                        pack_paths[subdir, source_pack] = source_pack_path
                         if source_pack in manifest[subdir] and not args.force:
                             msg = subdir + "/" + source_pack + \
                                 " already on remote"
@@ -507,7 +516,7 @@ class Push(object):
                 for subdir, source_packs in push_manifest.iteritems():
                     for source_pack in source_packs:
                         manifest[subdir].append(source_pack)
-                        source_pack_path = pjoin(subdir, source_pack)
+                        source_pack_path = pack_paths[subdir, source_pack]
                         msg = "Pushing " + repr(source_pack_path) + "\n"
                         sys.stdout.write(msg)
                         remoteHandler.mkdir('/src/' + subdir)
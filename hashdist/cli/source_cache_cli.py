@@ -45,6 +45,54 @@ class FetchGit(object):
 register_subcommand(FetchGit)
 
 
+class ReindexGit(object):
+    """
+    Rebuild the index mapping git commits to source cache repositories
+
+    The index is normally maintained as commits are fetched; this
+    command recreates it from scratch, e.g., after repositories in the
+    ``git`` directory of the source cache were copied or removed by
+    hand.
+    """
+    command = 'reindex-git'
+
+    @staticmethod
+    def setup(ap):
+        pass
+
+    @staticmethod
+    def run(ctx, args):
+        store = SourceCache.create_from_config(ctx.get_config(), ctx.logger)
+        count = store.rebuild_git_index()
+        sys.stdout.write('Indexed %d commits\n' % count)
+
+register_subcommand(ReindexGit)
+
+
+class MigratePacks(object):
+    """
+    Move archives in the source cache to the sharded directory layout
+
+    Archives used to be stored directly in ``packs/<type>``; they are
+    now spread over subdirectories named by the first two characters of
+    their hash. Archives in the old layout are still found, so this
+    command may be run at any time, also while the source cache is in use.
+    """
+    command = 'migrate-packs'
+
+    @staticmethod
+    def setup(ap):
+        pass
+
+    @staticmethod
+    def run(ctx, args):
+        store = SourceCache.create_from_config(ctx.get_config(), ctx.logger)
+        count = store.migrate_packs()
+        sys.stdout.write('Moved %d packs\n' % count)
+
+register_subcommand(MigratePacks)
+
+
 _archive_types_doc = ', '.join(archive_types)
 
 def as_url(url):
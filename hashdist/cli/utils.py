@@ -1,5 +1,7 @@
 import json
 
+from ..core.common import parse_size
+
 try:
     import argparse
 except ImportError:
@@ -32,4 +34,15 @@ def parameter_pair(string):
         p1, p2 = string.split('=', 1)
         return p1, p2
     except:
-        raise argparse.ArgumentTypeError('Unable to parse as parameter: %r' % string)
\ No newline at end of file
+        raise argparse.ArgumentTypeError('Unable to parse as parameter: %r' % string)
+
+def byte_size(string):
+    """Parse a size in bytes with an optional K/M/G/T suffix (powers of 1024).
+
+    :param string: Size string, e.g., '50M' or '1024'
+    :return: Number of bytes as an int
+    """
+    try:
+        return parse_size(string)
+    except ValueError, e:
+        raise argparse.ArgumentTypeError(str(e))
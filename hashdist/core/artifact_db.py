@@ -0,0 +1,233 @@
+"""
+:mod:`hashdist.core.artifact_db` --- Index of the build store
+=============================================================
+
+Answering questions such as "is this artifact present", "what does it
+depend on" or "what are the GC roots" by looking at the build store
+directory itself means reading an ``id`` or ``artifact.json`` file per
+artifact, which gets slow with many thousands of artifacts on a
+network file system. An :class:`ArtifactDB` keeps the same information
+in a single SQLite database (in the ``db`` directory of the
+configuration), so that these become indexed lookups.
+
+The database is only an index; the build store directory remains
+the authority. :class:`~hashdist.core.build_store.BuildStore` updates
+the database whenever it adds or removes artifacts or GC roots, and
+the database can always be thrown away and rebuilt from the tree
+(see :meth:`~hashdist.core.build_store.BuildStore.rebuild_db`).
+
+Tables:
+
+**artifacts**:
+    One row per artifact: ``id`` (full artifact ID), ``name``,
+    ``path`` (relative to the artifact root), ``size`` (bytes, or
+    NULL if unknown), ``build_time`` (seconds, or NULL if the
+    artifact was not built here), ``created`` and ``last_used``
+    (UNIX times; the latter is NULL if the artifact has not been used
+    since it was recorded).
+
+**dependencies**:
+    ``(artifact_id, dependency_id)`` pairs, taken from the
+    ``dependencies`` of ``artifact.json`` (so this is already the
+    complete set of dependencies, not just the direct ones).
+
+**gc_roots**:
+    ``(name, symlink, artifact_id)``, where ``name`` is the name of
+    the entry in the gc_roots directory and ``symlink`` is the
+    profile symlink it points to.
+
+All changes are done in transactions, so that several processes may
+share a database.
+"""
+
+import time
+import sqlite3
+import threading
+from contextlib import closing, contextmanager
+
+SCHEMA_VERSION = 2
+
+# Seconds to wait for another process holding a lock on the database
+LOCK_TIMEOUT = 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER,
+    build_time REAL,
+    created REAL NOT NULL,
+    last_used REAL
+);
+CREATE INDEX IF NOT EXISTS artifacts_path ON artifacts (path);
+CREATE TABLE IF NOT EXISTS dependencies (
+    artifact_id TEXT NOT NULL,
+    dependency_id TEXT NOT NULL,
+    PRIMARY KEY (artifact_id, dependency_id)
+);
+CREATE TABLE IF NOT EXISTS gc_roots (
+    name TEXT PRIMARY KEY,
+    symlink TEXT NOT NULL,
+    artifact_id TEXT
+);
+"""
+
+
+class ArtifactDBError(Exception):
+    pass
+
+
+class ArtifactDB(object):
+    """
+    SQLite index of the artifacts and GC roots of a build store
+
+    Parameters
+    ----------
+    filename : str
+        The database file; it is created if it does not exist. After
+        construction, the `is_new` attribute tells whether the database
+        was just created (and so needs to be filled in by the caller).
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        try:
+            self._conn = sqlite3.connect(filename, timeout=LOCK_TIMEOUT, check_same_thread=False)
+        except sqlite3.Error, e:
+            raise ArtifactDBError('Could not open %s: %s' % (filename, e))
+        self._conn.text_factory = str
+        with self._transaction() as c:
+            version = c.execute('PRAGMA user_version').fetchone()[0]
+            if version > SCHEMA_VERSION:
+                raise ArtifactDBError('%s was written by a newer version of HashDist' % filename)
+            self.is_new = (version == 0)
+            if self.is_new:
+                c.executescript(_SCHEMA)
+            elif version < 2:
+                c.execute('ALTER TABLE artifacts ADD COLUMN last_used REAL')
+            if version < SCHEMA_VERSION:
+                c.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+
+    def close(self):
+        self._conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            c = self._conn.cursor()
+            try:
+                yield c
+            except:
+                self._conn.rollback()
+                raise
+            else:
+                self._conn.commit()
+            finally:
+                c.close()
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            with closing(self._conn.cursor()) as c:
+                return c.execute(sql, args).fetchall()
+
+    #
+    # Artifacts
+    #
+    def add_artifact(self, artifact_id, path, dependencies=(), size=None, build_time=None):
+        """Records an artifact, replacing any earlier record of it
+        """
+        name = artifact_id.split('/')[0]
+        with self._transaction() as c:
+            c.execute('INSERT OR REPLACE INTO artifacts (id, name, path, size, build_time, created) '
+                      'VALUES (?, ?, ?, ?, ?, ?)',
+                      (artifact_id, name, path, size, build_time, time.time()))
+            c.execute('DELETE FROM dependencies WHERE artifact_id = ?', (artifact_id,))
+            c.executemany('INSERT OR IGNORE INTO dependencies (artifact_id, dependency_id) VALUES (?, ?)',
+                          [(artifact_id, dep_id) for dep_id in dependencies])
+
+    def remove_artifact(self, artifact_id):
+        with self._transaction() as c:
+            c.execute('DELETE FROM artifacts WHERE id = ?', (artifact_id,))
+            c.execute('DELETE FROM dependencies WHERE artifact_id = ?', (artifact_id,))
+
+    def remove_all_artifacts(self):
+        with self._transaction() as c:
+            c.execute('DELETE FROM artifacts')
+            c.execute('DELETE FROM dependencies')
+
+    def get_path(self, artifact_id):
+        """Returns the recorded path of an artifact, or `None`"""
+        rows = self._query('SELECT path FROM artifacts WHERE id = ?', (artifact_id,))
+        return rows[0][0] if rows else None
+
+    def get_artifact(self, artifact_id):
+        """Returns the record of an artifact as a dict, or `None`"""
+        rows = self._query('SELECT id, name, path, size, build_time, created, last_used '
+                           'FROM artifacts WHERE id = ?', (artifact_id,))
+        if not rows:
+            return None
+        return dict(zip(['id', 'name', 'path', 'size', 'build_time', 'created', 'last_used'],
+                        rows[0]))
+
+    def find_by_path(self, path):
+        """Returns the ID of the artifact recorded at `path`, or `None`"""
+        rows = self._query('SELECT id FROM artifacts WHERE path = ?', (path,))
+        return rows[0][0] if rows else None
+
+    def resolve_prefix(self, prefix):
+        """Returns the sorted IDs of the artifacts whose ID starts with `prefix`
+
+        E.g., ``resolve_prefix('zlib/4nio')``.
+        """
+        if not prefix:
+            return [artifact_id for artifact_id, path in self.list_artifacts()]
+        # Range scan on the primary key rather than LIKE, which can't use the index
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        rows = self._query('SELECT id FROM artifacts WHERE id >= ? AND id < ? ORDER BY id',
+                           (prefix, upper))
+        return [row[0] for row in rows]
+
+    def list_artifacts(self):
+        """Returns a sorted list of ``(artifact_id, path)``"""
+        return self._query('SELECT id, path FROM artifacts ORDER BY id')
+
+    def touch(self, artifact_id, when=None):
+        """Records that an artifact was used (now, or at time `when`)"""
+        with self._transaction() as c:
+            c.execute('UPDATE artifacts SET last_used = ? WHERE id = ?',
+                      (time.time() if when is None else when, artifact_id))
+
+    def get_total_size(self):
+        """Returns the sum of the recorded artifact sizes"""
+        return self._query('SELECT COALESCE(SUM(size), 0) FROM artifacts')[0][0]
+
+    def list_by_last_use(self):
+        """Returns a list of ``(artifact_id, path, size, last_used)``, least
+        recently used first; artifacts never used count as used when they
+        were recorded
+        """
+        return self._query('SELECT id, path, size, COALESCE(last_used, created) AS t '
+                           'FROM artifacts ORDER BY t, id')
+
+    def get_dependencies(self, artifact_id):
+        rows = self._query('SELECT dependency_id FROM dependencies WHERE artifact_id = ? '
+                           'ORDER BY dependency_id', (artifact_id,))
+        return [row[0] for row in rows]
+
+    #
+    # GC roots
+    #
+    def add_gc_root(self, name, symlink, artifact_id):
+        with self._transaction() as c:
+            c.execute('INSERT OR REPLACE INTO gc_roots (name, symlink, artifact_id) VALUES (?, ?, ?)',
+                      (name, symlink, artifact_id))
+
+    def remove_gc_root(self, name):
+        with self._transaction() as c:
+            c.execute('DELETE FROM gc_roots WHERE name = ?', (name,))
+
+    def list_gc_roots(self):
+        """Returns a sorted list of ``(name, symlink, artifact_id)``"""
+        return self._query('SELECT name, symlink, artifact_id FROM gc_roots ORDER BY name')
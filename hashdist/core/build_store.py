@@ -118,7 +118,22 @@ Build artifact storage format
 -----------------------------
 
 The presence of the 'id' file signals that the build is complete, and
-contains the full 256-bit hash.
+contains the full 256-bit hash. Just before it is written, a listing of
+all files with their content hashes is written to ``manifest.gz`` (see
+:mod:`hashdist.core.manifest`), and the files referring to the build
+store by absolute path to ``relocations.json`` (see
+:mod:`hashdist.core.relocation`).
+
+If the configuration has a ``db`` directory, the artifacts, their
+dependencies and the GC roots are also indexed in an SQLite database
+there (see :mod:`hashdist.core.artifact_db`), so that looking up,
+listing and garbage collecting artifacts does not have to read a file
+in every artifact directory.
+
+If the ``dedup`` setting is on, identical write-protected files of
+different artifacts are hard links to one copy in an object pool in the
+build store (see :mod:`hashdist.core.dedup`). Names starting with a dot
+in the root of the build store (such as the pool) are never artifacts.
 
 More TODO.
 
@@ -135,7 +150,6 @@ Reference
 import os
 from os.path import join as pjoin
 import shutil
-import hashlib
 import sys
 import re
 import errno
@@ -143,16 +157,28 @@ import json
 import base64
 import tempfile
 import urllib2
+import httplib
 import stat
-
-from .source_cache import SourceCache, ProgressBar
-from .hasher import hash_document, prune_nohash, HashingWriteStream
+import time
+from timeit import default_timer as clock
+from multiprocessing.pool import ThreadPool
+
+from .source_cache import (SourceCache, download_resumable, locked_partial_file, open_url,
+                           PARTIAL_DIRNAME)
+from .mirrors import MirrorRanking, race
+from .artifact_db import ArtifactDB
+from .dedup import ObjectPool
+from .manifest import write_manifest, read_manifest, update_manifest, MANIFEST_FILENAME
+from .relocation import (write_relocation_index, read_relocation_index, is_ignored,
+                         relocate_files, RELOCATION_INDEX_FILENAME)
+from .hasher import hash_document, prune_nohash
 from .common import (InvalidBuildSpecError, BuildFailedError,
                      IllegalBuildStoreError,
                      json_formatting_options, SHORT_ARTIFACT_ID_LEN,
-                     working_directory)
+                     working_directory, parse_size)
 from .fileutils import silent_unlink, robust_rmtree, silent_makedirs, gzip_compress, write_protect
-from .fileutils import rmtree_write_protected, atomic_symlink, realpath_to_symlink, allow_writes
+from .fileutils import rmtree_write_protected, atomic_symlink, realpath_to_symlink, allow_writes, copy_tree
+from .namespace import to_fixed_path
 from . import run_job
 
 from hashdist.util.logger_setup import log_to_file, getLogger
@@ -243,6 +269,57 @@ def shorten_artifact_id(artifact_id, length=SHORT_ARTIFACT_ID_LEN):
 
 SIMPLE_FILE_URL_RE = re.compile(r'^file:/?[^/]+.*$')
 
+ARTIFACT_DB_FILENAME = 'artifacts.sqlite'
+
+# Garbage collected artifacts are moved here before they are deleted
+TRASH_DIRNAME = '.trash'
+
+# Pool of files shared between artifacts (see hashdist.core.dedup)
+OBJECTS_DIRNAME = '.objects'
+
+# Downloaded artifacts are extracted and relocated in a directory with
+# this prefix before they are moved into place
+EXTRACT_PREFIX = '.extract-'
+
+# Don't record the use of an artifact more often than this (seconds)
+TOUCH_INTERVAL = 60
+
+# Artifacts used this recently (seconds) are never evicted to meet the quota,
+# as a concurrent build may be about to use them
+EVICTION_GRACE = 3600
+
+# Holds the symlink making up a padded artifact root (see make_padded_root)
+PADDING_DIRNAME = '.padding'
+PADDING_NAME = '__hashdist_padding__'
+
+def make_padded_root(artifact_root, length):
+    """Creates a path of exactly `length` characters leading to `artifact_root`
+
+    The path is ``artifact_root/.padding/<name>[/<name>...]``, the last
+    component being a symlink back to `artifact_root`; returns it.
+    """
+    base = pjoin(artifact_root, PADDING_DIRNAME)
+    rest = length - len(base)
+    if rest < 2:
+        raise ValueError('Cannot pad %s to %d characters' % (artifact_root, length))
+    components = []
+    while rest > 0:
+        # components are at most 255 characters, and a slash
+        n = min(rest, 256)
+        if rest - n == 1:
+            n -= 1
+        components.append((PADDING_NAME * (n // len(PADDING_NAME) + 1))[:n - 1])
+        rest -= n
+    padded_root = pjoin(base, *components)
+    if not os.path.islink(padded_root):
+        silent_makedirs(os.path.dirname(padded_root))
+        try:
+            os.symlink('/'.join(['..'] * len(components)), padded_root)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    return padded_root
+
 class BuildStore(object):
     """
     Manages the directory of build artifacts; this is usually the entry point
@@ -266,11 +343,36 @@ class BuildStore(object):
         through these will not be collected in garbage collection.
 
     logger : Logger
+
+    db : ArtifactDB (optional)
+        Index of the artifacts and GC roots. If it was just created, it
+        is filled in from the build store directory.
+
+    quota : int (optional)
+        Size in bytes the build store may take. When it is exceeded,
+        :meth:`ensure_present` evicts the least recently used artifacts
+        that are not reachable from the GC roots. Requires `db`.
+
+    dedup : bool
+        Whether to share identical files of newly built artifacts with
+        other artifacts (see :meth:`dedup_artifact`).
+
+    fixed_artifact_root : str (optional)
+        Path at which builds see `artifact_root` (Linux only; see
+        :mod:`hashdist.core.namespace`).
+
+    padded_root_length : int (optional)
+        Have builds see `artifact_root` through a path of this length (see
+        :func:`make_padded_root`), so that the artifacts can be relocated
+        by patching binary files (see :mod:`hashdist.core.relocation`).
+        Ignored if `fixed_artifact_root` is given.
     """
 
     chunk_size = 16 * 1024
 
-    def __init__(self, temp_build_dir, artifact_root, gc_roots_dir, logger, local_mirrors=(), mirrors=(), create_dirs=False):
+    def __init__(self, temp_build_dir, artifact_root, gc_roots_dir, logger, local_mirrors=(), mirrors=(), create_dirs=False,
+                 mirror_ranking=None, mirror_race=0, db=None, quota=None, dedup=False,
+                 fixed_artifact_root=None, padded_root_length=None):
         self.temp_build_dir = os.path.realpath(temp_build_dir)
         self.artifact_root = os.path.realpath(artifact_root)
         self.gc_roots_dir = gc_roots_dir
@@ -280,6 +382,28 @@ class BuildStore(object):
                 silent_makedirs(d)
         self.local_mirrors = local_mirrors
         self.mirrors = mirrors
+        self.mirror_ranking = mirror_ranking if mirror_ranking is not None else MirrorRanking()
+        self.mirror_race = mirror_race
+        self.db = db
+        if db is not None and db.is_new:
+            self.rebuild_db()
+        if quota is not None and db is None:
+            logger.warning('The build store quota is ignored without the artifact database (db)')
+            quota = None
+        self.quota = quota
+        self._last_touched = {}
+        self.dedup = dedup
+        self.object_pool = ObjectPool(pjoin(self.artifact_root, OBJECTS_DIRNAME), logger)
+        if fixed_artifact_root is not None:
+            fixed_artifact_root = os.path.normpath(fixed_artifact_root)
+        self.fixed_artifact_root = fixed_artifact_root
+        if padded_root_length is not None and fixed_artifact_root is not None:
+            logger.warning('padded_root_length is ignored when building at a fixed_artifact_root')
+            padded_root_length = None
+        if padded_root_length is not None and os.path.isdir(self.artifact_root):
+            self.padded_artifact_root = make_padded_root(self.artifact_root, padded_root_length)
+        else:
+            self.padded_artifact_root = None
 
     def _log_artifact_collision(self, path, artifact_id):
         d = dict(path=path, artifact_id=artifact_id)
@@ -310,6 +434,15 @@ class BuildStore(object):
             else:
                 logger.error('Unrecognized build store mirror entry = '+`entry`)
                 raise NotImplementedError()
+        kw.setdefault('mirror_ranking', MirrorRanking.create_from_config(config))
+        kw.setdefault('mirror_race', config.get('mirror_race', 0))
+        if 'db' in config and 'db' not in kw:
+            kw['db'] = ArtifactDB(pjoin(config['db'], ARTIFACT_DB_FILENAME))
+        if 'build_store_quota' in config:
+            kw.setdefault('quota', parse_size(config['build_store_quota']))
+        kw.setdefault('dedup', config.get('dedup', False))
+        kw.setdefault('fixed_artifact_root', config.get('fixed_artifact_root'))
+        kw.setdefault('padded_root_length', config.get('padded_root_length'))
         return BuildStore(config['build_temp'],
                           config['build_stores'][0]['dir'],
                           config['gc_roots'],
@@ -321,14 +454,26 @@ class BuildStore(object):
     def get_build_dir(self):
         return self.temp_build_dir
 
+    def to_fixed_path(self, path):
+        """Returns `path` as seen by builds, which is different from `path`
+        if it is within the artifact root and builds happen at a fixed or
+        padded path
+        """
+        root = self.fixed_artifact_root or self.padded_artifact_root
+        if root is None:
+            return path
+        return to_fixed_path(path, self.artifact_root, root)
+
     def is_path_in_build_store(self, d):
         return os.path.realpath(d).startswith(self.artifact_root)
 
     def delete_all(self):
         for x in os.listdir(self.artifact_root):
             rmtree_write_protected(pjoin(self.artifact_root, x))
+        if self.db is not None:
+            self.db.remove_all_artifacts()
 
-    def delete(self, artifact_id):
+    def delete(self, artifact_id, prune=True):
         """Deletes an artifact ID from the store. This is simply an
         `rmtree`, i.e., it is (at least currently) possible to delete
         an aborted build, a build in progress etc., as long as it is
@@ -336,164 +481,283 @@ class BuildStore(object):
 
         This is the backend of the ``hit purge`` command.
 
+        Pruning the object pool walks all of it, so when deleting several
+        artifacts pass ``prune=False`` and call :meth:`prune_objects`
+        once at the end.
+
         Returns the path that was removed, or `None` if no path was present.
         """
         name, digest = artifact_id.split('/')
         path = self._get_artifact_path(name, digest)
+        if self.db is not None:
+            present_id = self.db.find_by_path(self._get_relative_path(path))
+            if present_id is not None:
+                self.db.remove_artifact(present_id)
         if os.path.exists(path):
             rmtree_write_protected(path)
+            if prune:
+                self.prune_objects()
             return path
         else:
             return None
 
+    def prune_objects(self):
+        """Removes the files of the object pool no longer shared by any
+        artifact; returns ``(count, freed)``
+        """
+        return self.object_pool.prune()
+
+    def resolve_prefix(self, prefix):
+        """Returns the sorted list of full IDs of the artifacts in the store
+        whose ID starts with `prefix`, e.g., ``python/2qbg``
+        """
+        if self.db is not None:
+            return self.db.resolve_prefix(prefix)
+        name = prefix.split('/')[0]
+        return sorted(artifact_id for artifact_id, path in self._walk_artifacts([name])
+                      if artifact_id.startswith(prefix))
+
     def _get_artifact_path(self, name, digest):
         return pjoin(self.artifact_root, name, digest[:SHORT_ARTIFACT_ID_LEN])
 
-    def _download_artifact(self, url, path, name, digest):
+    def _get_relative_path(self, path):
+        return os.path.relpath(os.path.realpath(path), self.artifact_root)
+
+    def _walk_artifacts(self, names=None):
+        """Yields ``(artifact_id, path)`` for the complete artifacts found in
+        the build store directory (optionally only those with the given names)
+        """
+        if names is None:
+            names = sorted(name for name in os.listdir(self.artifact_root)
+                           if not name.startswith('.'))
+        for name in names:
+            name_dir = pjoin(self.artifact_root, name)
+            if not os.path.isdir(name_dir):
+                continue
+            for short_digest in sorted(os.listdir(name_dir)):
+                path = pjoin(name_dir, short_digest)
+                try:
+                    with open(pjoin(path, 'id')) as f:
+                        artifact_id = f.read().strip()
+                except IOError:
+                    continue # not a complete artifact
+                yield artifact_id, path
+
+    def list_artifacts(self):
+        """Returns a list of ``(artifact_id, path)`` for all artifacts in the store"""
+        if self.db is not None:
+            return [(artifact_id, pjoin(self.artifact_root, path))
+                    for artifact_id, path in self.db.list_artifacts()]
+        else:
+            return list(self._walk_artifacts())
+
+    def register_artifact(self, artifact_id, path, build_time=None):
+        """Records a complete artifact in the artifact database (if any)
+        """
+        if self.db is None:
+            return
+        try:
+            with open(pjoin(path, 'artifact.json')) as f:
+                dependencies = json.load(f).get('dependencies', [])
+        except (IOError, ValueError):
+            dependencies = []
+        self.db.add_artifact(artifact_id, self._get_relative_path(path), dependencies,
+                             _get_tree_size(path), build_time)
+
+    def rebuild_db(self):
+        """Fills the artifact database in from scratch by scanning the build
+        store and gc_roots directories
+        """
+        self.logger.info('Indexing build store %s' % self.artifact_root)
+        self.db.remove_all_artifacts()
+        for artifact_id, path in self._walk_artifacts():
+            self.register_artifact(artifact_id, path)
+        self._sync_gc_roots()
+
+    def _get_partial_path(self, name, digest):
+        partial_dir = pjoin(self.temp_build_dir, PARTIAL_DIRNAME)
+        silent_makedirs(partial_dir)
+        return pjoin(partial_dir, '%s-%s.tar.gz' % (name, digest))
+
+    def _download_artifact(self, url, path, name, digest, mirror=None, opened=None):
         import subprocess
-        import glob
-        from .build_tools import _check_call
         # Provide a special case for local files
         use_urllib = not SIMPLE_FILE_URL_RE.match(url)
-        if not use_urllib:
+        if use_urllib:
+            # Download to a partial file named by the artifact, so that an
+            # interrupted download is resumed on the next attempt
+            partial_path = self._get_partial_path(name, digest)
+            self.logger.info("Downloading '%s'" % url)
+            t0 = clock()
+            with locked_partial_file(partial_path) as download_path:
+                try:
+                    hasher, transferred = download_resumable(url, download_path, self.logger,
+                                                             self.chunk_size, opened)
+                except urllib2.HTTPError, e:
+                    msg = "urllib failed to download (code: %d): %s" % (e.code, url)
+                    self.logger.info(msg)
+                    raise RemoteBuildStoreFetchError(msg)
+                except urllib2.URLError, e:
+                    if mirror is not None:
+                        self.mirror_ranking.record_failure(mirror)
+                    msg = "urllib failed to download (reason: %s): %s" % (e.reason, url)
+                    self.logger.info(msg)
+                    raise RemoteBuildStoreFetchError(msg)
+                except (IOError, httplib.HTTPException) as e:
+                    msg = "Unhandled Exception in Download: %s" % e
+                    self.logger.warning(msg)
+                    raise RemoteBuildStoreFetchError(msg)
+                # Move the complete file out of the way while still holding the lock
+                temp_fd, temp_path = tempfile.mkstemp(prefix='downloading-', dir=self.temp_build_dir)
+                os.close(temp_fd)
+                os.rename(download_path, temp_path)
+            if mirror is not None:
+                self.mirror_ranking.record_success(mirror, transferred, clock() - t0)
+        else:
             try:
                 stream = open(url[len('file:'):])
             except IOError as e:
                 raise StoreNotFoundError(str(e))
-        else:
-            # Make request.
+
+            # Copy file to a temporary file within self.artifact_root
+            self.logger.info("Downloading '%s'" % url)
+            temp_fd, temp_path = tempfile.mkstemp(prefix='downloading-', dir=self.artifact_root)
             try:
-                stream = urllib2.urlopen(url)
-            except urllib2.HTTPError, e:
-                msg = "urllib failed to download (code: %d): %s" % (e.code, url)
-                self.logger.info(msg)
-                raise RemoteBuildStoreFetchError(msg)
-            except urllib2.URLError, e:
-                msg = "urllib failed to download (reason: %s): %s" % (e.reason, url)
-                self.logger.info(msg)
+                with os.fdopen(temp_fd, 'wb') as f:
+                    try:
+                        shutil.copyfileobj(stream, f, self.chunk_size)
+                    finally:
+                        stream.close()
+            except Exception as e:
+                # Remove temporary file if there was a failure
+                os.unlink(temp_path)
+                msg = "Unhandled Exception in Download: %s" % e
+                self.logger.warning(msg)
                 raise RemoteBuildStoreFetchError(msg)
-
-        # Download file to a temporary file within self.packs_path, while hashing
-        # it.
-        self.logger.info("Downloading '%s'" % url)
-        temp_fd, temp_path = tempfile.mkstemp(prefix='downloading-', dir=self.artifact_root)
+        os.chmod(temp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        # Extract and relocate next to the store, and only move the artifact
+        # into place once that succeeded, so that a failure does not leave
+        # an unusable artifact behind
+        extract_dir = tempfile.mkdtemp(prefix=EXTRACT_PREFIX, dir=self.artifact_root)
         try:
-            f = os.fdopen(temp_fd, 'wb')
-            tee = HashingWriteStream(hashlib.sha256(), f)
-            if use_urllib:
-                if 'Content-Length' in stream.headers:
-                    progress = ProgressBar(int(stream.headers["Content-Length"]), logger=self.logger)
-                else:
-                    progress = ProgressSpinner(logger=self.logger)
             try:
-                n = 0
-                while True:
-                    chunk = stream.read(self.chunk_size)
-                    if not chunk: break
-                    if use_urllib:
-                        n += len(chunk)
-                        progress.update(n)
-                    tee.write(chunk)
+                subprocess.check_call(['tar', 'xzf', temp_path], cwd=extract_dir)
             finally:
-                stream.close()
-                f.close()
-                if use_urllib:
-                    progress.finish()
-        except Exception as e:
-            # Remove temporary file if there was a failure
-            os.unlink(temp_path)
-            msg = "Unhandled Exception in Download: %s" % e
-            self.logger.warning(msg)
-            raise RemoteBuildStoreFetchError(msg)
-        os.chmod(temp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
-        subprocess.check_call(['tar', 'xzf', temp_path], cwd=self.artifact_root)
-        os.remove(temp_path)
-        def relocate(artifact_dir, path):
-            artifact_full_path = pjoin(self.artifact_root, artifact_dir)
-            if not path.startswith(artifact_full_path):
-                raise ValueError('filename must be prefixed with artifact_dir')
-            s = path[len(artifact_full_path):]
-            ignore_patterns = ['.*\.pyc',
-                               '.*\.pyo',
-                               '.id',
-                               '.artifact.json',
-                               '.build.json',
-                               '.build.log.gz']
-            for pattern in ignore_patterns:
-                if re.match(pattern, s):
-                    return
-
-            artifact_dir_b = artifact_dir.encode(sys.getfilesystemencoding())
-            is_link = os.path.islink(path)
-            location_file = pjoin(artifact_full_path, 'location')
-            if os.path.isfile(location_file):
-                with open(location_file, 'r') as f:
-                    from_b = pjoin(f.read()).encode(
-                        sys.getfilesystemencoding())
-            elif os.getenv('HASHDIST_MIRROR_BLD') != None:
-                from_b =  pjoin(os.getenv('HASHDIST_MIRROR_BLD'),
-                                artifact_dir).encode(
-                    sys.getfilesystemencoding())
+                os.remove(temp_path)
+            extracted_path = pjoin(extract_dir, os.path.relpath(path, self.artifact_root))
+            try:
+                self._relocate(extracted_path, pjoin(name, digest))
+            except ValueError, e:
+                msg = "Could not relocate %s: %s" % (url, e)
+                self.logger.warning(msg)
+                raise RemoteBuildStoreFetchError(msg)
+            silent_makedirs(os.path.dirname(path))
+            # moving a directory to another parent needs write access to it
+            mode = os.stat(extracted_path).st_mode
+            os.chmod(extracted_path, mode | stat.S_IWUSR)
+            try:
+                os.rename(extracted_path, path)
+            except OSError, e:
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+                # fetched by another process meanwhile; use that one
             else:
-                return
-            from_b_parent = os.path.split(os.path.split(os.path.split(from_b)[0])[0])[0]
-            if not is_link and os.path.isfile(path):
-                with open(path) as f:
-                    data = f.read()
-                if from_b_parent in data or from_b in data:
-                    to_b = pjoin(self.artifact_root,artifact_dir).encode(
-                        sys.getfilesystemencoding())
-                    to_b = os.path.split(os.path.split(to_b)[0])[0]
-                    to_b_parent = os.path.split(to_b)[0]
-                    from_b = os.path.split(os.path.split(from_b)[0])[0]
-                    if '\x7fELF' in data[:4]:
-                        self.logger.info(
-                            'ELF contains reference  to "%s", which is being replaced with : %s' % (from_b, to_b))
-                        #if 'PATCHELF' not in env:
-                        #    raise Exception('PATCHELF not set (Linux relocatable packages depend on patchelf)')
-                        patchelf = glob.glob(os.path.join(to_b,'patchelf','*','bin','patchelf'))[0]
-                        
-                        # OK, we have an ELF, patch it. We first shrink the RPATH to what is actually used.
-                        filename=path
-                        #_check_call(logger, [patchelf, '--shrink-rpath', filename])
-                        
-                        # Then grab the RPATH, replace old location
-                        try:
-                            out = _check_call(self.logger, [patchelf, '--print-rpath', filename]).strip()
-                        except:
-                            out = False#did our best...
-                        if out:
-                            # non-empty RPATH, patch it
-                            abs_rpaths_str = out.strip()
-                            abs_rpaths = abs_rpaths_str.split(':')
-                            d = os.path.dirname(os.path.realpath(filename))
-                            new_abs_rpaths = [abs_rpath.replace(from_b,to_b) for abs_rpath in abs_rpaths]
-                            new_abs_rpaths = [abs_rpath.replace(from_b_parent,to_b_parent) for abs_rpath in new_abs_rpaths]
-                            new_abs_rpaths_str = ':'.join(new_abs_rpaths)
-                            self.logger.info('Rewriting RPATH on "%s" from "%s" to "%s"' % (filename, abs_rpaths_str, new_abs_rpaths_str))
-                            _check_call(self.logger, [patchelf, '--set-rpath', new_abs_rpaths_str, filename])
-                    else:
-                        new_data = data.replace(from_b, to_b)
-                        new_data = new_data.replace(from_b_parent, to_b_parent)
-                        self.logger.info(
-                            'File contains reference  to "%s", which is being replaced with : %s' % (from_b, to_b))
-                        st = os.stat(path)
-                        os.chmod( path, st.st_mode | stat.S_IWRITE )
-                        os.unlink( path )
-                        with open(path,'w') as f:
-                            data = f.write(new_data)
-                        os.chmod( path, st.st_mode)
-        for dirpath, dirnames, filenames in os.walk(path, topdown=False):
-            st = os.stat(dirpath)
-            os.chmod(dirpath, st.st_mode | stat.S_IWRITE)
-            for filename in filenames:
-                relocate(pjoin(name, digest), pjoin(dirpath, filename))
-            os.chmod(dirpath, st.st_mode)
+                os.chmod(path, mode)
+        finally:
+            rmtree_write_protected(extract_dir)
+
+    def _get_relocation_replacements(self, path, artifact_dir):
+        """Returns the ``(old, new)`` paths to replace in an artifact
+        downloaded to `path`, or `None` if its original location is unknown
+        """
+        location_file = pjoin(path, 'location')
+        if os.path.isfile(location_file):
+            with open(location_file, 'r') as f:
+                from_b = f.read().strip()
+        elif os.getenv('HASHDIST_MIRROR_BLD') != None:
+            from_b = pjoin(os.getenv('HASHDIST_MIRROR_BLD'), artifact_dir)
+        else:
+            return None
+        fs_encoding = sys.getfilesystemencoding()
+        # The artifact root the artifact was built in and its parent,
+        # which any path into the build store starts with
+        from_root = os.path.dirname(os.path.dirname(from_b.rstrip(os.sep)))
+        from_parent = os.path.dirname(from_root)
+        # Nothing to do for artifacts built at the same fixed path as ours
+        to_root = self.to_fixed_path(self.artifact_root)
+        to_parent = os.path.dirname(to_root)
+        replacements = []
+        for old, new in [(from_root, to_root), (from_parent, to_parent)]:
+            if isinstance(old, unicode):
+                old = old.encode(fs_encoding)
+            if isinstance(new, unicode):
+                new = new.encode(fs_encoding)
+            if old != new and old.strip(os.sep):
+                replacements.append((old, new))
+        return replacements or None
+
+    def _relocate(self, path, artifact_dir, jobs=4):
+        """Rewrites the paths to the build store an artifact downloaded to
+        `path` was built in, and updates its manifest accordingly
+        """
+        import glob
+        index = read_relocation_index(path)
+        if index is not None and 'padded_root' in index:
+            self._relocate_padded(path, index, jobs)
+            return
+        replacements = self._get_relocation_replacements(path, artifact_dir)
+        if replacements is None:
+            return
+        if index is not None:
+            # Only the files found to contain paths when the artifact was built
+            relpaths = [entry['path'] for entry in index['files']]
+        else:
+            relpaths = []
+            for dirpath, dirnames, filenames in os.walk(path):
+                for filename in filenames:
+                    relpath = os.path.relpath(pjoin(dirpath, filename), path)
+                    if not is_ignored(relpath):
+                        relpaths.append(relpath)
+        patchelfs = glob.glob(pjoin(self.artifact_root, 'patchelf', '*', 'bin', 'patchelf'))
+        patchelf = patchelfs[0] if patchelfs else None
+        with allow_writes(path):
+            changed = relocate_files(path, relpaths, replacements, self.logger, patchelf, jobs)
+            update_manifest(path, changed)
+
+    def _relocate_padded(self, path, index, jobs):
+        """Relocates an artifact built under a padded artifact root by
+        patching the root wherever it occurs
+        """
+        fs_encoding = sys.getfilesystemencoding()
+        old = index['padded_root'].encode(fs_encoding)
+        new = self.to_fixed_path(self.artifact_root)
+        if isinstance(new, unicode):
+            new = new.encode(fs_encoding)
+        if old == new:
+            return
+        if len(new) > len(old):
+            raise ValueError('the artifact root %s is longer than the padded root %s the artifact '
+                             'was built under' % (new, old))
+        relpaths = [entry['path'] for entry in index['files']]
+        with allow_writes(path):
+            changed = relocate_files(path, relpaths, [(old, new)], self.logger, jobs=jobs,
+                                     binary=True)
+            update_manifest(path, changed)
+
     def resolve(self, artifact_id,build_store_only=False):
         """Given an artifact_id, resolve the short path for it, or return
         None if the artifact isn't built.
         """
         name, digest = artifact_id.split('/')
+        if self.db is not None:
+            path = self.db.get_path(artifact_id)
+            if path is not None:
+                path = pjoin(self.artifact_root, path)
+                if os.path.isdir(path):
+                    self._touch(artifact_id)
+                    return path
+                # Removed behind our back
+                self.db.remove_artifact(artifact_id)
         path = self._get_artifact_path(name, digest)
         if build_store_only and not os.path.exists(path):
             return None
@@ -525,13 +789,25 @@ class BuildStore(object):
                     self.logger.error('The odds of this happening due to chance are very low.')
                     self.logger.error('Please get in touch with the HashDist developer mailing list.')
                     raise IllegalBuildStoreError('Hashes collide in first 12 chars: %s and %s' % (present_id, artifact_id))
+            self.register_artifact(artifact_id, path)
+            self._touch(artifact_id)
             return path
 
+    def _touch(self, artifact_id):
+        """Records the use of an artifact for the LRU eviction"""
+        if self.db is None:
+            return
+        now = time.time()
+        if now - self._last_touched.get(artifact_id, 0) < TOUCH_INTERVAL:
+            return
+        self.db.touch(artifact_id, now)
+        self._last_touched[artifact_id] = now
+
     def fetch_from_local_mirrors(self, name,digest,path):
         for mirror in self.local_mirrors:
             path_mirror = '%s/%s/%s' % (mirror, name, digest)
             try:
-                shutil.copytree(path_mirror,path)
+                copy_tree(path_mirror, path, allow_hardlink=True)
             except:
                 msg = "Could not fetch existing build from local mirror, continuing."
                 self.logger.debug(msg)
@@ -544,11 +820,42 @@ class BuildStore(object):
         self.logger.debug(msg)
         return False
 
+    def _race_mirrors(self, mirrors, name, digest):
+        """Sends the first request to the top ``mirror_race`` mirrors at once
+
+        Returns the mirror that responded first and its opened response
+        (see :func:`~hashdist.core.source_cache.open_url`), or ``(None, None)``.
+        """
+        candidates = [mirror for mirror in mirrors
+                      if not SIMPLE_FILE_URL_RE.match(mirror)][:self.mirror_race]
+        if len(candidates) < 2:
+            return None, None
+        partial_path = self._get_partial_path(name, digest)
+        offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+        openers = [lambda mirror=mirror: open_url('%s/%s/%s.tar.gz' % (mirror, name, digest), offset)
+                   for mirror in candidates]
+        i, opened, failures = race(openers, close=lambda opened: opened[0].close())
+        for j, e in failures:
+            if isinstance(e, urllib2.URLError) and not isinstance(e, urllib2.HTTPError):
+                self.mirror_ranking.record_failure(candidates[j])
+        if i is None:
+            return None, None
+        self.logger.debug("Mirror %s responded first" % candidates[i])
+        return candidates[i], opened
+
     def fetch_from_mirrors(self, name,digest,path):
-        for mirror in self.mirrors:
+        mirrors = self.mirror_ranking.order(self.mirrors)
+        winner, opened = None, None
+        if self.mirror_race > 1:
+            winner, opened = self._race_mirrors(mirrors, name, digest)
+            if winner is not None:
+                mirrors.remove(winner)
+                mirrors.insert(0, winner)
+        for mirror in mirrors:
             url = '%s/%s/%s.tar.gz' % (mirror, name, digest)
             try:
-                self._download_artifact(url, path, name, digest)
+                self._download_artifact(url, path, name, digest, mirror=mirror,
+                                        opened=opened if mirror == winner else None)
             except StoreNotFoundError:
                 msg = "Could not find remote build store mirror, continuing"
                 self.logger.debug(msg)
@@ -584,6 +891,14 @@ class BuildStore(object):
         if keep_build not in ('never', 'error', 'always'):
             raise ValueError("invalid keep_build value")
         build_spec = as_build_spec(build_spec)
+        if self.quota is not None:
+            # keep what this build will need
+            keep = set(virtuals.values())
+            for import_ in build_spec.doc['build'].get('import', []):
+                keep.add(import_['id'])
+            for artifact_id in list(keep):
+                keep.update(self.db.get_dependencies(artifact_id))
+            self.enforce_quota(keep)
         artifact_dir = self.resolve(build_spec.artifact_id)
 
         if artifact_dir is None:
@@ -640,8 +955,12 @@ class BuildStore(object):
 
     def prepare_build_dir(self, config, logger, build_spec, target_dir):
         source_cache = SourceCache.create_from_config(config, logger)
-        self.serialize_build_spec(build_spec, target_dir)
-        unpack_sources(self.logger, source_cache, build_spec.doc.get('sources', []), target_dir)
+        try:
+            self.serialize_build_spec(build_spec, target_dir)
+            unpack_sources(self.logger, source_cache, build_spec.doc.get('sources', []), target_dir)
+        finally:
+            # stop the git processes and finish shadow copies of this build
+            source_cache.close()
 
     def serialize_build_spec(self, build_spec, target_dir):
         fname = pjoin(target_dir, 'build.json')
@@ -670,29 +989,202 @@ class BuildStore(object):
         atomic_symlink(artifact_dir, symlink_target)
         root_name = self._encode_symlink(symlink_target)
         atomic_symlink(symlink_target, pjoin(self.gc_roots_dir, root_name))
+        if self.db is not None:
+            self.db.add_gc_root(root_name, symlink_target, artifact_id)
 
     def remove_symlink_to_artifact(self, symlink_target):
         symlink_target = realpath_to_symlink(symlink_target)
         root_name = self._encode_symlink(symlink_target)
         silent_unlink(pjoin(self.gc_roots_dir, root_name))
         silent_unlink(symlink_target)
+        if self.db is not None:
+            self.db.remove_gc_root(root_name)
+
+    def _sync_gc_roots(self):
+        """Brings the GC roots in the artifact database up to date with
+        the gc_roots directory, which may also be changed by hand
+        """
+        names = set(os.listdir(self.gc_roots_dir))
+        known = set(name for name, symlink, artifact_id in self.db.list_gc_roots())
+        for name in known - names:
+            self.db.remove_gc_root(name)
+        for name in names - known:
+            try:
+                symlink = os.readlink(pjoin(self.gc_roots_dir, name))
+            except OSError:
+                continue
+            artifact_id = self.db.find_by_path(self._get_relative_path(symlink))
+            self.db.add_gc_root(name, symlink, artifact_id)
 
-    def gc(self):
+    def list_gc_roots(self):
+        """Returns a sorted list of ``(symlink, artifact_dir)`` for the GC roots
+
+        `artifact_dir` is the artifact the symlink (usually a profile)
+        points to. If the symlink has been removed, the artifact it pointed
+        to when it was created is given if the artifact database knows
+        about it, otherwise `None`.
+        """
+        if self.db is not None:
+            self._sync_gc_roots()
+            roots = []
+            for name, symlink, artifact_id in self.db.list_gc_roots():
+                path = self.db.get_path(artifact_id) if artifact_id is not None else None
+                roots.append((symlink, pjoin(self.artifact_root, path) if path is not None else None))
+        else:
+            roots = []
+            for name in os.listdir(self.gc_roots_dir):
+                try:
+                    roots.append((os.readlink(pjoin(self.gc_roots_dir, name)), None))
+                except OSError:
+                    continue
+        return sorted((symlink, os.path.realpath(symlink) if os.path.exists(symlink) else path)
+                      for symlink, path in roots)
+
+    def get_source_keys(self):
+        """Returns the set of source keys listed in the ``build.json`` of
+        the artifacts in the build store
+        """
+        keys = set()
+        for artifact_id, path in self.list_artifacts():
+            try:
+                with open(pjoin(path, 'build.json')) as f:
+                    doc = json.load(f)
+            except (IOError, ValueError):
+                continue
+            for source in doc.get('sources', []):
+                keys.add(source['key'])
+        return keys
+
+    def gc(self, dry_run=False, jobs=4):
         """Run garbage collection, removing any unneeded artifacts.
 
         For now, this doesn't care about virtual dependencies. They're not
         used at the moment of writing this; it would have to be revisited
         in the future.
+
+        Artifacts to remove are first moved to a trash directory within
+        the build store, one atomic rename each, so that the store is
+        only briefly in flux; the trash is then emptied by `jobs`
+        threads. Trash left behind by an interrupted run is emptied too.
+
+        Parameters
+        ----------
+        dry_run : bool
+            Only report what would be removed.
+
+        jobs : int
+            Number of threads deleting artifacts.
+
+        Returns
+        -------
+        removed : list of str
+            IDs of the removed (or, with `dry_run`, removable) artifacts.
+
+        freed : int
+            Number of bytes freed (or that would be freed).
+        """
+        marked = self._mark()
+        # Less confusing output if we first output all keep, then the removals
+        for artifact_id in marked:
+            if not artifact_id.startswith('virtual:'):
+                self.logger.info('Keeping %s' % shorten_artifact_id(artifact_id))
+        # sweep phase
+        doomed = [(artifact_id, artifact_dir) for artifact_id, artifact_dir in self.list_artifacts()
+                  if artifact_id not in marked]
+        removed = [artifact_id for artifact_id, artifact_dir in doomed]
+        freed = sum(self._get_artifact_size(artifact_id, artifact_dir)
+                    for artifact_id, artifact_dir in doomed)
+        if dry_run:
+            for artifact_id in removed:
+                self.logger.info('Would remove %s' % shorten_artifact_id(artifact_id))
+        else:
+            self._remove_artifacts(doomed, jobs)
+        return removed, freed
+
+    def enforce_quota(self, keep=(), jobs=4):
+        """Evicts the least recently used artifacts that are not reachable
+        from the GC roots (nor listed in `keep`) until the build store fits
+        in the quota
+
+        Artifacts used within the last `EVICTION_GRACE` seconds are never
+        evicted. Returns ``(removed, freed)`` like :meth:`gc`.
+        """
+        if self.quota is None:
+            return [], 0
+        total = self.db.get_total_size()
+        if total <= self.quota:
+            return [], 0
+        marked = self._mark()
+        marked.update(keep)
+        cutoff = time.time() - EVICTION_GRACE
+        doomed = []
+        freed = 0
+        for artifact_id, path, size, last_used in self.db.list_by_last_use():
+            if total - freed <= self.quota or last_used > cutoff:
+                break
+            if artifact_id not in marked:
+                doomed.append((artifact_id, pjoin(self.artifact_root, path)))
+                freed += size or 0
+        if total - freed > self.quota:
+            self.logger.warning('Build store exceeds its quota of %.1f MB by %.1f MB, but the '
+                                'rest is in use' % (self.quota / 1e6, (total - freed - self.quota) / 1e6))
+        if doomed:
+            self.logger.info('Evicting %d artifacts to keep the build store within its quota' % len(doomed))
+            self._remove_artifacts(doomed, jobs)
+        return [artifact_id for artifact_id, artifact_dir in doomed], freed
+
+    def _remove_artifacts(self, doomed, jobs):
+        """Moves the ``(artifact_id, artifact_dir)`` in `doomed` to the trash
+        and then empties it
+        """
+        trash_dir = pjoin(self.artifact_root, TRASH_DIRNAME)
+        silent_makedirs(trash_dir)
+        for artifact_id, artifact_dir in doomed:
+            self.logger.info('Removing %s' % shorten_artifact_id(artifact_id))
+            if os.path.isdir(artifact_dir):
+                # moving a directory to another parent requires write access to it
+                os.chmod(artifact_dir, os.stat(artifact_dir).st_mode | stat.S_IWUSR)
+                trash_path = tempfile.mkdtemp(prefix=artifact_id.replace('/', '-') + '-', dir=trash_dir)
+                os.rename(artifact_dir, pjoin(trash_path, 'artifact'))
+            if self.db is not None:
+                self.db.remove_artifact(artifact_id)
+        self.empty_trash(jobs)
+        # once for all of them, as it walks the whole pool
+        self.prune_objects()
+
+    def dedup_artifact(self, artifact_dir, jobs=4):
+        """Replaces the write-protected files of an artifact by hard links
+        to identical files of other artifacts (through the object pool)
+
+        Returns ``(count, saved)``, the number of files that are now shared
+        and the number of bytes saved.
+        """
+        self.object_pool.jobs = jobs
+        manifest = read_manifest(artifact_dir)
+        digests = None
+        if manifest is not None:
+            digests = dict((entry.path, entry.digest) for entry in manifest if entry.type == 'f')
+        return self.object_pool.dedup_tree(artifact_dir, digests)
+
+    def _mark(self):
+        """Returns the set of IDs of artifacts reachable from the GC roots
         """
-        # mark phase
         marked = set()
         for gc_root in os.listdir(self.gc_roots_dir):
+            root_path = pjoin(self.gc_roots_dir, gc_root)
+            artifact_id = None
+            if self.db is not None and os.path.exists(root_path):
+                artifact_id = self.db.find_by_path(self._get_relative_path(root_path))
+            if artifact_id is not None:
+                marked.add(artifact_id)
+                marked.update(self.db.get_dependencies(artifact_id))
+                continue
             try:
-                f = open(pjoin(self.gc_roots_dir, gc_root, 'artifact.json'))
+                f = open(pjoin(root_path, 'artifact.json'))
             except IOError as e:
                 if e.errno == errno.ENOENT:
                     self.logger.warning("GC root link does not lead to artifact, removing: %s" % gc_root)
-                    silent_unlink(pjoin(self.gc_roots_dir, gc_root))
+                    silent_unlink(root_path)
                 else:
                     raise
             else:
@@ -700,24 +1192,51 @@ class BuildStore(object):
                     doc = json.load(f)
                 marked.add(doc['id'])
                 marked.update(doc['dependencies'])
-        # Less confusing output if we first output all keep, then the removals
-        for artifact_id in marked:
-            if not artifact_id.startswith('virtual:'):
-                self.logger.info('Keeping %s' % shorten_artifact_id(artifact_id))
-        # sweep phase
-        for artifact_name in os.listdir(self.artifact_root):
-            for short_digest in os.listdir(pjoin(self.artifact_root, artifact_name)):
-                artifact_dir = pjoin(self.artifact_root, artifact_name, short_digest)
-                artifact_id_file = pjoin(artifact_dir, 'id')
-                with open(artifact_id_file) as f:
-                    artifact_id = f.read().strip()
-                if artifact_id not in marked:
-                    # make sure 'id' is removed first, to de-mark the artifact as valid
-                    # before we go ahead and remove it
-                    self.logger.info('Removing %s' % shorten_artifact_id(artifact_id))
-                    os.chmod(artifact_dir, 0o777)
-                    os.unlink(artifact_id_file)
-                    rmtree_write_protected(artifact_dir)
+        if self.db is not None:
+            self._sync_gc_roots()
+        return marked
+
+    def _get_artifact_size(self, artifact_id, artifact_dir):
+        if self.db is not None:
+            record = self.db.get_artifact(artifact_id)
+            if record is not None and record['size'] is not None:
+                return record['size']
+        return _get_tree_size(artifact_dir)
+
+    def empty_trash(self, jobs=4):
+        """Deletes the artifacts moved to the trash by :meth:`gc`, using
+        `jobs` threads
+        """
+        trash_dir = pjoin(self.artifact_root, TRASH_DIRNAME)
+        if not os.path.isdir(trash_dir):
+            return
+        paths = [pjoin(trash_dir, x) for x in os.listdir(trash_dir)]
+        if not paths:
+            return
+        def remove(path):
+            try:
+                rmtree_write_protected(path)
+            except OSError, e:
+                # e.g., emptied by a concurrent run
+                if e.errno != errno.ENOENT:
+                    raise
+        pool = ThreadPool(min(jobs, len(paths)))
+        try:
+            pool.map(remove, paths)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def _get_tree_size(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(pjoin(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return total
 
 
 class ArtifactBuilder(object):
@@ -761,12 +1280,14 @@ class ArtifactBuilder(object):
     def build(self, config, keep_build):
         assert isinstance(config, dict), "caller not refactored"
         artifact_dir = self.build_store.make_artifact_dir(self.build_spec)
+        t0 = clock()
         try:
             self.make_artifact_json(artifact_dir)
             self.build_to(artifact_dir, config, keep_build)
         except:
             rmtree_write_protected(artifact_dir)
             raise
+        self.build_store.register_artifact(self.artifact_id, artifact_dir, build_time=clock() - t0)
         return artifact_dir
 
     def build_to(self, artifact_dir, config, keep_build):
@@ -784,6 +1305,17 @@ class ArtifactBuilder(object):
             try:
                 self.run_build_commands(build_dir, artifact_dir, env, config)
                 self.build_store.serialize_build_spec(self.build_spec, artifact_dir)
+                with allow_writes(artifact_dir):
+                    # any path into the build store starts with its parent
+                    artifact_root = self.build_store.to_fixed_path(self.build_store.artifact_root)
+                    padded_root = artifact_root if self.build_store.padded_artifact_root else None
+                    write_relocation_index(artifact_dir, os.path.dirname(artifact_root),
+                                           padded_root=padded_root)
+                    write_manifest(artifact_dir)
+                write_protect(pjoin(artifact_dir, RELOCATION_INDEX_FILENAME))
+                write_protect(pjoin(artifact_dir, MANIFEST_FILENAME))
+                if self.build_store.dedup:
+                    self.build_store.dedup_artifact(artifact_dir)
 
                 # Create 'id' marker for finished build by writing to _id and then mv to id
                 with allow_writes(artifact_dir):
@@ -864,4 +1396,4 @@ def unpack_sources(logger, source_cache, doc, target_dir):
         key = source_item['key']
         target = pjoin(target_dir, source_item.get('target', '.'))
         logger.debug('Unpacking sources %s' % key)
-        source_cache.unpack(key, target)
+        source_cache.unpack(key, target, source_item.get('git_checkout', None))
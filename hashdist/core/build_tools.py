@@ -20,6 +20,7 @@ import subprocess
 from .common import json_formatting_options
 from .build_store import BuildStore
 from .fileutils import rmdir_empty_up_to, write_protect, silent_unlink
+from .elf import ElfFile, ElfError, is_elf, shrink_rpath, set_rpath
 
 def execute_files_dsl(files, env):
     """
@@ -231,30 +232,32 @@ def postprocess_rpath_darwin(logger, artifact_root_dir, env, filename):
             _check_call(logger, ['install_name_tool', '-change', abs_lib_path, rel_lib_path, filename])
 
 def postprocess_rpath_linux(logger, env, filename):
-    # Read first 4 bytes to check for ELF magic
-    with open(filename) as f:
-        if f.read(4) != '\x7fELF':
-            # Not an ELF file
-            return
-
-    if 'PATCHELF' not in env:
-        raise Exception('PATCHELF not set (Linux relocatable packages depend on patchelf)')
-    patchelf = env['PATCHELF']
-
-    # OK, we have an ELF, patch it. We first shrink the RPATH to what is actually used.
-    _check_call(logger, [patchelf, '--shrink-rpath', filename])
+    if not is_elf(filename):
+        return
+    elf = ElfFile(filename)
+    if elf.rpath is None:
+        return
 
-    # Then grab the RPATH, make each path relative to ${ORIGIN}, and set again.
-    out = _check_call(logger, [patchelf, '--print-rpath', filename]).strip()
-    if out:
-        # non-empty RPATH, patch it
-        abs_rpaths_str = out.strip()
-        abs_rpaths = abs_rpaths_str.split(':')
+    # We first shrink the RPATH to what is actually used, then make each
+    # path relative to ${ORIGIN}. The RPATH is read and, if it got shorter,
+    # written in place; only a longer one needs patchelf.
+    abs_rpaths_str = shrink_rpath(elf.rpath, elf.needed)
+    if abs_rpaths_str:
         d = os.path.dirname(os.path.realpath(filename))
-        rel_rpaths = ['${ORIGIN}/' + os.path.relpath(abs_rpath, d) for abs_rpath in abs_rpaths]
+        rel_rpaths = ['${ORIGIN}/' + os.path.relpath(abs_rpath, d)
+                      if abs_rpath.startswith('/') else abs_rpath
+                      for abs_rpath in abs_rpaths_str.split(':')]
         rel_rpaths_str = ':'.join(rel_rpaths)
-        logger.debug('Rewriting RPATH on "%s" from "%s" to "%s"' % (filename, abs_rpaths_str, rel_rpaths_str))
-        _check_call(logger, [patchelf, '--set-rpath', rel_rpaths_str, filename])
+    else:
+        rel_rpaths_str = ''
+    if rel_rpaths_str != elf.rpath:
+        logger.debug('Rewriting RPATH on "%s" from "%s" to "%s"' % (filename, elf.rpath, rel_rpaths_str))
+        try:
+            set_rpath(filename, rel_rpaths_str, env.get('PATCHELF'), elf)
+        except ElfError:
+            if 'PATCHELF' not in env:
+                raise Exception('PATCHELF not set (Linux relocatable packages depend on patchelf)')
+            raise
 
 
 PKG_CONFIG_FILES_RE = re.compile(r'.*/lib/pkgconfig/.*\.pc$')
@@ -19,6 +19,21 @@ json_formatting_options = dict(indent=2, separators=(', ', ' : '),
 
 SHORT_ARTIFACT_ID_LEN = 12
 
+_SIZE_SUFFIXES = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+def parse_size(string):
+    """Parses a size in bytes with an optional K/M/G/T suffix (powers of 1024),
+    e.g., '50M' or '1024'. Raises ValueError if it can't be parsed.
+    """
+    s = str(string).strip().upper()
+    if s.endswith('B'):
+        s = s[:-1]
+    suffix = s[-1:] if s[-1:] in _SIZE_SUFFIXES else ''
+    try:
+        return int(float(s[:len(s) - len(suffix)]) * _SIZE_SUFFIXES[suffix])
+    except ValueError:
+        raise ValueError('Unable to parse as size: %r' % string)
+
 @contextlib.contextmanager
 def working_directory(path):
     old = os.getcwd()
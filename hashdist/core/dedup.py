@@ -0,0 +1,218 @@
+"""
+:mod:`hashdist.core.dedup` --- Sharing identical files between artifacts
+========================================================================
+
+Artifacts built from different build specs often contain many
+byte-identical files (headers, Python sources, documentation...). An
+:class:`ObjectPool` lets artifacts share a single copy of each such file
+through hard links: every file is hashed, and is replaced by a hard
+link to an object in the pool named by its hash (the file becoming the
+pool object if there is none yet).
+
+Only write-protected files are shared, as it must never be possible
+to modify a file in place through one artifact and thereby change
+another; the object name includes the file mode, so that files only
+differing in mode are not merged. Symlinks and empty files are left
+alone.
+
+The pool lives within the build store (so that hard links are
+possible) and uses the file system link count for reference counting:
+an object whose link count has dropped to 1 is no longer used by any
+artifact and is removed by :meth:`ObjectPool.prune`, which the build
+store runs after removing artifacts.
+
+Layout of the pool directory::
+
+    <xx>/<hash>-<mode>   object with the base32 SHA-256 digest <hash>
+                         (<xx> being its first two characters) and
+                         octal permission bits <mode>
+"""
+
+import os
+import errno
+import stat
+import hashlib
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+from .hasher import format_digest
+from .fileutils import allow_writes, silent_makedirs, silent_unlink
+
+pjoin = os.path.join
+
+CHUNK_SIZE = 1024 * 1024
+
+# Errors of os.link meaning a file can't be shared: not owned by us with
+# protected_hardlinks enabled, or on another file system than the pool
+UNLINKABLE_ERRNOS = (errno.EPERM, errno.EXDEV)
+
+
+def hash_file(filename):
+    """Returns the base32 SHA-256 digest of the contents of a file"""
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return format_digest(h)
+
+
+def is_shareable(st):
+    """Whether a file with the given ``os.lstat`` result may be shared"""
+    return stat.S_ISREG(st.st_mode) and st.st_size > 0 and not st.st_mode & 0o222
+
+
+class ObjectPool(object):
+    """
+    Pool of files shared between artifacts by hard links
+
+    Parameters
+    ----------
+    path : str
+        Directory of the pool; must be on the same file system as the
+        trees to deduplicate.
+
+    logger : Logger
+
+    jobs : int
+        Number of threads hashing files.
+    """
+
+    def __init__(self, path, logger, jobs=4):
+        self.path = path
+        self.logger = logger
+        self.jobs = jobs
+
+    def _get_object_filename(self, digest, mode):
+        return pjoin(self.path, digest[:2], '%s-%o' % (digest, stat.S_IMODE(mode)))
+
+    def dedup_tree(self, root, digests=None):
+        """Replaces the shareable files under `root` by hard links to pool objects
+
+        `digests` may map paths relative to `root` to the digests of
+        the files (e.g., from the manifest of an artifact), so that they
+        don't have to be read again.
+
+        Returns
+        -------
+        count : int
+            Number of files now shared with another artifact.
+
+        saved : int
+            Number of bytes saved.
+        """
+        if digests is None:
+            digests = {}
+        candidates = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                filename = pjoin(dirpath, filename)
+                st = os.lstat(filename)
+                if is_shareable(st):
+                    candidates.append((filename, st, digests.get(os.path.relpath(filename, root))))
+        if not candidates:
+            return 0, 0
+        def get_digest(candidate):
+            filename, st, digest = candidate
+            return digest if digest is not None else hash_file(filename)
+        pool = ThreadPool(min(self.jobs, len(candidates)))
+        try:
+            digests = pool.map(get_digest, candidates)
+        finally:
+            pool.close()
+            pool.join()
+        count = saved = 0
+        for (filename, st, known_digest), digest in zip(candidates, digests):
+            if self._share(filename, st, digest):
+                count += 1
+                if st.st_nlink == 1:
+                    saved += st.st_size
+        self.logger.debug('Shared %d files under %s, saving %d bytes' % (count, root, saved))
+        return count, saved
+
+    def _share(self, filename, st, digest):
+        """Links `filename` with the pool object for `digest`; returns whether
+        it was linked to an already existing object
+        """
+        obj = self._get_object_filename(digest, st.st_mode)
+        try:
+            obj_st = os.lstat(obj)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            obj_st = None
+        if obj_st is not None and obj_st.st_ino == st.st_ino and obj_st.st_dev == st.st_dev:
+            return False # already shared
+        if obj_st is None:
+            silent_makedirs(os.path.dirname(obj))
+            try:
+                os.link(filename, obj)
+            except OSError, e:
+                if e.errno in UNLINKABLE_ERRNOS:
+                    self._log_unlinkable(filename, e)
+                    return False
+                elif e.errno != errno.EEXIST:
+                    raise
+                # lost a race with another process; fall through to use its object
+            else:
+                return False
+        dirname = os.path.dirname(filename)
+        with allow_writes(dirname):
+            fd, temp = tempfile.mkstemp(prefix='.dedup-', dir=dirname)
+            os.close(fd)
+            os.unlink(temp)
+            try:
+                os.link(obj, temp)
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    return False # pruned by a concurrent process
+                elif e.errno in UNLINKABLE_ERRNOS:
+                    self._log_unlinkable(filename, e)
+                    return False
+                elif e.errno != errno.EMLINK:
+                    raise
+                # The object has as many links as the file system allows;
+                # start over with this file as the object
+                try:
+                    self._replace_object(filename, obj)
+                except OSError, e:
+                    if e.errno not in UNLINKABLE_ERRNOS:
+                        raise
+                    self._log_unlinkable(filename, e)
+                return False
+            try:
+                os.rename(temp, filename)
+            except:
+                silent_unlink(temp)
+                raise
+        return True
+
+    def _log_unlinkable(self, filename, e):
+        self.logger.info('Not sharing %s: %s' % (filename, os.strerror(e.errno)))
+
+    def _replace_object(self, filename, obj):
+        temp = obj + '.tmp'
+        silent_unlink(temp)
+        os.link(filename, temp)
+        os.rename(temp, obj)
+
+    def prune(self):
+        """Removes the objects no longer used by any artifact
+
+        Returns ``(count, freed)``.
+        """
+        count = freed = 0
+        if not os.path.isdir(self.path):
+            return count, freed
+        for shard in os.listdir(self.path):
+            shard_dir = pjoin(self.path, shard)
+            for name in os.listdir(shard_dir):
+                obj = pjoin(shard_dir, name)
+                st = os.lstat(obj)
+                if st.st_nlink == 1:
+                    silent_unlink(obj)
+                    count += 1
+                    freed += st.st_size
+        return count, freed
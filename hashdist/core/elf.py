@@ -0,0 +1,245 @@
+"""
+:mod:`hashdist.core.elf` --- Reading and rewriting the RPATH of ELF files
+=========================================================================
+
+Post-processing and relocating artifacts needs the RPATH (or RUNPATH)
+and the NEEDED entries of every ELF file. Running ``patchelf`` for
+each costs a fork and exec per file, which dominates for artifacts with
+thousands of shared libraries. This module reads the dynamic section
+directly instead.
+
+Rewriting is done in place in the dynamic string table, and so is only
+possible when the new RPATH is no longer than the old one (the rest of
+the old string is filled with NUL bytes). This is the common case when
+making RPATHs relative to ``${ORIGIN}``. When the string would have to
+grow, :func:`set_rpath` falls back to ``patchelf``, which knows how to
+rearrange the file.
+
+Both 32- and 64-bit files of either byte order are supported. The
+dynamic section is located through the program headers, so stripped
+files without section headers can be handled.
+"""
+
+import os
+import stat
+import struct
+import subprocess
+
+ELF_MAGIC = '\x7fELF'
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_STRSZ = 10
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+# Dynamic entries whose value is an offset into the string table
+_STRING_TAGS = (DT_NEEDED, DT_SONAME, DT_RPATH, DT_RUNPATH)
+
+
+class ElfError(Exception):
+    pass
+
+
+def is_elf(filename):
+    with open(filename, 'rb') as f:
+        return f.read(4) == ELF_MAGIC
+
+
+class ElfFile(object):
+    """
+    The dynamic section of an ELF file
+
+    Parameters
+    ----------
+    filename : str
+
+    Attributes
+    ----------
+    needed : list of str
+        The DT_NEEDED entries, in order.
+
+    rpath : str or None
+        The DT_RUNPATH if there is one, otherwise the DT_RPATH (like
+        ``patchelf --print-rpath``); `None` if there is neither.
+
+    Raises :exc:`ElfError` if the file is not an ELF file or can't be
+    parsed.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self._parse(f)
+
+    def _parse(self, f):
+        ident = f.read(16)
+        if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+            raise ElfError('%s is not an ELF file' % self.filename)
+        if ident[4] not in '\x01\x02' or ident[5] not in '\x01\x02':
+            raise ElfError('%s: unknown ELF class or byte order' % self.filename)
+        is64 = ident[4] == '\x02'
+        bo = '<' if ident[5] == '\x01' else '>'
+        if is64:
+            ehdr_fmt, phdr_fmt, dyn_fmt = bo + 'HHIQQQIHHHHHH', bo + 'IIQQQQQQ', bo + 'qQ'
+        else:
+            ehdr_fmt, phdr_fmt, dyn_fmt = bo + 'HHIIIIIHHHHHH', bo + 'IIIIIIII', bo + 'iI'
+        ehdr = self._unpack(f, 16, ehdr_fmt)
+        e_phoff, e_phentsize, e_phnum = ehdr[4], ehdr[8], ehdr[9]
+
+        loads = []
+        dynamic = None
+        for i in range(e_phnum):
+            phdr = self._unpack(f, e_phoff + i * e_phentsize, phdr_fmt)
+            if is64:
+                p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz = phdr[:6]
+            else:
+                p_type, p_offset, p_vaddr, p_paddr, p_filesz = phdr[:5]
+            if p_type == PT_LOAD:
+                loads.append((p_vaddr, p_offset, p_filesz))
+            elif p_type == PT_DYNAMIC:
+                dynamic = (p_offset, p_filesz)
+
+        self.needed = []
+        self.rpath = None
+        self._strings = {} # tag -> [string table offsets]
+        self._strtab_offset = None
+        if dynamic is None:
+            # statically linked
+            return
+        entries = []
+        dyn_size = struct.calcsize(dyn_fmt)
+        offset, size = dynamic
+        for pos in range(offset, offset + size - dyn_size + 1, dyn_size):
+            tag, val = self._unpack(f, pos, dyn_fmt)
+            if tag == DT_NULL:
+                break
+            entries.append((tag, val))
+        tags = dict(entries)
+        if DT_STRTAB not in tags:
+            raise ElfError('%s: dynamic section without string table' % self.filename)
+        # DT_STRTAB is a virtual address; find it in the file
+        strtab_vaddr = tags[DT_STRTAB]
+        for p_vaddr, p_offset, p_filesz in loads:
+            if p_vaddr <= strtab_vaddr < p_vaddr + p_filesz:
+                self._strtab_offset = strtab_vaddr - p_vaddr + p_offset
+                break
+        else:
+            raise ElfError('%s: string table not in any loaded segment' % self.filename)
+        for tag, val in entries:
+            if tag in _STRING_TAGS:
+                self._strings.setdefault(tag, []).append(val)
+        self.needed = [self._read_string(f, val) for val in self._strings.get(DT_NEEDED, [])]
+        for tag in (DT_RUNPATH, DT_RPATH):
+            if tag in self._strings:
+                self.rpath = self._read_string(f, self._strings[tag][0])
+                break
+
+    def _unpack(self, f, offset, fmt):
+        f.seek(offset)
+        size = struct.calcsize(fmt)
+        buf = f.read(size)
+        if len(buf) != size:
+            raise ElfError('%s: truncated ELF file' % self.filename)
+        return struct.unpack(fmt, buf)
+
+    def _read_string(self, f, offset):
+        f.seek(self._strtab_offset + offset)
+        chunks = []
+        while True:
+            chunk = f.read(256)
+            if not chunk:
+                raise ElfError('%s: unterminated string' % self.filename)
+            i = chunk.find('\0')
+            if i != -1:
+                chunks.append(chunk[:i])
+                return ''.join(chunks)
+            chunks.append(chunk)
+
+    def set_rpath_in_place(self, rpath):
+        """Overwrites the RPATH/RUNPATH strings with `rpath`
+
+        Returns `False`, leaving the file untouched, if `rpath` does not
+        fit in place of any of them (or the file has no RPATH), in
+        which case the file must be rewritten using ``patchelf``.
+        """
+        offsets = self._strings.get(DT_RPATH, []) + self._strings.get(DT_RUNPATH, [])
+        if not offsets:
+            return False
+        with open(self.filename, 'r+b') as f:
+            # Check everything before writing anything
+            old_lengths = [len(self._read_string(f, offset)) for offset in offsets]
+            if any(len(rpath) > n for n in old_lengths):
+                return False
+            # Don't clobber other strings sharing the space (tail merging)
+            others = [offset for tag, tag_offsets in self._strings.items()
+                      if tag not in (DT_RPATH, DT_RUNPATH) for offset in tag_offsets]
+            for offset, n in zip(offsets, old_lengths):
+                if any(offset <= other < offset + n for other in others):
+                    return False
+            for offset, n in zip(offsets, old_lengths):
+                f.seek(self._strtab_offset + offset)
+                f.write(rpath + '\0' * (n - len(rpath)))
+        self.rpath = rpath
+        return True
+
+
+def shrink_rpath(rpath, needed):
+    """Removes the directories of `rpath` that don't provide any library
+    in `needed` (like ``patchelf --shrink-rpath``)
+
+    Directories not given by an absolute path (e.g. ``$ORIGIN/../lib``)
+    are kept.
+    """
+    missing = set(needed)
+    kept = []
+    for d in rpath.split(':'):
+        if not d:
+            continue
+        if not d.startswith('/'):
+            kept.append(d)
+            continue
+        found = set(lib for lib in missing if os.path.exists(os.path.join(d, lib)))
+        if found:
+            kept.append(d)
+            missing -= found
+    return ':'.join(kept)
+
+
+def _run_patchelf(patchelf, args):
+    p = subprocess.Popen([patchelf] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    if p.returncode != 0:
+        raise ElfError('patchelf %s failed with code %d and stderr:\n%s' %
+                       (' '.join(args), p.returncode, err))
+    return out
+
+
+def set_rpath(filename, rpath, patchelf=None, elf=None):
+    """Sets the RPATH of an ELF file, in place if possible, otherwise
+    using `patchelf`
+
+    Returns whether `patchelf` was needed. Raises :exc:`ElfError` if it
+    was needed but `patchelf` is `None`.
+    """
+    if elf is None:
+        elf = ElfFile(filename)
+    if elf.rpath == rpath:
+        return False
+    mode = os.stat(filename).st_mode
+    os.chmod(filename, mode | stat.S_IWUSR)
+    try:
+        if elf.set_rpath_in_place(rpath):
+            return False
+        if patchelf is None:
+            raise ElfError('%s: the new RPATH "%s" does not fit in place, and patchelf is '
+                           'not available' % (filename, rpath))
+        _run_patchelf(patchelf, ['--set-rpath', rpath, filename])
+        return True
+    finally:
+        os.chmod(filename, mode)
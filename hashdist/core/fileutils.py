@@ -1,7 +1,9 @@
 import os
+import sys
 import errno
 import filecmp
 import shutil
+import stat
 import time
 import gzip
 from os.path import join as pjoin
@@ -20,12 +22,156 @@ def allow_writes(path):
         os.chmod(path, old_mode)
 
 
+#
+# Copy engine
+#
+# Copying is attempted in order of decreasing speed: reflink (a
+# copy-on-write clone, supported by e.g. btrfs and XFS), hard link
+# (only if allowed by the caller, and only for write-protected files
+# which should never be modified in place), an in-kernel copy
+# (``copy_file_range`` or ``sendfile``), and finally a plain
+# read/write loop.
+#
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int) from linux/fs.h
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        import ctypes
+        import ctypes.util
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        except OSError:
+            _libc = False
+    return _libc
+
+def _reflink(src_fd, dst_fd):
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except (IOError, OSError):
+        return False
+    return True
+
+def _kernel_copy(src_fd, dst_fd, size):
+    """Copies `size` bytes between the file descriptors without passing
+    through user space; returns False if this is not supported (in which
+    case nothing has been written)
+    """
+    libc = _get_libc()
+    if not libc or not sys.platform.startswith('linux'):
+        return False
+    import ctypes
+    for func_name in ['copy_file_range', 'sendfile']:
+        func = getattr(libc, func_name, None)
+        if func is None:
+            continue
+        func.restype = ctypes.c_ssize_t
+        copied = 0
+        while copied < size:
+            n = min(size - copied, 1 << 30)
+            if func_name == 'copy_file_range':
+                r = func(src_fd, None, dst_fd, None, ctypes.c_size_t(n), 0)
+            else:
+                r = func(dst_fd, src_fd, None, ctypes.c_size_t(n))
+            if r < 0:
+                err = ctypes.get_errno()
+                if copied == 0 and err in (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                                           errno.EOPNOTSUPP, errno.EBADF):
+                    break  # try next method
+                raise OSError(err, os.strerror(err))
+            elif r == 0:
+                break  # source shrunk under our feet
+            copied += r
+        else:
+            return True
+        if copied > 0:
+            return True
+    return False
+
+def copy_file(src, dst, allow_hardlink=False):
+    """Copies contents and mode of `src` to `dst` (like ``shutil.copy``),
+    using the fastest method available
+
+    Parameters
+    ----------
+
+    src : str
+        Source file.
+
+    dst : str
+        Target filename (not directory). Replaced if it exists; as it
+        may be a hard link, it is unlinked rather than overwritten.
+
+    allow_hardlink : bool
+        Whether `dst` may be a hard link to `src`. This is only done if
+        `src` is write-protected, as is the case for content of the
+        build store and source cache. It is up to the caller to make
+        sure `dst` will not be modified in place.
+
+    Returns
+    -------
+
+    method : str
+        One of ``'reflink'``, ``'hardlink'``, ``'kernel'``, ``'copy'``.
+    """
+    src_mode = os.stat(src).st_mode
+    silent_unlink(dst)
+    if allow_hardlink and not src_mode & 0o222:
+        try:
+            os.link(src, dst)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+        else:
+            return 'hardlink'
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            if _reflink(fsrc.fileno(), fdst.fileno()):
+                method = 'reflink'
+            elif _kernel_copy(fsrc.fileno(), fdst.fileno(), os.fstat(fsrc.fileno()).st_size):
+                method = 'kernel'
+            else:
+                shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+                method = 'copy'
+    os.chmod(dst, stat.S_IMODE(src_mode))
+    return method
+
+def copy_tree(src, dst, allow_hardlink=False):
+    """Like ``shutil.copytree(src, dst, symlinks=True)``, but copies files
+    with :func:`copy_file`
+
+    Directory modes are applied after their contents have been copied,
+    so that write-protected trees can be copied.
+    """
+    os.makedirs(dst)
+    dirs = [(src, dst)]
+    for dirpath, dirnames, filenames in os.walk(src):
+        target_dir = pjoin(dst, os.path.relpath(dirpath, src))
+        for name in dirnames + filenames:
+            src_name = pjoin(dirpath, name)
+            dst_name = pjoin(target_dir, name)
+            if os.path.islink(src_name):
+                os.symlink(os.readlink(src_name), dst_name)
+            elif name in dirnames:
+                os.mkdir(dst_name)
+                dirs.append((src_name, dst_name))
+            else:
+                copy_file(src_name, dst_name, allow_hardlink)
+    for src_dir, dst_dir in reversed(dirs):
+        shutil.copystat(src_dir, dst_dir)
+
 def silent_copy(src, dst):
     try:
         if os.path.isdir(src):
-            shutil.copytree(src, dst)
+            copy_tree(src, dst)
         else:
-            shutil.copy(src, dst)
+            copy_file(src, dst)
     except OSError:
         if not filecmp.cmp(src, dst):
             raise
@@ -214,13 +360,15 @@ def write_allow(path):
 def rmtree_write_protected(rootpath):
     """
     Like shutil.rmtree, but removes files/directories that are write-protected.
+
+    Only directory modes are changed; files may be hard links shared
+    with a mirror or another artifact, and unlinking them only requires
+    write access to the directory.
     """
     for dirpath, dirnames, filenames in os.walk(rootpath, followlinks=False, topdown=False):
         os.chmod(dirpath, 0o777)
         for fname in filenames:
             qname = pjoin(dirpath, fname)
-            if not os.path.islink(qname):
-                os.chmod(qname, 0o777)
             os.unlink(qname)
         for fname in dirnames:
             qname = pjoin(dirpath, fname)
@@ -39,7 +39,9 @@ happens.
   * *absolute_symlink* creates absolute symlinks. Just *symlink* is an
     alias for absolute symlink.
   * *relative_symlink* creates relative symlinks
-  * *copy* copies contents and mode (``shutil.copy``)
+  * *copy* copies contents and mode (like ``shutil.copy``, but using
+    reflinks where the filesystem supports it, see
+    :func:`~hashdist.core.fileutils.copy_file`)
   * *exclude* makes sure matching files are not considered in rules below
   * *launcher*, see :func:`make_launcher`
 
@@ -0,0 +1,160 @@
+"""
+:mod:`hashdist.core.manifest` --- Listing of the files of an artifact
+=====================================================================
+
+Each finished artifact carries a manifest, ``manifest.gz``, listing
+every file and directory in it with its type, mode, size and content
+hash. Anything that needs to know what an artifact contains (integrity
+checks, deduplication, pushing to a remote, looking for libraries) can
+read the manifest rather than walk and re-read the tree.
+
+The manifest is a gzipped text file with one line per entry, in the
+order of a depth-first walk with sorted directory listings::
+
+    <type> <mode> <size> <hash> <path>
+
+where `type` is ``f`` (regular file), ``d`` (directory) or ``l``
+(symlink), `mode` the octal permission bits, and `hash` the base32
+SHA-256 digest of the file contents (or of the target of a symlink;
+``-`` for directories). `path` is relative to the artifact and escaped
+like a Python string literal (``string_escape``). The manifest itself
+and the ``id`` file, which is written afterwards to mark the artifact
+as complete, are not listed.
+
+Files are hashed by a pool of threads while the tree is walked and the
+entries are written as soon as they are ready, so producing a manifest
+costs little more than reading the artifact once.
+"""
+
+import os
+import stat
+import gzip
+import hashlib
+from collections import namedtuple
+from contextlib import closing
+from multiprocessing.pool import ThreadPool
+
+from .hasher import format_digest
+from .dedup import hash_file
+
+pjoin = os.path.join
+
+MANIFEST_FILENAME = 'manifest.gz'
+
+# Not listed in the manifest
+EXCLUDED = (MANIFEST_FILENAME, MANIFEST_FILENAME + '.tmp', 'id')
+
+ManifestEntry = namedtuple('ManifestEntry', ['path', 'type', 'mode', 'size', 'digest'])
+
+
+def _iter_tree(root, reldir=''):
+    """Yields ``(relative_path, lstat_result)`` for everything under `root`,
+    depth first with the names of each directory sorted
+    """
+    for name in sorted(os.listdir(pjoin(root, reldir))):
+        relpath = pjoin(reldir, name) if reldir else name
+        if relpath in EXCLUDED:
+            continue
+        st = os.lstat(pjoin(root, relpath))
+        yield relpath, st
+        if stat.S_ISDIR(st.st_mode):
+            for x in _iter_tree(root, relpath):
+                yield x
+
+
+def _make_entry(root, relpath, st):
+    mode = stat.S_IMODE(st.st_mode)
+    if stat.S_ISDIR(st.st_mode):
+        return ManifestEntry(relpath, 'd', mode, 0, '-')
+    elif stat.S_ISLNK(st.st_mode):
+        target = os.readlink(pjoin(root, relpath))
+        return ManifestEntry(relpath, 'l', mode, len(target),
+                             format_digest(hashlib.sha256(target)))
+    elif stat.S_ISREG(st.st_mode):
+        return ManifestEntry(relpath, 'f', mode, st.st_size, hash_file(pjoin(root, relpath)))
+    else:
+        raise ValueError('%s is not a file, directory or symlink' % pjoin(root, relpath))
+
+
+def format_entry(entry):
+    path = entry.path
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    return '%s %o %d %s %s\n' % (entry.type, entry.mode, entry.size, entry.digest,
+                                 path.encode('string_escape'))
+
+
+def parse_entry(line):
+    type, mode, size, digest, path = line.rstrip('\n').split(' ', 4)
+    return ManifestEntry(path.decode('string_escape'), type, int(mode, 8), int(size), digest)
+
+
+def write_manifest(root, jobs=4):
+    """Writes the manifest of the tree `root` to ``root/manifest.gz``
+
+    Returns the list of :class:`ManifestEntry`.
+    """
+    filename = pjoin(root, MANIFEST_FILENAME)
+    temp_filename = filename + '.tmp'
+    entries = []
+    # Walk the tree up front (errors raised by the iterable passed to imap
+    # would hang the pool); it is cheap compared to the hashing
+    items = list(_iter_tree(root))
+    pool = ThreadPool(jobs)
+    try:
+        with closing(gzip.open(temp_filename, 'wb')) as f:
+            # imap returns the entries in order while the next files are hashed
+            for entry in pool.imap(lambda item: _make_entry(root, *item), items):
+                f.write(format_entry(entry))
+                entries.append(entry)
+        os.rename(temp_filename, filename)
+    except:
+        pool.terminate()
+        if os.path.exists(temp_filename):
+            os.unlink(temp_filename)
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    return entries
+
+
+def read_manifest(root):
+    """Returns the list of :class:`ManifestEntry` of the artifact `root`, or
+    `None` if it has no manifest
+    """
+    try:
+        f = gzip.open(pjoin(root, MANIFEST_FILENAME), 'rb')
+    except IOError:
+        return None
+    with closing(f):
+        return [parse_entry(line) for line in f]
+
+
+def update_manifest(root, relpaths):
+    """Updates the manifest entries of the given files of `root` after
+    they were changed (e.g., relocated)
+
+    Does nothing if the artifact has no manifest. The manifest is
+    replaced atomically, keeping its permissions.
+    """
+    entries = read_manifest(root)
+    if entries is None or not relpaths:
+        return
+    relpaths = set(relpaths)
+    filename = pjoin(root, MANIFEST_FILENAME)
+    temp_filename = filename + '.tmp'
+    mode = stat.S_IMODE(os.stat(filename).st_mode)
+    try:
+        with closing(gzip.open(temp_filename, 'wb')) as f:
+            for entry in entries:
+                if entry.path in relpaths:
+                    entry = _make_entry(root, entry.path, os.lstat(pjoin(root, entry.path)))
+                f.write(format_entry(entry))
+        os.chmod(temp_filename, mode)
+        os.rename(temp_filename, filename)
+    except:
+        if os.path.exists(temp_filename):
+            os.unlink(temp_filename)
+        raise
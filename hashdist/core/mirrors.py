@@ -0,0 +1,185 @@
+"""
+:mod:`hashdist.core.mirrors` --- Mirror health and ranking
+==========================================================
+
+Both the source cache and the build store can be configured with a
+list of remote mirrors. Rather than trying them strictly in the
+configured order, :class:`MirrorRanking` keeps track of how each
+mirror has performed and orders them by measured throughput:
+
+ * Mirrors that recently failed to connect are tried last. After
+   ``FAILURE_BACKOFF`` seconds they are treated as untested again.
+
+ * Mirrors with measured throughput are tried first, fastest first.
+
+ * Untested mirrors come in between, in configured order.
+
+The statistics are persisted as JSON in the ``cache`` directory of
+the configuration (see :mod:`hashdist.core.cache`); like everything
+else there, the file may be removed at any time.
+
+Optionally, :func:`race` can be used to issue the first request to
+several mirrors at once and keep whichever responds first.
+"""
+
+import os
+import json
+import tempfile
+import threading
+import Queue
+import time
+
+pjoin = os.path.join
+
+MIRROR_STATS_FILENAME = 'mirrors.json'
+
+# Seconds a mirror that failed to connect is moved to the back of the list
+FAILURE_BACKOFF = 600
+
+# Weight of a new throughput measurement in the running average
+SMOOTHING = 0.5
+
+
+class MirrorRanking(object):
+    """
+    Tracks mirror health and throughput, and orders mirrors accordingly.
+
+    Parameters
+    ----------
+
+    filename : str or None
+        JSON file to persist the statistics in. If `None`, statistics
+        are only kept in memory.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self.stats = self._load()
+
+    @staticmethod
+    def create_from_config(config):
+        """Creates a MirrorRanking persisted in the cache directory of the configuration
+        """
+        cache_dir = config.get('cache', None)
+        if cache_dir is None:
+            return MirrorRanking()
+        return MirrorRanking(pjoin(cache_dir, MIRROR_STATS_FILENAME))
+
+    def _load(self):
+        if self.filename is None:
+            return {}
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _refresh(self):
+        # re-read before updating, as other processes may have recorded
+        # statistics for other mirrors in the meantime
+        if self.filename is not None:
+            self.stats = self._load()
+
+    def _save(self):
+        if self.filename is None:
+            return
+        # dump to temporary file + atomic rename
+        dirname = os.path.dirname(self.filename)
+        try:
+            fd, temp_filename = tempfile.mkstemp(dir=dirname)
+        except OSError:
+            return  # the cache directory is a convenience only
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.stats, f)
+            os.rename(temp_filename, self.filename)
+        except:
+            os.unlink(temp_filename)
+            raise
+
+    def record_success(self, mirror, nbytes, seconds):
+        """Records that `nbytes` were fetched from `mirror` in `seconds`
+        """
+        throughput = nbytes / max(seconds, 1e-3)
+        with self._lock:
+            self._refresh()
+            entry = self.stats.setdefault(mirror, {})
+            if 'throughput' in entry:
+                throughput = SMOOTHING * throughput + (1 - SMOOTHING) * entry['throughput']
+            entry['throughput'] = throughput
+            entry.pop('failed_at', None)
+            self._save()
+
+    def record_failure(self, mirror):
+        """Records that `mirror` could not be reached
+        """
+        with self._lock:
+            self._refresh()
+            self.stats.setdefault(mirror, {})['failed_at'] = time.time()
+            self._save()
+
+    def order(self, mirrors):
+        """Returns `mirrors` sorted so that the most promising mirror comes first
+        """
+        now = time.time()
+        def key(item):
+            i, mirror = item
+            entry = self.stats.get(mirror, {})
+            if now - entry.get('failed_at', 0) < FAILURE_BACKOFF:
+                return (2, 0, i)
+            elif 'throughput' in entry:
+                return (0, -entry['throughput'], i)
+            else:
+                return (1, 0, i)
+        return [mirror for i, mirror in sorted(enumerate(mirrors), key=key)]
+
+
+def _close(result):
+    result.close()
+
+def race(openers, close=_close):
+    """Calls each function in `openers` concurrently, keeping the first result
+
+    Results of openers finishing after the winner are passed to
+    `close`, which by default calls their ``close`` method (as for
+    an HTTP response).
+
+    Returns
+    -------
+
+    index, result, failures
+        `index` and `result` are those of the first opener to return,
+        or `None` if all of them raised. `failures` is a list of
+        ``(index, exception)`` for the openers that raised before a
+        winner was found.
+    """
+    results = Queue.Queue()
+    lock = threading.Lock()
+    state = {'done': False}
+
+    def run(i, opener):
+        try:
+            result = opener()
+        except Exception as e:
+            results.put((i, None, e))
+            return
+        with lock:
+            if not state['done']:
+                state['done'] = True
+                results.put((i, result, None))
+                return
+        close(result)
+
+    for i, opener in enumerate(openers):
+        thread = threading.Thread(target=run, args=(i, opener))
+        thread.daemon = True
+        thread.start()
+
+    failures = []
+    for _ in range(len(openers)):
+        i, result, e = results.get()
+        if e is None:
+            return i, result, failures
+        failures.append((i, e))
+    return None, None, failures
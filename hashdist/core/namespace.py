@@ -0,0 +1,153 @@
+"""
+:mod:`hashdist.core.namespace` --- Building at a fixed path
+===========================================================
+
+Artifacts refer to themselves and their dependencies by absolute path,
+so an artifact built in one build store has to be relocated (see
+:mod:`hashdist.core.relocation`) before it can be used from a build
+store at another path. On Linux this can be avoided altogether: with
+the ``fixed_artifact_root`` setting, e.g.::
+
+    fixed_artifact_root: /hashdist/bld
+
+every build runs in a private mount namespace in which the real
+artifact root of the build store is bind-mounted at
+``/hashdist/bld``, and sees ``$ARTIFACT`` and the paths of its imports
+under that path. The artifacts then only contain the fixed path, and
+artifacts built by anyone using the same setting can be used as they
+are, provided the programs are also run with the same mapping
+(``hit fixed-root-exec``, or a launcher doing the same).
+
+The mount namespace is created inside an unprivileged user namespace
+(mapping the current user to itself), so no root access is needed at
+build time. The one requirement is that the fixed path exists as a
+directory to mount onto; it is created once by the administrator
+(``mkdir -p /hashdist/bld``) and left empty. Unprivileged user
+namespaces must be enabled in the kernel.
+"""
+
+import os
+import sys
+import errno
+import cPickle as pickle
+
+from .fileutils import _get_libc
+
+CLONE_NEWNS = 0x00020000
+CLONE_NEWUSER = 0x10000000
+
+MS_BIND = 4096
+MS_REC = 16384
+MS_PRIVATE = 1 << 18
+
+
+class NamespaceError(Exception):
+    pass
+
+
+def is_supported():
+    """Whether this platform can have user and mount namespaces"""
+    return sys.platform.startswith('linux') and os.path.exists('/proc/self/ns/user')
+
+
+def _check(ret, what):
+    if ret != 0:
+        import ctypes
+        e = ctypes.get_errno()
+        raise NamespaceError('%s failed: %s' % (what, os.strerror(e)))
+
+
+def _write_proc(name, s):
+    with open(os.path.join('/proc/self', name), 'w') as f:
+        f.write(s)
+
+
+def enter_fixed_root(real_path, fixed_path):
+    """Makes `real_path` appear at `fixed_path` for the calling process and
+    the processes it starts from now on
+
+    The process must be single-threaded (a requirement of entering a
+    user namespace), so this is normally called in a freshly forked
+    child; see :func:`run_with_fixed_root`.
+    """
+    if not is_supported():
+        raise NamespaceError('Building at a fixed path needs Linux user namespaces')
+    if not os.path.isdir(fixed_path):
+        raise NamespaceError('%s must exist as an (empty) directory to build at a fixed path; '
+                             'create it with "mkdir -p %s"' % (fixed_path, fixed_path))
+    libc = _get_libc()
+    if not libc:
+        raise NamespaceError('Could not load the C library')
+    encoding = sys.getfilesystemencoding()
+    if isinstance(real_path, unicode):
+        real_path = real_path.encode(encoding)
+    if isinstance(fixed_path, unicode):
+        fixed_path = fixed_path.encode(encoding)
+    uid, gid = os.getuid(), os.getgid()
+    _check(libc.unshare(CLONE_NEWUSER | CLONE_NEWNS), 'unshare')
+    try:
+        _write_proc('setgroups', 'deny')
+    except IOError, e:
+        if e.errno != errno.ENOENT: # kernels before 3.19
+            raise
+    _write_proc('uid_map', '%d %d 1\n' % (uid, uid))
+    _write_proc('gid_map', '%d %d 1\n' % (gid, gid))
+    # Keep our mounts from propagating back to the parent namespace
+    _check(libc.mount(None, '/', None, MS_REC | MS_PRIVATE, None), 'mount --make-rprivate /')
+    _check(libc.mount(real_path, fixed_path, None, MS_BIND | MS_REC, None),
+           'mount --rbind %s %s' % (real_path, fixed_path))
+
+
+def run_with_fixed_root(real_path, fixed_path, func, *args, **kw):
+    """Calls ``func(*args, **kw)`` in a child process in which `real_path`
+    appears at `fixed_path` (see :func:`enter_fixed_root`)
+
+    The return value, or the exception raised, is passed back to the
+    caller; both must be picklable (an exception that isn't is raised
+    as a :exc:`NamespaceError` with the same message).
+    """
+    for stream in (sys.stdout, sys.stderr):
+        stream.flush()
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(read_fd)
+            try:
+                enter_fixed_root(real_path, fixed_path)
+                result = (True, func(*args, **kw))
+            except BaseException, e:
+                result = (False, e)
+            try:
+                data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+                pickle.loads(data) # some exceptions can't be unpickled
+            except Exception:
+                data = pickle.dumps((False, NamespaceError('%s: %s' % (type(result[1]).__name__,
+                                                                       result[1]))))
+            with os.fdopen(write_fd, 'wb') as f:
+                f.write(data)
+            status = 0
+        finally:
+            for stream in (sys.stdout, sys.stderr):
+                stream.flush()
+            os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    if not data:
+        raise NamespaceError('Process building at %s terminated unexpectedly' % fixed_path)
+    result = pickle.loads(data)
+    if result[0]:
+        return result[1]
+    raise result[1]
+
+
+def to_fixed_path(path, real_path, fixed_path):
+    """Returns `path` as seen at the fixed path if it is within `real_path`,
+    otherwise `path` unchanged
+    """
+    if path == real_path or path.startswith(real_path + os.sep):
+        return fixed_path + path[len(real_path):]
+    return path
@@ -0,0 +1,427 @@
+"""
+:mod:`hashdist.core.relocation` --- Where artifacts refer to their own location
+===============================================================================
+
+Artifacts fetched from a build store mirror were built under another
+path, and files that refer to the build store by absolute path must be
+rewritten (see :meth:`~hashdist.core.build_store.BuildStore.resolve`).
+Most files of an artifact contain no such path, so rather than reading
+every file after a download, the files that do are found once, when
+the artifact is built, and recorded in ``relocations.json`` in the
+artifact::
+
+    {
+      "prefix": "/home/user/.hashdist",
+      "files": [
+        {"path": "bin/foo-config", "elf": false, "offsets": [312, 1025]},
+        {"path": "lib/libfoo.so", "elf": true, "offsets": [4400]}
+      ]
+    }
+
+`prefix` is the directory containing the build store (any path into
+the store, or next to it, starts with it), and `offsets` are the byte
+offsets at which it occurs in each file. ELF files are flagged, as
+only their RPATH is rewritten on relocation.
+
+Files matching `IGNORE_PATTERNS` (compiled Python files and the
+metadata files of the artifact) are never relocated and not listed.
+
+Paths can only be rewritten within text files, and in the RPATH of ELF
+files, as other binary data depends on offsets not changing. Artifacts
+built under a *padded* artifact root (see the ``padded_root_length``
+setting of :class:`~hashdist.core.build_store.BuildStore`), whose index
+has a ``"padded_root"`` key giving that root, are relocated differently:
+the new root is written over the padded one wherever it occurs (in any
+file not ignored), moving up the rest of the NUL-terminated string and
+filling the remaining space with NUL bytes. This requires the new root
+to be no longer than the padded one; if it is padded to the same
+length, nothing moves at all. Compiled Python files are still left
+alone, as their strings are length-prefixed rather than NUL-terminated
+(the paths in them only show up in tracebacks).
+
+:func:`relocate_files` does the rewriting, spread over a pool of
+processes. Files are scanned through ``mmap``; a file is rewritten in
+place if the replacement paths have the same length as the original
+ones, and is otherwise streamed to a new file that replaces it, so a
+file is never held in memory twice. The RPATHs of ELF files are
+rewritten in place when the new RPATH fits (see :mod:`hashdist.core.elf`);
+otherwise ``patchelf`` is used, one invocation for all files getting
+the same new RPATH.
+"""
+
+import os
+import re
+import json
+import mmap
+import stat
+import shutil
+import tempfile
+import subprocess
+from contextlib import closing
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from .elf import ElfFile, ElfError
+
+pjoin = os.path.join
+
+RELOCATION_INDEX_FILENAME = 'relocations.json'
+
+# Matched against the path relative to the artifact, with a leading '/'
+IGNORE_PATTERNS = [r'.*\.pyc',
+                   r'.*\.pyo',
+                   r'.id',
+                   r'.artifact.json',
+                   r'.build.json',
+                   r'.build.log.gz',
+                   r'.manifest.gz',
+                   # records the original location; must stay as it is
+                   r'.location$',
+                   r'.' + re.escape(RELOCATION_INDEX_FILENAME)]
+
+
+def is_ignored(relpath):
+    s = '/' + relpath
+    return any(re.match(pattern, s) for pattern in IGNORE_PATTERNS)
+
+
+def find_offsets(filename, needle):
+    """Returns the offsets at which `needle` occurs in a file, and whether
+    it is an ELF file
+    """
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return [], False
+        with closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as m:
+            is_elf = m[:4] == '\x7fELF'
+            offsets = []
+            i = m.find(needle)
+            while i != -1:
+                offsets.append(i)
+                i = m.find(needle, i + 1)
+            return offsets, is_elf
+
+
+def make_relocation_index(artifact_dir, prefix, jobs=4, padded_root=None):
+    """Finds the files in `artifact_dir` containing `prefix`
+
+    `padded_root` is the padded artifact root the artifact was built
+    under, if any.
+
+    Returns the index as described in the module docstring.
+    """
+    if isinstance(prefix, unicode):
+        prefix = prefix.encode('utf-8')
+    candidates = []
+    for dirpath, dirnames, filenames in os.walk(artifact_dir):
+        for filename in filenames:
+            path = pjoin(dirpath, filename)
+            relpath = os.path.relpath(path, artifact_dir)
+            if not os.path.islink(path) and os.path.isfile(path) and not is_ignored(relpath):
+                candidates.append(relpath)
+    candidates.sort()
+    files = []
+    if candidates:
+        pool = ThreadPool(min(jobs, len(candidates)))
+        try:
+            results = pool.map(lambda relpath: find_offsets(pjoin(artifact_dir, relpath), prefix),
+                               candidates)
+        finally:
+            pool.close()
+            pool.join()
+        for relpath, (offsets, is_elf) in zip(candidates, results):
+            if offsets:
+                files.append({'path': relpath, 'elf': is_elf, 'offsets': offsets})
+    index = {'prefix': prefix, 'files': files}
+    if padded_root is not None:
+        index['padded_root'] = padded_root
+    return index
+
+
+def write_relocation_index(artifact_dir, prefix, jobs=4, padded_root=None):
+    """Writes the relocation index of `artifact_dir` (see :func:`make_relocation_index`)
+    """
+    index = make_relocation_index(artifact_dir, prefix, jobs, padded_root)
+    with open(pjoin(artifact_dir, RELOCATION_INDEX_FILENAME), 'w') as f:
+        json.dump(index, f)
+    return index
+
+
+def read_relocation_index(artifact_dir):
+    """Returns the relocation index of an artifact, or `None` if it has none
+    """
+    try:
+        with open(pjoin(artifact_dir, RELOCATION_INDEX_FILENAME)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+#
+# Relocation
+#
+
+# Maximum number of files passed to a single patchelf invocation
+PATCHELF_BATCH_SIZE = 100
+
+
+def _make_pattern(replacements):
+    # The longest paths first, so that a path is replaced as a whole
+    # rather than a prefix of it
+    olds = sorted([old for old, new in replacements], key=len, reverse=True)
+    return re.compile('|'.join(re.escape(old) for old in olds))
+
+
+def replace_paths(s, replacements):
+    """Replaces each ``old`` in `s` by ``new`` for ``(old, new)`` in
+    `replacements`, in a single pass
+    """
+    mapping = dict(replacements)
+    return _make_pattern(replacements).sub(lambda m: mapping[m.group(0)], s)
+
+
+def _rewrite_file(filename, f, m, matches, mapping):
+    st = os.fstat(f.fileno())
+    if st.st_nlink == 1 and all(len(old) == len(new) for old, new in mapping.items()):
+        # Same length: patch the bytes in place
+        os.chmod(filename, st.st_mode | stat.S_IWUSR)
+        try:
+            with open(filename, 'r+b') as out:
+                for match in matches:
+                    out.seek(match.start())
+                    out.write(mapping[match.group(0)])
+        finally:
+            os.chmod(filename, st.st_mode)
+        return
+    # Stream the file to a new one, replacing the matches on the way
+    fd, temp_filename = tempfile.mkstemp(prefix='.relocate-', dir=os.path.dirname(filename))
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            pos = 0
+            for match in matches:
+                out.write(m[pos:match.start()])
+                out.write(mapping[match.group(0)])
+                pos = match.end()
+            out.write(m[pos:])
+        os.chmod(temp_filename, stat.S_IMODE(st.st_mode))
+        os.rename(temp_filename, filename)
+    except:
+        os.unlink(temp_filename)
+        raise
+
+
+def _patch_strings(filename, replacements):
+    """Rewrites the paths in a binary file in place, within each
+    NUL-terminated string containing them: the rest of the string is
+    moved up and the space left at its end filled with NUL bytes
+
+    The new paths must be no longer than the old ones.
+    """
+    pattern = _make_pattern(replacements)
+    with open(filename, 'r+b') as f:
+        with closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE)) as m:
+            pos = 0
+            while True:
+                match = pattern.search(m, pos)
+                if match is None:
+                    break
+                start = match.start()
+                end = m.find('\0', start)
+                if end == -1:
+                    end = len(m)
+                old = m[start:end]
+                new = replace_paths(old, replacements)
+                m[start:end] = new + '\0' * (len(old) - len(new))
+                pos = end
+            m.flush()
+
+
+def _patch_binary_file(filename, replacements):
+    st = os.stat(filename)
+    if st.st_nlink == 1:
+        os.chmod(filename, st.st_mode | stat.S_IWUSR)
+        try:
+            _patch_strings(filename, replacements)
+        finally:
+            os.chmod(filename, st.st_mode)
+        return
+    # Don't change the other links; patch a copy and replace the file with it
+    fd, temp_filename = tempfile.mkstemp(prefix='.relocate-', dir=os.path.dirname(filename))
+    os.close(fd)
+    try:
+        shutil.copyfile(filename, temp_filename)
+        _patch_strings(temp_filename, replacements)
+        os.chmod(temp_filename, stat.S_IMODE(st.st_mode))
+        os.rename(temp_filename, filename)
+    except:
+        os.unlink(temp_filename)
+        raise
+
+
+def relocate_file(filename, replacements, binary=False):
+    """Rewrites the paths in a file
+
+    If `binary` is `True`, files containing NUL bytes (ELF files, other
+    compiled code and data...) are patched in place (see
+    :func:`_patch_strings`), and the new paths must be no longer than
+    the old ones. Otherwise such files are left alone, and ``'elf'`` is
+    returned for ELF files containing any of the paths.
+
+    Returns whether the file was changed (or ``'elf'``).
+    """
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return False
+        with closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as m:
+            matches = list(_make_pattern(replacements).finditer(m))
+            if not matches:
+                return False
+            if binary and m.find('\0') != -1:
+                is_binary = True
+            elif m[:4] == '\x7fELF':
+                return 'elf'
+            else:
+                is_binary = False
+                _rewrite_file(filename, f, m, matches, dict(replacements))
+    if is_binary:
+        _patch_binary_file(filename, replacements)
+    return True
+
+
+def _relocate_file_worker(args):
+    return relocate_file(*args)
+
+
+def _relocate_elf_worker(args):
+    """Rewrites the RPATH of an ELF file in place if possible
+
+    Returns whether it was changed, or the new RPATH if that needs patchelf.
+    """
+    filename, replacements = args
+    try:
+        elf = ElfFile(filename)
+    except ElfError:
+        # not a proper ELF file after all
+        return False
+    if elf.rpath is None:
+        return False
+    rpath = replace_paths(elf.rpath, replacements)
+    if rpath == elf.rpath:
+        return False
+    mode = os.stat(filename).st_mode
+    os.chmod(filename, mode | stat.S_IWUSR)
+    try:
+        return True if elf.set_rpath_in_place(rpath) else rpath
+    finally:
+        os.chmod(filename, mode)
+
+
+def _set_rpaths(logger, patchelf, new_rpaths):
+    """Sets the RPATHs of ELF files given a dict ``{filename: rpath}``,
+    with one patchelf invocation per distinct RPATH (and batch of files)
+    """
+    by_rpath = {}
+    for filename, rpath in new_rpaths.items():
+        by_rpath.setdefault(rpath, []).append(filename)
+    for rpath, filenames in sorted(by_rpath.items()):
+        filenames.sort()
+        modes = [os.stat(filename).st_mode for filename in filenames]
+        for filename, mode in zip(filenames, modes):
+            os.chmod(filename, mode | stat.S_IWUSR)
+        try:
+            for i in range(0, len(filenames), PATCHELF_BATCH_SIZE):
+                batch = filenames[i:i + PATCHELF_BATCH_SIZE]
+                logger.info('Setting RPATH of %d files to "%s"' % (len(batch), rpath))
+                p = subprocess.Popen([patchelf, '--set-rpath', rpath] + batch,
+                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                out, err = p.communicate()
+                if p.returncode != 0:
+                    raise Exception('patchelf failed with code %d and stderr:\n%s' % (p.returncode, err))
+        finally:
+            for filename, mode in zip(filenames, modes):
+                os.chmod(filename, mode)
+
+
+def relocate_files(artifact_dir, relpaths, replacements, logger, patchelf=None, jobs=4,
+                   binary=False):
+    """Rewrites paths in files of an artifact
+
+    Parameters
+    ----------
+    artifact_dir : str
+        The artifact.
+
+    relpaths : list of str
+        The files to relocate, relative to `artifact_dir`; files not
+        containing any of the paths are left alone.
+
+    replacements : list of (str, str)
+        ``(old, new)`` byte strings.
+
+    logger : Logger
+
+    patchelf : str or None
+        The ``patchelf`` executable, used to rewrite the RPATHs of ELF
+        files that can't be rewritten in place. If `None`, such files
+        are left alone with a warning.
+
+    jobs : int
+        Number of processes.
+
+    binary : bool
+        Whether to patch the paths within binary files too (see
+        :func:`relocate_file`); for artifacts built under a padded
+        artifact root.
+
+    Returns
+    -------
+    The sorted list of the paths (relative to `artifact_dir`) of the
+    files that were changed.
+    """
+    if binary and any(len(new) > len(old) for old, new in replacements):
+        raise ValueError('Binary files can only be relocated to shorter paths: %s' %
+                         ', '.join('%s -> %s' % pair for pair in replacements))
+    filenames = [pjoin(artifact_dir, relpath) for relpath in sorted(set(relpaths))]
+    filenames = [filename for filename in filenames
+                 if not os.path.islink(filename) and os.path.isfile(filename)]
+    if not filenames:
+        return []
+    # Files may be replaced, so their directories must be writable; this
+    # is done up front rather than by each worker as workers share directories
+    dir_modes = {}
+    for filename in filenames:
+        dirname = os.path.dirname(filename)
+        if dirname not in dir_modes:
+            dir_modes[dirname] = os.stat(dirname).st_mode
+            os.chmod(dirname, dir_modes[dirname] | stat.S_IWUSR)
+    pool = Pool(min(jobs, len(filenames))) if jobs > 1 and len(filenames) > 1 else None
+    try:
+        map_ = pool.map if pool is not None else map
+        results = map_(_relocate_file_worker, [(filename, replacements, binary)
+                                               for filename in filenames])
+        changed = [filename for filename, result in zip(filenames, results) if result is True]
+        elf_files = [filename for filename, result in zip(filenames, results) if result == 'elf']
+        if elf_files:
+            results = map_(_relocate_elf_worker, [(filename, replacements) for filename in elf_files])
+            changed.extend(filename for filename, result in zip(elf_files, results) if result is True)
+            new_rpaths = dict((filename, result) for filename, result in zip(elf_files, results)
+                              if isinstance(result, str))
+            if new_rpaths and patchelf is None:
+                logger.warning('patchelf not found; not relocating %d ELF files in %s' %
+                               (len(new_rpaths), artifact_dir))
+            elif new_rpaths:
+                _set_rpaths(logger, patchelf, new_rpaths)
+                changed.extend(new_rpaths.keys())
+        if pool is not None:
+            pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+        for dirname, mode in dir_modes.items():
+            os.chmod(dirname, mode)
+    logger.info('Relocated %d files in %s' % (len(changed), artifact_dir))
+    return sorted(os.path.relpath(filename, artifact_dir) for filename in changed)
@@ -180,6 +180,15 @@ change the hash of the job desc.
    from the host; though software from the host will sometimes be
    specified as virtual dependencies.
 
+Building at a fixed path
+------------------------
+
+If the build store has a fixed artifact root (the ``fixed_artifact_root``
+setting), the commands are run in a mount namespace in which the
+artifact root appears at that path, and ``$ARTIFACT`` and the
+directories of the imports are given under it. See
+:mod:`hashdist.core.namespace`.
+
 Reference
 ---------
 
@@ -205,6 +214,7 @@ from logging import CRITICAL, ERROR, WARNING, INFO, DEBUG
 from hashdist.util.logger_setup import suppress_log_info, sublevel_added
 
 from .common import working_directory
+from .namespace import run_with_fixed_root
 
 LOG_PIPE_BUFSIZE = 4096
 
@@ -261,6 +271,8 @@ def handle_imports(logger, build_store, artifact_dir, virtuals, job_spec):
         if dep_dir is None:
             raise InvalidJobSpecError('Dependency "%s"="%s" not already built, please build it first' %
                                         (dep_ref, dep_id))
+        # The path as seen by the job when building at a fixed path
+        dep_dir = build_store.to_fixed_path(dep_dir)
 
         HDIST_IMPORT.append(dep_id)
         HDIST_IMPORT_PATHS.append(dep_dir)
@@ -325,6 +337,7 @@ def run_job(logger, build_store, job_spec, override_env, artifact_dir, virtuals,
         this will be an empty dict.
 
     """
+    artifact_dir = build_store.to_fixed_path(artifact_dir)
     env, assembled_commands = handle_imports(logger, build_store, artifact_dir, virtuals, job_spec)
 
     if 'commands' not in job_spec:
@@ -337,6 +350,13 @@ def run_job(logger, build_store, job_spec, override_env, artifact_dir, virtuals,
     env['HDIST_VIRTUALS'] = pack_virtuals_envvar(virtuals)
     env['HDIST_CONFIG'] = json.dumps(config, separators=(',', ':'))
     env['PWD'] = os.path.abspath(cwd)
+    if build_store.fixed_artifact_root is not None:
+        # See hashdist.core.namespace
+        return run_with_fixed_root(build_store.artifact_root, build_store.fixed_artifact_root,
+                                   _execute, logger, temp_dir, debug, assembled_commands, env)
+    return _execute(logger, temp_dir, debug, assembled_commands, env)
+
+def _execute(logger, temp_dir, debug, assembled_commands, env):
     executor = CommandTreeExecution(logger, temp_dir, debug=debug)
     try:
         executor.run_command_list(assembled_commands, env, ())
@@ -0,0 +1,422 @@
+"""
+:mod:`hashdist.core.scrub` --- Integrity checking of stores
+===========================================================
+
+Corruption in the source cache or the build store is otherwise only
+noticed when a build happens to unpack a damaged pack or resolve a
+damaged artifact. :class:`Scrubber` re-verifies everything up front:
+
+ * every archive and ``files:`` pack (also those in the segment store)
+   is hashed and compared with its key; shadow copies are compared
+   with their recorded digest
+
+ * every git repository of the source cache is checked with ``git fsck``
+
+ * for every artifact in the build store, the ``id`` file, the ``id`` in
+   ``artifact.json`` and the hash of ``build.json`` must agree with each
+   other and with the location of the artifact, and the files listed in
+   its manifest (see :mod:`hashdist.core.manifest`) are re-hashed
+
+Checks run in a thread pool. As scrubbing is meant to run from cron on
+shared stores, it can be throttled to a number of bytes per second,
+and :func:`set_idle_io_priority` asks the kernel to only serve our
+reads when the disk is otherwise idle.
+
+Items are checked in a fixed order, and the position reached is
+regularly saved to a cursor file, so that an interrupted scrub
+continues where it left off. The cursor is removed once a pass is
+complete.
+
+The outcome is a JSON-able report::
+
+    {"complete": true, "started": 1380000000.0, "finished": 1380000100.0,
+     "resumed_after": null, "checked": 1234, "bytes": 98765432,
+     "problems": [{"item": "tar.gz:...", "path": "...", "problem": "..."}]}
+
+where the counts and problems include those of earlier, interrupted
+runs of the same pass.
+"""
+
+import os
+import json
+import time
+import errno
+import hashlib
+import tempfile
+import threading
+import subprocess
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+from .hasher import format_digest
+from .source_cache import (ArchiveSourceCache, GitSourceCache, archive_types, iter_pack_files,
+                           SHADOW_DIRNAME, SHADOW_FORMATS)
+from .build_store import BuildSpec
+from .manifest import read_manifest, MANIFEST_FILENAME
+from .fileutils import silent_unlink
+
+pjoin = os.path.join
+
+SCRUB_CURSOR_FILENAME = 'scrub-cursor.json'
+
+# Seconds between saves of the cursor
+CURSOR_SAVE_INTERVAL = 10
+
+
+class RateLimiter(object):
+    """
+    Limits the combined rate at which threads consume bytes
+
+    Parameters
+    ----------
+
+    bytes_per_sec : int or None
+        Maximum rate; `None` or 0 for no limit
+    """
+
+    def __init__(self, bytes_per_sec=None):
+        self.bytes_per_sec = bytes_per_sec
+        self._lock = threading.Lock()
+        self._next = time.time()
+
+    def consume(self, nbytes):
+        """Waits until `nbytes` more bytes may be consumed"""
+        if not self.bytes_per_sec:
+            return
+        with self._lock:
+            now = time.time()
+            start = max(self._next, now)
+            self._next = start + float(nbytes) / self.bytes_per_sec
+        if start > now:
+            time.sleep(start - now)
+
+
+def set_idle_io_priority():
+    """Puts the current process in the "idle" IO scheduling class
+
+    Threads started afterwards inherit the priority. Returns whether
+    it succeeded (it needs the ``ionice`` program).
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(['ionice', '-c', '3', '-p', str(os.getpid())],
+                                   stdout=devnull, stderr=devnull) == 0
+    except OSError:
+        return False
+
+
+class Scrubber(object):
+    """
+    Verifies the contents of a source cache and/or build store
+
+    Parameters
+    ----------
+
+    source_cache : SourceCache or None
+
+    build_store : BuildStore or None
+
+    logger : Logger
+
+    jobs : int
+        Number of items checked in parallel
+
+    bytes_per_sec : int or None
+        Limit on the rate of reading pack contents
+
+    cursor_filename : str or None
+        Where to save the position reached, see module docstring. If
+        `None`, every scrub starts from the beginning.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, source_cache, build_store, logger, jobs=1, bytes_per_sec=None,
+                 cursor_filename=None):
+        self.source_cache = source_cache
+        self.build_store = build_store
+        self.logger = logger
+        self.jobs = jobs
+        self.limiter = RateLimiter(bytes_per_sec)
+        self.cursor_filename = cursor_filename
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def create_from_config(config, source_cache, build_store, logger, **kw):
+        cursor_filename = None
+        if config.get('cache', None) is not None:
+            cursor_filename = pjoin(config['cache'], SCRUB_CURSOR_FILENAME)
+        return Scrubber(source_cache, build_store, logger, cursor_filename=cursor_filename, **kw)
+
+    #
+    # Enumerating items
+    #
+
+    def iter_items(self):
+        """Returns a list of ``(item, check)`` in a fixed order, where `check`
+        is a function returning a list of ``(path, problem)``
+        """
+        items = []
+        if self.source_cache is not None:
+            items.extend(self._source_cache_items())
+        if self.build_store is not None:
+            items.extend(self._build_store_items())
+        items.sort(key=lambda item: item[0])
+        return items
+
+    def _source_cache_items(self):
+        asc = ArchiveSourceCache(self.source_cache)
+        items = []
+        for type in archive_types:
+            for hash, filename in iter_pack_files(asc.packs_path, type):
+                items.append(('%s:%s' % (type, hash),
+                              lambda hash=hash, filename=filename: self._check_file(filename, hash)))
+            shadow_dir = pjoin(asc.packs_path, SHADOW_DIRNAME, type)
+            for name in _listdir(shadow_dir):
+                for filename in _listdir(pjoin(shadow_dir, name)):
+                    if filename.endswith('.sha256') or filename.split('.')[-1] not in SHADOW_FORMATS:
+                        continue
+                    path = pjoin(shadow_dir, name, filename)
+                    items.append(('shadow:%s:%s' % (type, filename),
+                                  lambda path=path: self._check_shadow(path)))
+        files_dir = pjoin(asc.files_path, 'files')
+        for hash in _listdir(files_dir):
+            filename = pjoin(files_dir, hash)
+            # skip temporary files
+            if '-' not in hash and '.' not in hash and os.path.isfile(filename):
+                items.append(('files:%s' % hash,
+                              lambda hash=hash, filename=filename: self._check_file(filename, hash)))
+        segment_store = self.source_cache.get_segment_store()
+        for hash in segment_store.digests():
+            items.append(('files:%s' % hash,
+                          lambda hash=hash: self._check_segment(segment_store, hash)))
+        git_sc = GitSourceCache(self.source_cache)
+        for repo_name in _listdir(git_sc.repo_path):
+            items.append(('git:%s' % repo_name,
+                          lambda repo_name=repo_name: self._check_git(git_sc, repo_name)))
+        return items
+
+    def _build_store_items(self):
+        root = self.build_store.artifact_root
+        items = []
+        for name in _listdir(root):
+            if name.startswith('.') or not os.path.isdir(pjoin(root, name)):
+                continue
+            for short_digest in _listdir(pjoin(root, name)):
+                path = pjoin(root, name, short_digest)
+                if os.path.isdir(path):
+                    items.append(('artifact:%s/%s' % (name, short_digest),
+                                  lambda path=path, name=name, short_digest=short_digest:
+                                      self._check_artifact(path, name, short_digest)))
+        return items
+
+    #
+    # Checks
+    #
+
+    def _hash_file(self, f):
+        hasher = hashlib.sha256()
+        nbytes = 0
+        while True:
+            chunk = f.read(self.chunk_size)
+            if not chunk:
+                break
+            self.limiter.consume(len(chunk))
+            hasher.update(chunk)
+            nbytes += len(chunk)
+        self._count_bytes(nbytes)
+        return format_digest(hasher)
+
+    def _count_bytes(self, nbytes):
+        with self._lock:
+            self._state['bytes'] += nbytes
+
+    def _check_file(self, filename, hash):
+        try:
+            with open(filename, 'rb') as f:
+                digest = self._hash_file(f)
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return []  # removed while we were scrubbing
+            return [(filename, str(e))]
+        if digest != hash:
+            return [(filename, 'contents do not match key (hash is %s)' % digest)]
+        return []
+
+    def _check_shadow(self, path):
+        try:
+            with open(path + '.sha256') as f:
+                expected = f.read().strip()
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return []  # incomplete; will be remade on next unpack
+            return [(path, str(e))]
+        try:
+            with open(path, 'rb') as f:
+                digest = self._hash_file(f)
+        except IOError, e:
+            return [(path, str(e))]
+        if digest != expected:
+            return [(path, 'shadow copy does not match its digest')]
+        return []
+
+    def _check_segment(self, segment_store, hash):
+        try:
+            data = segment_store.get(hash)
+        except Exception, e:
+            return [(segment_store.path, 'files:%s: %s' % (hash, e))]
+        if data is None:
+            return []
+        digest = self._hash_file(StringIO(data))
+        if digest != hash:
+            return [(segment_store.path, 'files:%s does not match key (hash is %s)' % (hash, digest))]
+        return []
+
+    def _check_git(self, git_sc, repo_name):
+        path = git_sc.get_bare_repo_path(repo_name)
+        env = dict(os.environ)
+        env['GIT_DIR'] = path
+        p = subprocess.Popen(['git', 'fsck', '--no-dangling', '--no-progress'], env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        out, _ = p.communicate()
+        if p.returncode != 0:
+            return [(path, 'git fsck failed:\n%s' % out.strip())]
+        return []
+
+    def _check_artifact(self, path, name, short_digest):
+        id_filename = pjoin(path, 'id')
+        try:
+            with open(id_filename) as f:
+                artifact_id = f.read().strip()
+        except IOError, e:
+            if e.errno == errno.ENOENT and not os.path.exists(path):
+                return []  # removed while we were scrubbing
+            return [(path, 'no id file; incomplete or aborted build')]
+        problems = []
+        if not artifact_id.startswith('%s/%s' % (name, short_digest)):
+            problems.append((id_filename, 'id %s does not match location' % artifact_id))
+        try:
+            with open(pjoin(path, 'artifact.json')) as f:
+                artifact_doc = json.load(f)
+            if artifact_doc.get('id') != artifact_id:
+                problems.append((pjoin(path, 'artifact.json'),
+                                 'id %s does not match id file' % artifact_doc.get('id')))
+        except (IOError, ValueError), e:
+            problems.append((pjoin(path, 'artifact.json'), str(e)))
+        try:
+            with open(pjoin(path, 'build.json')) as f:
+                spec_id = BuildSpec(json.load(f)).artifact_id
+            if spec_id != artifact_id:
+                problems.append((pjoin(path, 'build.json'), 'hashes to %s, not to the id' % spec_id))
+        except (IOError, ValueError, KeyError), e:
+            problems.append((pjoin(path, 'build.json'), str(e)))
+        try:
+            manifest = read_manifest(path)
+        except (IOError, ValueError), e:
+            problems.append((pjoin(path, MANIFEST_FILENAME), str(e)))
+            manifest = None
+        for entry in manifest or []:
+            if entry.type == 'f':
+                problems.extend(self._check_file(pjoin(path, entry.path), entry.digest))
+        return problems
+
+    #
+    # Cursor
+    #
+
+    def _load_cursor(self):
+        if self.cursor_filename is None:
+            return None
+        try:
+            with open(self.cursor_filename) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _save_cursor(self):
+        if self.cursor_filename is None:
+            return
+        dirname = os.path.dirname(self.cursor_filename)
+        fd, temp_filename = tempfile.mkstemp(dir=dirname)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._state, f)
+            os.rename(temp_filename, self.cursor_filename)
+        except:
+            silent_unlink(temp_filename)
+            raise
+
+    def reset(self):
+        """Forgets the position of an interrupted scrub"""
+        if self.cursor_filename is not None:
+            silent_unlink(self.cursor_filename)
+
+    #
+    # Running
+    #
+
+    def scrub(self, max_items=None):
+        """Checks all items after the saved cursor; returns the report
+
+        If `max_items` is given, stops after that many items (leaving
+        the cursor for the next run to continue from).
+        """
+        state = self._load_cursor()
+        if state is None:
+            state = {'started': time.time(), 'position': None, 'checked': 0,
+                     'bytes': 0, 'problems': []}
+        self._state = state
+        resumed_after = state['position']
+        items = [(item, check) for item, check in self.iter_items()
+                 if resumed_after is None or item > resumed_after]
+        complete = True
+        if max_items is not None and len(items) > max_items:
+            items = items[:max_items]
+            complete = False
+        if resumed_after is not None:
+            self.logger.info('Resuming scrub after %s' % resumed_after)
+
+        def run(item_and_check):
+            item, check = item_and_check
+            try:
+                return item, check()
+            except Exception, e:
+                return item, [(None, 'check failed: %s' % e)]
+
+        pool = ThreadPool(self.jobs)
+        last_save = time.time()
+        done = False
+        try:
+            # imap returns results in order, so once an item is returned
+            # all items before it are done too
+            for item, problems in pool.imap(run, items):
+                for path, problem in problems:
+                    self.logger.error('%s: %s' % (path or item, problem))
+                    state['problems'].append({'item': item, 'path': path, 'problem': problem})
+                with self._lock:
+                    state['checked'] += 1
+                    state['position'] = item
+                if time.time() - last_save > CURSOR_SAVE_INTERVAL:
+                    self._save_cursor()
+                    last_save = time.time()
+            done = True
+        finally:
+            pool.terminate()
+            pool.join()
+            if not (done and complete):
+                self._save_cursor()
+        if complete:
+            self.reset()
+        report = {'complete': complete, 'started': state['started'], 'finished': time.time(),
+                  'resumed_after': resumed_after, 'checked': state['checked'],
+                  'bytes': state['bytes'], 'problems': state['problems']}
+        return report
+
+
+def _listdir(path):
+    try:
+        return sorted(os.listdir(path))
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
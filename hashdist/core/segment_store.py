@@ -0,0 +1,286 @@
+"""
+:mod:`hashdist.core.segment_store` --- Append-only store for small objects
+==========================================================================
+
+Storing every small object (such as the ``files:`` hit-packs holding
+build scripts and patches) as a file of its own leads to hundreds of
+thousands of tiny files over time, which is slow on network file
+systems. A :class:`SegmentStore` instead appends objects to a few
+large *segment* files, and records where each object went in an
+append-only index.
+
+Layout of the store directory::
+
+    index          one line "<digest> <segment> <offset> <length>" per object;
+                   a length of -1 marks the object as removed
+    lock           lock file serializing writers (``flock``)
+    seg-<g>-<n>    segment files of generation <g>
+
+Objects are appended to a segment before their index line is written,
+so readers never see a partially written object. Readers cache the
+index in memory and only read what has been appended since the last
+lookup.
+
+Space taken by removed objects (and by writes interrupted by a crash)
+is reclaimed by :meth:`SegmentStore.compact`, which copies the live
+objects to segments of a new generation and atomically replaces the
+index. :meth:`SegmentStore.put` compacts automatically once more than
+`COMPACT_RATIO` of the segment data is garbage.
+
+The store does not verify contents itself; objects are expected to be
+keyed by a secure hash of their contents that the caller checks.
+"""
+
+import os
+import errno
+import fcntl
+import tempfile
+import threading
+import contextlib
+
+pjoin = os.path.join
+
+INDEX_FILENAME = 'index'
+LOCK_FILENAME = 'lock'
+
+# Start a new segment file once the current one exceeds this size
+MAX_SEGMENT_SIZE = 64 * 1024 * 1024
+
+# Compact when more than this fraction of the segment data is garbage
+COMPACT_RATIO = 0.5
+
+# Don't bother compacting stores smaller than this
+COMPACT_MIN_SIZE = 4 * 1024 * 1024
+
+
+class SegmentStoreError(Exception):
+    pass
+
+
+def _segment_key(segment):
+    """Sort key of a segment name, ordering 'seg-0-10' after 'seg-0-9'"""
+    _, generation, n = segment.split('-')
+    return int(generation), int(n)
+
+
+class SegmentStore(object):
+    """
+    Append-only store of small objects keyed by digest
+
+    Parameters
+    ----------
+
+    path : str
+        Directory of the store; created if it does not exist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self._lock = threading.Lock()
+        self._entries = {}  # digest -> (segment, offset, length)
+        self._index_id = None  # (st_ino, bytes read) of the index we've loaded
+
+    #
+    # Index handling
+    #
+
+    def _refresh(self):
+        """Reads anything appended to the index since the last call"""
+        index_filename = pjoin(self.path, INDEX_FILENAME)
+        try:
+            f = open(index_filename, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._entries = {}
+            self._index_id = None
+            return
+        with f:
+            ino = os.fstat(f.fileno()).st_ino
+            if self._index_id is None or self._index_id[0] != ino:
+                # new or compacted index
+                self._entries = {}
+                pos = 0
+            else:
+                pos = self._index_id[1]
+            f.seek(pos)
+            data = f.read()
+        # ignore any incomplete line being written right now
+        end = data.rfind('\n') + 1
+        for line in data[:end].splitlines():
+            digest, segment, offset, length = line.split()
+            if int(length) < 0:
+                self._entries.pop(digest, None)
+            else:
+                self._entries[digest] = (segment, int(offset), int(length))
+        self._index_id = (ino, pos + end)
+
+    @contextlib.contextmanager
+    def _write_lock(self):
+        with open(pjoin(self.path, LOCK_FILENAME), 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                with self._lock:
+                    self._refresh()
+                    yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _append_index(self, lines):
+        with open(pjoin(self.path, INDEX_FILENAME), 'ab') as f:
+            f.write(''.join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _segments(self):
+        return sorted((x for x in os.listdir(self.path) if x.startswith('seg-')),
+                      key=_segment_key)
+
+    def _current_segment(self):
+        """Returns the name of the segment to append to"""
+        segments = self._segments()
+        if not segments:
+            return 'seg-0-0'
+        last = segments[-1]
+        _, generation, n = last.split('-')
+        if os.path.getsize(pjoin(self.path, last)) >= MAX_SEGMENT_SIZE:
+            return 'seg-%s-%d' % (generation, int(n) + 1)
+        return last
+
+    #
+    # Public API
+    #
+
+    def __contains__(self, digest):
+        with self._lock:
+            if digest not in self._entries:
+                self._refresh()
+            return digest in self._entries
+
+    def digests(self):
+        """Returns a list of all digests in the store"""
+        with self._lock:
+            self._refresh()
+            return self._entries.keys()
+
+    def sizes(self):
+        """Returns a dict mapping each digest in the store to the object size"""
+        with self._lock:
+            self._refresh()
+            return dict((digest, length) for digest, (segment, offset, length)
+                        in self._entries.items())
+
+    def get(self, digest):
+        """Returns the object stored under `digest`, or `None`"""
+        for attempt in range(2):
+            with self._lock:
+                if digest not in self._entries or attempt > 0:
+                    self._refresh()
+                entry = self._entries.get(digest, None)
+            if entry is None:
+                return None
+            segment, offset, length = entry
+            try:
+                with open(pjoin(self.path, segment), 'rb') as f:
+                    f.seek(offset)
+                    data = f.read(length)
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue  # compacted under our feet; reload the index
+            if len(data) == length:
+                return data
+        raise SegmentStoreError('Object %s is truncated in segment store %s' % (digest, self.path))
+
+    def put(self, digest, data):
+        """Appends `data` under `digest`, unless it is already present"""
+        if digest in self:
+            return
+        with self._write_lock():
+            if digest in self._entries:
+                return
+            segment = self._current_segment()
+            with open(pjoin(self.path, segment), 'ab') as f:
+                offset = f.tell()
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            self._append_index(['%s %s %d %d\n' % (digest, segment, offset, len(data))])
+            self._entries[digest] = (segment, offset, len(data))
+            if self._garbage_ratio() > COMPACT_RATIO:
+                self._compact()
+
+    def remove(self, digest):
+        """Marks the object stored under `digest` as removed; the space is
+        reclaimed on the next compaction"""
+        with self._write_lock():
+            if digest not in self._entries:
+                return
+            self._append_index(['%s - 0 -1\n' % digest])
+            del self._entries[digest]
+
+    def _garbage_ratio(self):
+        total = sum(os.path.getsize(pjoin(self.path, x)) for x in self._segments())
+        if total < COMPACT_MIN_SIZE:
+            return 0
+        live = sum(length for segment, offset, length in self._entries.values())
+        return 1 - float(live) / total
+
+    def compact(self):
+        """Copies all live objects to new segments, dropping removed ones"""
+        with self._write_lock():
+            self._compact()
+
+    def _compact(self):
+        old_segments = self._segments()
+        if old_segments:
+            generation = max(int(x.split('-')[1]) for x in old_segments) + 1
+        else:
+            generation = 0
+        n = 0
+        segment = 'seg-%d-%d' % (generation, n)
+        out = open(pjoin(self.path, segment), 'wb')
+        lines = []
+        new_entries = {}
+        try:
+            # copy in the order of the old segments to keep reads sequential
+            for digest, (old_segment, offset, length) in sorted(
+                    self._entries.items(),
+                    key=lambda item: (_segment_key(item[1][0]), item[1][1])):
+                if out.tell() >= MAX_SEGMENT_SIZE:
+                    out.close()
+                    n += 1
+                    segment = 'seg-%d-%d' % (generation, n)
+                    out = open(pjoin(self.path, segment), 'wb')
+                with open(pjoin(self.path, old_segment), 'rb') as f:
+                    f.seek(offset)
+                    data = f.read(length)
+                new_offset = out.tell()
+                out.write(data)
+                lines.append('%s %s %d %d\n' % (digest, segment, new_offset, length))
+                new_entries[digest] = (segment, new_offset, length)
+            out.flush()
+            os.fsync(out.fileno())
+        finally:
+            out.close()
+        # atomically replace the index, then remove the old segments
+        fd, temp_index = tempfile.mkstemp(dir=self.path, prefix='index-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(''.join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(temp_index, pjoin(self.path, INDEX_FILENAME))
+        except:
+            os.unlink(temp_index)
+            raise
+        for old_segment in old_segments:
+            os.unlink(pjoin(self.path, old_segment))
+        self._entries = new_entries
+        self._index_id = None
@@ -42,6 +42,41 @@ Features
  * Safety: Hashes are re-checked on the fly while unpacking, to protect
    against corruption or tainting of the source cache.
 
+ * Interrupted downloads are kept under ``packs/partial`` and resumed with
+   HTTP range requests on the next attempt.
+
+ * Git commits are stored in one bare repository per project under
+   ``git``. The ``git-index`` directory maps each commit to the
+   repository holding it, so that unpacking needs no search; it can
+   be rebuilt from the ``inuse/*`` branches with ``hit reindex-git``.
+
+ * Git sources need not be fetched with full history; see the
+   ``git_fetch`` setting and :data:`GIT_FETCH_MODES`. The index records
+   how each commit was fetched.
+
+ * Archives are stored as ``packs/<type>/<xx>/<hash>``, where ``xx``
+   are the first two characters of the hash, to keep directories small.
+   Packs in the flat ``packs/<type>/<hash>`` layout of older caches are
+   still found, and moved over by ``hit migrate-packs``. Mirrors keep
+   serving the flat layout.
+
+ * Tarballs are decompressed by parallel programs such as ``pigz``,
+   ``lbzip2``, ``xz -T0`` or ``zstd -T0`` when found on PATH (unless
+   the ``external_decompress`` setting is off); ``tar.zst`` always
+   requires ``zstd``.
+
+ * With the ``shadow_packs`` setting, an uncompressed copy of each
+   tarball is made in the background after it is first unpacked, and
+   unpacked instead of the original from then on.
+
+ * Small hit-packs (build scripts, patches) are appended to a
+   :class:`.SegmentStore` in ``files/segments`` instead of each taking
+   a file of its own.
+
+ * :meth:`SourceCache.gc` (``hit gc --sources``) removes sources no
+   artifact in the build store was built from, least recently unpacked
+   first, optionally only until the cache fits in a size quota.
+
  * Should be safe for multiple users to share a source cache directory
    on a shared file-system as long as all have write access, though this
    may need some work with permissions.
@@ -55,7 +90,8 @@ The keys for a given source item can be determined
 
 Tarballs/archives:
     SHA-256, encoded in base64 using :func:`.format_digest`. The prefix
-    is currently either ``tar.gz`` or ``tar.bz2``.
+    is the archive type, one of ``tar.gz``, ``tar.bz2``, ``tar.xz``,
+    ``tar.zst`` or ``zip``.
 
 Git commits:
     Identified by their (SHA-1) commits prefixed with ``git:``.
@@ -90,21 +126,31 @@ import sys
 import subprocess
 import tempfile
 import urllib2
+import httplib
 import json
 import shutil
 import hashlib
 import struct
 import errno
 import stat
+import fcntl
+import time
 from timeit import default_timer as clock
 import contextlib
+import copy
 import urlparse
+import threading
+import atexit
 from contextlib import closing
+from io import BytesIO
+from cStringIO import StringIO
 import logging
 from .common import working_directory
 from .hasher import hash_document, format_digest, HashingReadStream, HashingWriteStream
-from .fileutils import silent_makedirs
+from .fileutils import silent_makedirs, copy_file
 from .decorators import retry
+from .mirrors import MirrorRanking, race
+from .segment_store import SegmentStore
 
 pjoin = os.path.join
 
@@ -112,7 +158,41 @@ TAG_RE_S = r'^[a-zA-Z-_+=]+$'
 TAG_RE = re.compile(TAG_RE_S)
 
 PACKS_DIRNAME = 'packs'
+PARTIAL_DIRNAME = 'partial'
 GIT_DIRNAME = 'git'
+GIT_INDEX_DIRNAME = 'git-index'
+SEGMENTS_DIRNAME = 'segments'
+USAGE_LOG_FILENAME = 'usage.log'
+
+SHADOW_DIRNAME = 'shadow'
+
+# Formats for local shadow copies of compressed tarballs, which are
+# unpacked instead of the original when present (see ArchiveSourceCache):
+#  tar -- uncompressed tarball
+SHADOW_FORMATS = ('tar',)
+
+# Packs are stored as packs/<type>/<first SHARD_LEN chars of hash>/<hash>;
+# older source caches (and all mirrors) use packs/<type>/<hash>
+SHARD_LEN = 2
+
+# files: packs smaller than this are appended to the segment store
+# rather than stored as files of their own
+MAX_SEGMENT_PACK_SIZE = 1024 * 1024
+
+# How git commits are checked out on unpack:
+#  clone   -- a full repository with its own copy of the objects
+#  shared  -- a repository borrowing objects from the source cache (alternates)
+#  archive -- just the files, streamed with 'git archive'; no .git directory
+GIT_CHECKOUT_MODES = ('clone', 'shared', 'archive')
+
+# How much of a git repository is fetched into the source cache:
+#  full    -- the complete history of the rev (or of all remote heads)
+#  shallow -- only the tip of the rev (--depth=1)
+#  partial -- all commits and trees, but blobs only on demand (--filter=blob:none);
+#             such commits are always unpacked in 'archive' checkout mode
+#  commit  -- only the commit itself, requested by hash (needs a server
+#             allowing this, e.g. uploadpack.allowReachableSHA1InWant)
+GIT_FETCH_MODES = ('full', 'shallow', 'partial', 'commit')
 
 class RemoteFetchError(Exception):
     pass
@@ -199,11 +279,159 @@ def mkdir_if_not_exists(path):
         if e.errno != errno.EEXIST:
             raise
 
+def open_url(url, offset=0):
+    """Opens `url` with urllib2, asking the server to start at byte `offset`
+
+    Returns
+    -------
+
+    stream, offset
+        The offset returned is the one the stream actually starts at;
+        it is 0 if the server ignored the range request.
+    """
+    request = urllib2.Request(url)
+    if offset > 0:
+        request.add_header('Range', 'bytes=%d-' % offset)
+    stream = urllib2.urlopen(request)
+    if offset > 0:
+        content_range = stream.headers.get('Content-Range', '')
+        if stream.getcode() != 206 or not content_range.startswith('bytes %d-' % offset):
+            offset = 0
+    return stream, offset
+
+def download_resumable(url, partial_path, logger, chunk_size=16 * 1024, opened=None):
+    """Downloads `url` to `partial_path`, resuming any earlier attempt
+
+    If `partial_path` exists it is taken to hold a prefix of the
+    resource, and only the remainder is requested. The prefix is
+    re-hashed first so that the returned hash object covers the entire
+    file. If the server does not honour the range request the download
+    starts over.
+
+    On failure, the exception propagates and `partial_path` is left
+    in place so that a later call can pick up where this one left off.
+
+    If `opened` is given, it is a ``(stream, offset)`` pair as returned
+    by :func:`open_url` for the current size of `partial_path`, and is
+    used instead of issuing a new request.
+
+    Returns
+    -------
+
+    hasher : ``hashlib.sha256`` object of the complete file
+
+    transferred : int
+        The number of bytes actually read from the network
+    """
+    if (opened is not None and opened[1] != 0 and
+        opened[1] != (os.path.getsize(partial_path) if os.path.exists(partial_path) else 0)):
+        # opened for another state of the partial file, e.g. before
+        # locked_partial_file fell back to a private file
+        opened[0].close()
+        opened = None
+    hasher = hashlib.sha256()
+    offset = 0
+    if os.path.exists(partial_path):
+        with open(partial_path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk: break
+                hasher.update(chunk)
+                offset += len(chunk)
+    try:
+        stream, start = opened if opened is not None else open_url(url, offset)
+    except urllib2.HTTPError, e:
+        if e.code != 416 or offset == 0:
+            raise
+        # Requested range not satisfiable; the partial file is stale
+        stream, start = open_url(url, 0)
+    if start != offset:
+        if offset > 0:
+            logger.info("Server did not honour range request, restarting download of '%s'" % url)
+        hasher = hashlib.sha256()
+        offset = 0
+    elif offset > 0:
+        logger.info("Resuming download of '%s' at byte %d" % (url, offset))
+
+    if 'Content-Length' in stream.headers:
+        expected_size = offset + int(stream.headers["Content-Length"])
+        progress = ProgressBar(expected_size, logger=logger)
+    else:
+        expected_size = None
+        progress = ProgressSpinner(logger=logger)
+    try:
+        with open(partial_path, 'ab' if offset > 0 else 'wb') as f:
+            tee = HashingWriteStream(hasher, f)
+            n = offset
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk: break
+                n += len(chunk)
+                progress.update(n)
+                tee.write(chunk)
+    finally:
+        stream.close()
+        progress.finish()
+    if expected_size is not None and n < expected_size:
+        # urllib2 does not complain about a connection closed early
+        raise IOError('connection closed after %d of %d bytes' % (n, expected_size))
+    return hasher, n - offset
+
+def _lock_partial_file(partial_path):
+    # Returns a descriptor holding an exclusive lock on `partial_path`,
+    # or None if another process holds it
+    while True:
+        fd = os.open(partial_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            os.close(fd)
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return None
+        # The holder we raced with may have moved the file away meanwhile
+        try:
+            if os.path.samestat(os.fstat(fd), os.stat(partial_path)):
+                return fd
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                os.close(fd)
+                raise
+        os.close(fd)
+
+@contextlib.contextmanager
+def locked_partial_file(partial_path):
+    """Claims the partial download `partial_path` for the duration of the
+    block, so that concurrent downloads don't write to the same file
+
+    Yields the filename to download to: `partial_path` itself, locked
+    with ``flock``, or, if another process is downloading to it, a new
+    private file next to it, which is removed at the end of the block
+    (the download can't be resumed from it). Either file should be
+    moved away within the block once the download is complete.
+    """
+    fd = _lock_partial_file(partial_path)
+    if fd is not None:
+        try:
+            yield partial_path
+        finally:
+            os.close(fd)
+    else:
+        fd, private_path = tempfile.mkstemp(prefix=os.path.basename(partial_path) + '.',
+                                            dir=os.path.dirname(partial_path))
+        os.close(fd)
+        try:
+            yield private_path
+        finally:
+            silent_unlink(private_path)
+
 class SourceCache(object):
     """
     """
 
-    def __init__(self, cache_path, logger, local_mirrors=(), mirrors=(), create_dirs=False):
+    def __init__(self, cache_path, logger, local_mirrors=(), mirrors=(), create_dirs=False,
+                 mirror_ranking=None, mirror_race=0, git_checkout='clone', git_fetch='full',
+                 git_jobs=4, shadow_packs=None, external_decompress=True):
         if not os.path.isdir(cache_path):
             if create_dirs:
                 silent_makedirs(cache_path)
@@ -213,6 +441,25 @@ class SourceCache(object):
         self.logger = logger
         self.local_mirrors = local_mirrors
         self.mirrors = mirrors
+        self.mirror_ranking = mirror_ranking if mirror_ranking is not None else MirrorRanking()
+        self.mirror_race = mirror_race
+        if git_checkout not in GIT_CHECKOUT_MODES:
+            raise ValueError('Unknown git checkout mode: %s' % git_checkout)
+        self.git_checkout = git_checkout
+        if git_fetch not in GIT_FETCH_MODES:
+            raise ValueError('Unknown git fetch mode: %s' % git_fetch)
+        self.git_fetch = git_fetch
+        self.git_jobs = git_jobs
+        if shadow_packs is not None and shadow_packs not in SHADOW_FORMATS:
+            raise ValueError('Unknown shadow pack format: %s' % shadow_packs)
+        self.shadow_packs = shadow_packs
+        self.external_decompress = external_decompress
+        self._background_jobs = []
+        self._background_jobs_lock = threading.Lock()
+        self._git_brokers = {}
+        self._git_brokers_lock = threading.Lock()
+        self._segment_store = None
+        self._segment_store_lock = threading.Lock()
 
     def _ensure_subdir(self, name):
         path = pjoin(self.cache_path, name)
@@ -220,9 +467,46 @@ class SourceCache(object):
         return path
 
     def delete_all(self):
+        self.close()
         shutil.rmtree(self.cache_path)
         os.mkdir(self.cache_path)
 
+    def close(self):
+        """Applies any pending git ref updates, stops the git processes
+        kept running for querying repositories (see :class:`GitBroker`)
+        and waits for background jobs
+        """
+        with self._git_brokers_lock:
+            brokers = self._git_brokers.values()
+            self._git_brokers.clear()
+        for broker in brokers:
+            broker.close()
+        self.wait_for_background_jobs()
+
+    def run_in_background(self, func):
+        """Calls `func` in a separate thread; :meth:`close` waits for it
+        """
+        thread = threading.Thread(target=func)
+        with self._background_jobs_lock:
+            self._background_jobs = [t for t in self._background_jobs if t.is_alive()]
+            self._background_jobs.append(thread)
+        thread.start()
+
+    def wait_for_background_jobs(self):
+        with self._background_jobs_lock:
+            jobs = self._background_jobs
+            self._background_jobs = []
+        for thread in jobs:
+            thread.join()
+
+    def get_segment_store(self):
+        """Returns the :class:`.SegmentStore` holding small ``files:`` packs
+        """
+        with self._segment_store_lock:
+            if self._segment_store is None:
+                self._segment_store = SegmentStore(pjoin(self.cache_path, 'files', SEGMENTS_DIRNAME))
+            return self._segment_store
+
     @staticmethod
     def create_from_config(config, logger, create_dirs=False):
         """Creates a SourceCache from the settings in the configuration
@@ -240,9 +524,13 @@ class SourceCache(object):
             else:
                 logger.error('Unrecognized source cache mirror entry = '+`entry`)
                 raise NotImplementedError()
-        return SourceCache(config['source_caches'][0]['dir'], logger, local_mirrors, mirrors, create_dirs)
+        return SourceCache(config['source_caches'][0]['dir'], logger, local_mirrors, mirrors, create_dirs,
+                           MirrorRanking.create_from_config(config), config.get('mirror_race', 0),
+                           config.get('git_checkout', 'clone'), config.get('git_fetch', 'full'),
+                           config.get('git_jobs', 4), config.get('shadow_packs', None),
+                           config.get('external_decompress', True))
 
-    def fetch_git(self, repository, rev, repo_name):
+    def fetch_git(self, repository, rev, repo_name, git_fetch=None):
         """Fetches source code from git repository
 
         With this method one does not need to know a specific commit,
@@ -265,6 +553,9 @@ class SourceCache(object):
             getting a unique ID for a remote repo; and cloning all repos
             into the same git repo has scalability issues.
 
+        git_fetch : str or None
+            One of :data:`GIT_FETCH_MODES`; defaults to the ``git_fetch``
+            setting of the configuration.
 
         Returns
         -------
@@ -274,7 +565,21 @@ class SourceCache(object):
             prepended by ``git:``.
 
         """
-        return GitSourceCache(self).fetch_git(repository, rev, repo_name)
+        return GitSourceCache(self).fetch_git(repository, rev, repo_name,
+                                              mode=git_fetch or self.git_fetch)
+
+    def migrate_packs(self):
+        """Moves archives stored in the old flat ``packs/<type>`` layout
+        to the sharded one; see :meth:`ArchiveSourceCache.migrate_layout`
+        """
+        return ArchiveSourceCache(self).migrate_layout()
+
+    def rebuild_git_index(self):
+        """Rebuilds the index from git commits to the repository holding them
+
+        Returns the number of commits indexed.
+        """
+        return GitSourceCache(self).rebuild_index()
 
     def fetch_archive(self, url, type=None):
         """Fetches  a tarball without knowing the key up-front.
@@ -325,7 +630,7 @@ class SourceCache(object):
         return handler
 
     @retry(max_tries=3, exceptions=(RemoteFetchError))
-    def fetch(self, url, key, repo_name=None):
+    def fetch(self, url, key, repo_name=None, git_fetch=None):
         """Fetch sources whose key is known.
 
         This is the method to use in automated settings. If the
@@ -350,12 +655,20 @@ class SourceCache(object):
             otherwise. This must be present because a git "project" is distributed
             and cannot be deduced from URL (and pulling everything into the same
             repo was way too slow). Hopefully this can be mended in the future.
+
+        git_fetch : str or None
+            For git sources, how much to fetch; one of :data:`GIT_FETCH_MODES`.
+            Defaults to the ``git_fetch`` setting of the configuration.
+            Ignored for other sources.
         """
         type, hash = key.split(':')
         handler = self._get_handler(type)
-        handler.fetch(url, type, hash, repo_name)
+        if type == 'git':
+            handler.fetch(url, type, hash, repo_name, git_fetch or self.git_fetch)
+        else:
+            handler.fetch(url, type, hash, repo_name)
 
-    def unpack(self, key, target_path):
+    def unpack(self, key, target_path, git_checkout=None):
         """
         Unpacks the sources identified by `key` to `target_path`
 
@@ -377,6 +690,14 @@ class SourceCache(object):
         target_path : str
             Path to extract in
 
+        git_checkout : str or None
+            For git sources, one of ``clone`` (a self-contained
+            repository), ``shared`` (a repository using the objects
+            of the source cache through git alternates) or ``archive``
+            (only the files, without a ``.git`` directory). The default
+            is taken from the ``git_checkout`` setting of the configuration,
+            which defaults to ``clone``. Ignored for other sources.
+
         """
         if not os.path.exists(target_path):
             os.makedirs(target_path)
@@ -384,7 +705,268 @@ class SourceCache(object):
             raise ValueError("Key must be on form 'type:hash'")
         type, hash = key.split(':')
         handler = self._get_handler(type)
-        handler.unpack(type, hash, target_path)
+        if type == 'git':
+            handler.unpack(type, hash, target_path, git_checkout or self.git_checkout)
+        else:
+            handler.unpack(type, hash, target_path)
+        self._record_use(key)
+
+    #
+    # Garbage collection
+    #
+    # Each unpack appends "<key> <time>" to usage.log, so that gc() can
+    # evict the least recently used sources first. Sources never unpacked
+    # count as used when they were fetched.
+    #
+
+    def _record_use(self, key):
+        try:
+            fd = os.open(pjoin(self.cache_path, USAGE_LOG_FILENAME),
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+        except OSError:
+            return  # e.g., a read-only source cache
+        try:
+            os.write(fd, '%s %d\n' % (key, time.time()))
+        finally:
+            os.close(fd)
+
+    def _load_usage(self):
+        usage = {}
+        try:
+            f = open(pjoin(self.cache_path, USAGE_LOG_FILENAME))
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return usage
+        with f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2 and parts[1].isdigit():
+                    usage[parts[0]] = max(usage.get(parts[0], 0), int(parts[1]))
+        return usage
+
+    def _save_usage(self, usage):
+        # Uses made while this runs may be lost, which only makes
+        # the sources concerned candidates for removal a bit early
+        filename = pjoin(self.cache_path, USAGE_LOG_FILENAME)
+        fd, temp_filename = tempfile.mkstemp(dir=self.cache_path, prefix='usage-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for key, t in sorted(usage.items()):
+                    f.write('%s %d\n' % (key, t))
+            if os.path.exists(filename):
+                os.chmod(temp_filename, stat.S_IMODE(os.stat(filename).st_mode))
+            os.rename(temp_filename, pjoin(self.cache_path, USAGE_LOG_FILENAME))
+        except:
+            silent_unlink(temp_filename)
+            raise
+
+    def gc(self, keep, quota=None):
+        """Removes sources not in `keep`, least recently used first
+
+        Parameters
+        ----------
+
+        keep : set of str
+            Keys of sources that must not be removed, typically those
+            listed in the ``build.json`` of the artifacts in the build
+            store (see :meth:`.BuildStore.get_source_keys`).
+
+        quota : int or None
+            If given, only remove sources until the source cache takes
+            no more than `quota` bytes; otherwise, remove all sources
+            not in `keep`.
+
+        Returns
+        -------
+
+        removed : list of str
+            Keys of the removed sources, in the order removed
+
+        freed : int
+            Approximate number of bytes freed
+        """
+        usage = self._load_usage()
+        archives = ArchiveSourceCache(self)
+        git = GitSourceCache(self)
+        entries = archives.list_entries() + git.list_entries()
+        total = sum(size for key, size, t, remove in entries)
+        candidates = [(usage.get(key, t), key, size, remove)
+                      for key, size, t, remove in entries if key not in keep]
+        candidates.sort()
+        removed = []
+        freed = 0
+        for t, key, size, remove in candidates:
+            if quota is not None and total - freed <= quota:
+                break
+            self.logger.info('Removing %s' % key)
+            remove()
+            removed.append(key)
+            freed += size
+        archives.finish_gc()
+        git.finish_gc()
+        for key in removed:
+            usage.pop(key, None)
+        self._save_usage(usage)
+        return removed, freed
+
+
+_open_git_brokers = set()
+
+@atexit.register
+def _close_git_brokers():
+    for broker in list(_open_git_brokers):
+        try:
+            broker.close()
+        except (RuntimeError, OSError, IOError) as e:
+            # nothing more to do at this point; the refs only protect
+            # commits from 'git gc'
+            broker.logger.warning('Could not apply git ref updates: %s' % e)
+
+class GitBroker(object):
+    """
+    Answers object queries and applies ref updates for one git repository
+    through long-running git processes
+
+    Object and ref lookups go through a single ``git cat-file
+    --batch-check`` process rather than spawning git for each query.
+    Ref updates are queued and applied in batches by ``git update-ref
+    --stdin``, once `flush_threshold` are pending, on :meth:`flush` or
+    :meth:`close`, and at the latest when the interpreter exits.
+    Pending updates are taken into account by :meth:`get_ref`.
+
+    Parameters
+    ----------
+
+    env : dict
+        Environment for git, with ``GIT_DIR`` set to the repository.
+
+    logger : Logger
+    """
+
+    flush_threshold = 100
+
+    def __init__(self, env, logger):
+        self.env = env
+        self.logger = logger
+        self._lock = threading.RLock()
+        self._cat_file = None
+        self._update_ref = None
+        self._transactions = True  # whether update-ref supports 'start'/'commit'
+        self._pending = []  # list of (ref, commit), with commit None for deletion
+        _open_git_brokers.add(self)
+
+    def _popen(self, args):
+        self.logger.debug('starting: %s' % args)
+        # stderr goes to a file, as nobody reads a pipe of a long-running
+        # process until it has exited, and git would block once it is full
+        stderr = tempfile.TemporaryFile()
+        p = subprocess.Popen(args, env=self.env, stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE, stderr=stderr)
+        p.stderr_file = stderr
+        return p
+
+    def _stop(self, p):
+        """Waits for `p` to exit and returns what it wrote to stderr"""
+        p.stdin.close()
+        p.wait()
+        with p.stderr_file:
+            p.stderr_file.seek(0)
+            return p.stderr_file.read()
+
+    def lookup(self, name):
+        """Returns ``(sha, type)`` of the object `name` refers to, or
+        `None` if it does not exist"""
+        if not name or '\n' in name:
+            return None
+        with self._lock:
+            if self._cat_file is None:
+                self._cat_file = self._popen(['git', 'cat-file', '--batch-check'])
+            self._cat_file.stdin.write(name + '\n')
+            self._cat_file.stdin.flush()
+            line = self._cat_file.stdout.readline()
+            if not line:
+                err = self._stop(self._cat_file)
+                self._cat_file = None
+                raise RuntimeError('git cat-file exited unexpectedly:\n%s' % err)
+        fields = line.split()
+        if len(fields) != 3:
+            return None  # "<name> missing" or "<name> ambiguous"
+        return fields[0], fields[1]
+
+    def has_commit(self, commit):
+        return self.lookup(commit + '^{commit}') is not None
+
+    def get_ref(self, ref):
+        """Returns the commit `ref` (e.g., ``refs/heads/master``) points
+        to, or `None`"""
+        with self._lock:
+            for pending_ref, commit in reversed(self._pending):
+                if pending_ref == ref:
+                    return commit
+        result = self.lookup(ref)
+        return result[0] if result is not None else None
+
+    def update_ref(self, ref, commit, flush=False):
+        """Points `ref` to `commit`, or deletes it if `commit` is `None`
+
+        Unless `flush` is set the update is only queued.
+        """
+        with self._lock:
+            if self.get_ref(ref) == commit and not any(r == ref for r, c in self._pending):
+                return  # nothing to do
+            # git refuses several updates of one ref in a transaction
+            self._pending = [(r, c) for r, c in self._pending if r != ref]
+            self._pending.append((ref, commit))
+            if flush or len(self._pending) >= self.flush_threshold:
+                self.flush()
+
+    def flush(self):
+        """Applies all queued ref updates"""
+        with self._lock:
+            if not self._pending:
+                return
+            lines = ''.join('update %s %s\n' % (ref, commit) if commit is not None
+                            else 'delete %s\n' % ref
+                            for ref, commit in self._pending)
+            self._pending = []
+            if self._transactions:
+                if self._update_ref is None:
+                    self._update_ref = self._popen(['git', 'update-ref', '--stdin'])
+                p = self._update_ref
+                p.stdin.write('start\n' + lines + 'commit\n')
+                p.stdin.flush()
+                if p.stdout.readline() == 'start: ok\n' and p.stdout.readline() == 'commit: ok\n':
+                    return
+                self._update_ref = None
+                err = self._stop(p)
+                if 'unknown command: start' not in err:
+                    raise RuntimeError('git update-ref failed:\n%s' % err)
+                # git older than 2.27; use a process per batch
+                self._transactions = False
+            p = self._popen(['git', 'update-ref', '--stdin'])
+            p.stdin.write(lines)
+            err = self._stop(p)
+            if p.returncode != 0:
+                raise RuntimeError('git update-ref failed:\n%s' % err)
+
+    def restart(self):
+        """Restarts the query process, e.g., after alternates were added"""
+        with self._lock:
+            if self._cat_file is not None:
+                self._stop(self._cat_file)
+                self._cat_file = None
+
+    def close(self):
+        with self._lock:
+            try:
+                self.flush()
+            finally:
+                for p in [self._cat_file, self._update_ref]:
+                    if p is not None:
+                        self._stop(p)
+                self._cat_file = self._update_ref = None
+                _open_git_brokers.discard(self)
 
 
 class GitSourceCache(object):
@@ -393,9 +975,21 @@ class GitSourceCache(object):
 
     def __init__(self, source_cache):
         self.repo_path = pjoin(source_cache.cache_path, GIT_DIRNAME)
+        self.index_path = pjoin(source_cache.cache_path, GIT_INDEX_DIRNAME)
         self.logger = source_cache.logger
         self.local_mirrors = source_cache.local_mirrors
-    
+        self.brokers = source_cache._git_brokers
+        self.brokers_lock = source_cache._git_brokers_lock
+        self.jobs = source_cache.git_jobs
+        self._gc_repos = set()
+
+    def get_broker(self, repo_name):
+        with self.brokers_lock:
+            broker = self.brokers.get(repo_name, None)
+            if broker is None:
+                broker = self.brokers[repo_name] = GitBroker(self.get_repo_env(repo_name), self.logger)
+            return broker
+
     def git(self, repo_name, *args):
         # Inherit stdin/stdout in order to interact with user about any passwords
         # required to connect to any servers and so on
@@ -443,19 +1037,16 @@ class GitSourceCache(object):
         """Create temporary branch reference to commit"""
         mark = 'tempmark/%s' % commit
 
-        self._ensure_branch(repo_name, mark, commit)
+        # git needs to see the branch right away; removing it can wait
+        self._ensure_branch(repo_name, mark, commit, flush=True)
         try:
             yield mark
         finally:
-            self.checked_git(repo_name, 'branch', '-D', mark)
+            self.get_broker(repo_name).update_ref('refs/heads/%s' % mark, None)
 
-    def _ensure_branch(self, repo_name, branch, commit):
-        retcode, out, err = self.git(repo_name, 'branch', branch, commit)
-        if retcode != 0:
-            # Did it already exist? If so we're good (except if hashdist gc runs
-            # at the same time...)
-            if not self._does_branch_exist(repo_name, branch):
-                raise RuntimeError('git branch failed with code %d: %s' % (retcode, err))
+    def _ensure_branch(self, repo_name, branch, commit, flush=False):
+        # The branch update is queued in the broker unless flush is set
+        self.get_broker(repo_name).update_ref('refs/heads/%s' % branch, commit, flush)
 
     def _resolve_remote_rev(self, repo_name, repo_url, rev):
         # Resolve the rev (if it is a branch/tag) to a commit hash
@@ -478,48 +1069,263 @@ class GitSourceCache(object):
         return commit
 
     def _does_branch_exist(self, repo_name, branch):
-        retcode, out, err = self.git(repo_name,
-                                     'show-ref', '--verify', '--quiet', 'refs/heads/%s' % branch)
-        return retcode == 0
+        return self.get_broker(repo_name).get_ref('refs/heads/%s' % branch) is not None
 
-    def _mark_commit_as_in_use(self, repo_name, commit):
+    def _mark_commit_as_in_use(self, repo_name, commit, fetch_mode=None):
+        # The ref protects the commit from 'git gc'; it is queued, and
+        # applied at the end of fetch() and fetch_git(), before gc and on
+        # close. The index is only a hint verified on lookup, so it may be
+        # written first.
         self._ensure_branch(repo_name, 'inuse/%s' % commit, commit)
+        self._index_commit(repo_name, commit, fetch_mode)
+
+    #
+    # Commit index
+    #
+    # For each commit in use, git-index/<first 2 hex digits>/<remaining digits>
+    # contains a JSON document naming the bare repository holding it and
+    # how it was fetched (one of GIT_FETCH_MODES).
+    #
 
-    def fetch(self, url, type, commit, repo_name):
+    def _get_index_filename(self, commit):
+        return pjoin(self.index_path, commit[:2], commit[2:])
+
+    def _index_commit(self, repo_name, commit, fetch_mode=None):
+        """Records that `commit` is held by `repo_name`; returns the entry"""
+        filename = self._get_index_filename(commit)
+        old_entry = self._lookup_commit(commit)
+        if fetch_mode is None:
+            # keep what we knew, as long as the commit stays in the same repo
+            if old_entry is not None and old_entry['repo_name'] == repo_name:
+                fetch_mode = old_entry.get('fetch', 'full')
+            else:
+                fetch_mode = self._guess_fetch_mode(repo_name, commit)
+        entry = {'repo_name': repo_name, 'fetch': fetch_mode}
+        if old_entry == entry:
+            return entry
+        # dump to temporary file + atomic rename
+        dirname = os.path.dirname(filename)
+        silent_makedirs(dirname)
+        fd, temp_filename = tempfile.mkstemp(dir=dirname)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.rename(temp_filename, filename)
+        except:
+            silent_unlink(temp_filename)
+            raise
+        return entry
+
+    def _lookup_commit(self, commit):
+        """Returns the index entry of `commit`, or `None` if there is none
+        or the repository it names no longer has the commit
+        """
+        if len(commit) < 3:
+            return None
+        try:
+            with open(self._get_index_filename(commit)) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if not entry.get('repo_name') or not os.path.isdir(self.get_bare_repo_path(entry['repo_name'])):
+            return None
+        # The index is only a hint; e.g. the repository may have been
+        # garbage collected or replaced behind our back
+        if not self._has_commit(entry['repo_name'], commit):
+            return None
+        return entry
+
+    def _get_fetch_mode(self, commit):
+        entry = self._lookup_commit(commit)
+        return entry.get('fetch', 'full') if entry is not None else None
+
+    def _guess_fetch_mode(self, repo_name, commit):
+        # For commits not fetched by this version of HashDist
+        repo_path = self.get_bare_repo_path(repo_name)
+        try:
+            with open(pjoin(repo_path, 'shallow')) as f:
+                if commit in f.read().split():
+                    return 'shallow'
+        except IOError:
+            pass
+        if self.git(repo_name, 'config', 'extensions.partialClone')[0] == 0:
+            # A partial clone may still hold everything the commit needs,
+            # e.g. if it was fetched in full before the repo became partial
+            retcode, out, err = self.git(repo_name, 'rev-list', '--objects', '--missing=print',
+                                         commit)
+            if retcode != 0 or any(line.startswith('?') for line in out.splitlines()):
+                return 'partial'
+        return 'full'
+
+    def _find_commit(self, commit):
+        """Returns the index entry of `commit` (see :meth:`_lookup_commit`),
+        or `None` if no repo holds it
+        """
+        entry = self._lookup_commit(commit)
+        if entry is not None:
+            return entry
+        # Not indexed (e.g., a source cache from an older version of
+        # HashDist); search all repos and index the result
+        try:
+            repo_names = os.listdir(self.repo_path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            repo_names = []
+        for repo_name in repo_names:
+            if self._has_commit(repo_name, commit):
+                return self._index_commit(repo_name, commit)
+        return None
+
+    def _get_inuse_commits(self, repo_name):
+        self.get_broker(repo_name).flush()
+        out = self.checked_git(repo_name, 'for-each-ref', '--format=%(objectname)',
+                               'refs/heads/inuse/')
+        return out.split()
+
+    def list_entries(self):
+        """Returns ``(key, size, mtime, remove)`` for every commit in use; calling
+        `remove` drops the ``inuse/`` branch and index entry of the commit. The
+        size of a commit is estimated as its share of its repository.
+        """
+        entries = []
+        for repo_name in (sorted(os.listdir(self.repo_path)) if os.path.isdir(self.repo_path) else []):
+            commits = self._get_inuse_commits(repo_name)
+            size = _get_tree_size(self.get_bare_repo_path(repo_name))
+            for commit in commits:
+                def remove(repo_name=repo_name, commit=commit):
+                    self.get_broker(repo_name).update_ref('refs/heads/inuse/%s' % commit, None)
+                    silent_unlink(self._get_index_filename(commit))
+                    self._gc_repos.add(repo_name)
+                entries.append(('git:%s' % commit, size // len(commits),
+                                _get_mtime(self._get_index_filename(commit)), remove))
+        return entries
+
+    def finish_gc(self):
+        """Prunes the objects of removed commits; repositories left with no
+        commits in use are removed
+        """
+        for repo_name in sorted(self._gc_repos):
+            if self._get_inuse_commits(repo_name):
+                self.checked_git(repo_name, 'gc', '--prune=now', '--quiet')
+            else:
+                with self.brokers_lock:
+                    broker = self.brokers.pop(repo_name, None)
+                if broker is not None:
+                    broker.close()
+                shutil.rmtree(self.get_bare_repo_path(repo_name))
+        self._gc_repos = set()
+
+    def rebuild_index(self):
+        """Recreates the commit index from the ``inuse/*`` branches of all repos
+        """
+        if os.path.exists(self.index_path):
+            shutil.rmtree(self.index_path)
+        try:
+            repo_names = os.listdir(self.repo_path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            repo_names = []
+        count = 0
+        for repo_name in sorted(repo_names):
+            self.get_broker(repo_name).flush()
+            out = self.checked_git(repo_name, 'for-each-ref', '--format=%(objectname)',
+                                   'refs/heads/inuse/')
+            for commit in out.split():
+                self._index_commit(repo_name, commit)
+                count += 1
+        return count
+
+    def fetch(self, url, type, commit, repo_name, mode='full'):
         assert type == 'git'
         if repo_name is None:
             raise TypeError('Need to provide repo_name when fetching git archive')
-        retcode, out, err = self.git(repo_name, 'rev-list', '-n1', '--quiet', commit)
-        if retcode == 0:
-            self._mark_commit_as_in_use(repo_name, commit)
-        elif url is None:
-            raise SourceNotFoundError('git:%s not present and repo url not provided' % commit)
-        else:
+        repo = branch = None
+        if url is not None:
             terms = url.split(' ')
             if len(terms) == 1:
                 repo, = terms
-                branch = None
             elif len(terms) == 2:
                 repo, branch = terms
             else:
                 raise ValueError('Please specify git repository as "git://repo/url [branchname]"')
-            for mirror in self.local_mirrors:
-                try:
-                    self.logger.warning("trying local mirror git repository")
-                    self.logger.warning(pjoin(mirror,'git',repo_name))
-                    self.fetch_git(pjoin(mirror,'git',repo_name), branch, repo_name, commit)
-                    self.logger.warning("succeded local mirror git repository")
-                except:
-                    self.logger.warning("failed local mirror git repository")
-                    pass
-            self.fetch_git(repo, branch, repo_name, commit)
+
+        deepen = mode == 'full' and self._get_fetch_mode(commit) in ('shallow', 'commit')
+        if self._has_commit(repo_name, commit) and not deepen:
+            self._mark_commit_as_in_use(repo_name, commit)
+            self.get_broker(repo_name).flush()
+            return
+        try:
+            if not deepen and self._attach_local_mirrors(repo_name) and self._has_commit(repo_name, commit):
+                self.logger.info('Found git:%s in local mirror' % commit)
+                self._mark_commit_as_in_use(repo_name, commit)
+                self._fetch_submodules(repo_name, repo, commit, mode)
+                self.get_broker(repo_name).flush()
+            elif url is None:
+                raise SourceNotFoundError('git:%s not present and repo url not provided' % commit)
+            else:
+                self.fetch_git(repo, branch, repo_name, commit, mode)
+        finally:
+            self._detach_local_mirrors(repo_name)
+
+    def _attach_local_mirrors(self, repo_name):
+        """Makes the objects of the local mirrors of `repo_name` available
+        to the cache repo through git alternates, for the duration of a
+        fetch (see :meth:`_detach_local_mirrors`)
+
+        Returns whether any mirror repository was found.
+        """
+        mirror_dirs = [os.path.realpath(pjoin(mirror, GIT_DIRNAME, repo_name, 'objects'))
+                       for mirror in self.local_mirrors]
+        mirror_dirs = [d for d in mirror_dirs if os.path.isdir(d)]
+        if not mirror_dirs:
+            return False
+        self.get_repo_env(repo_name)  # creates the repo if needed
+        alternates_file = pjoin(self.get_bare_repo_path(repo_name), 'objects', 'info', 'alternates')
+        try:
+            with open(alternates_file) as f:
+                present = f.read().splitlines()
+        except IOError:
+            present = []
+        missing = [d for d in mirror_dirs if d not in present]
+        if missing:
+            silent_makedirs(os.path.dirname(alternates_file))
+            with open(alternates_file, 'a') as f:
+                for d in missing:
+                    self.logger.info('Using objects of local mirror %s' % d)
+                    f.write(d + '\n')
+            # alternates are only read on startup
+            self.get_broker(repo_name).restart()
+        return True
+
+    def _detach_local_mirrors(self, repo_name):
+        """Copies the objects the cache repo needs from the local mirrors
+        attached by :meth:`_attach_local_mirrors`, and stops using them
+
+        Otherwise the cache repo would break as soon as a mirror is
+        pruned, moved or unmounted.
+        """
+        alternates_file = pjoin(self.get_bare_repo_path(repo_name), 'objects', 'info', 'alternates')
+        if not os.path.exists(alternates_file):
+            return
+        # what is copied is what the refs (including in-use ones) reach
+        broker = self.get_broker(repo_name)
+        broker.flush()
+        retcode, out, err = self.git(repo_name, 'repack', '-a', '-d', '-q')
+        if retcode != 0:
+            self.logger.warning('Could not copy the objects of the local mirrors of %s, '
+                                'still using them:\n%s' % (repo_name, err))
+            return
+        os.unlink(alternates_file)
+        broker.restart()
 
     def _has_commit(self, repo_name, commit):
-        # Assert that the commit is indeed present and is a commit hash and not a revspec
-        retcode, out, err = self.git(repo_name, 'rev-list', '-n1', '--quiet', commit)
-        return retcode == 0
+        return self.get_broker(repo_name).has_commit(commit)
 
-    def fetch_git(self, repo_url, rev, repo_name, commit=None):
+    def fetch_git(self, repo_url, rev, repo_name, commit=None, mode='full'):
+        if mode not in GIT_FETCH_MODES:
+            raise ValueError('Unknown git fetch mode: %s' % mode)
         if commit is None and rev is None:
             raise ValueError('Either a commit or a branch/rev must be specified')
         elif commit is None:
@@ -528,8 +1334,29 @@ class GitSourceCache(object):
             # same repo
             commit = self._resolve_remote_rev(repo_name, repo_url, rev)
 
+        if mode == 'full':
+            self._fetch_full(repo_name, repo_url, rev)
+        else:
+            self._fetch_limited(repo_name, repo_url, rev, commit, mode)
+
+        if not self._has_commit(repo_name, commit):
+            raise SourceNotFoundError('Repository "%s" did not contain commit "%s"' %
+                                      (repo_url, commit))
+
+
+        self._mark_commit_as_in_use(repo_name, commit, mode)  # Create a branch so that 'git gc' doesn't collect it
+        self._fetch_submodules(repo_name, repo_url, commit, mode)
+        self.get_broker(repo_name).flush()
+
+        return 'git:%s' % commit
+
+    def _fetch_full(self, repo_name, repo_url, rev):
+        args = ['fetch']
+        if os.path.exists(pjoin(self.get_bare_repo_path(repo_name), 'shallow')):
+            # an earlier shallow fetch cut off history
+            args.append('--unshallow')
         if rev is not None:
-            self.checked_git(repo_name, 'fetch', repo_url, rev)
+            self.checked_git(repo_name, *(args + [repo_url, rev]))
 
         else:
             # when rev is None, fetch all the remote heads; seems like one must
@@ -538,44 +1365,88 @@ class GitSourceCache(object):
             heads = [line.split()[1] for line in out.splitlines() if line.strip()]
             # Fix for https://github.com/hashdist/python-hpcmp2/issues/57
             heads = [x for x in heads if not x.endswith("^{}")]
-            self.checked_git(repo_name, 'fetch', repo_url, *heads)
-
-        if not self._has_commit(repo_name, commit):
-            raise SourceNotFoundError('Repository "%s" did not contain commit "%s"' %
-                                      (repo_url, commit))
-
-
-        self._mark_commit_as_in_use(repo_name, commit)  # Create a branch so that 'git gc' doesn't collect it
-        self._fetch_submodules(repo_name, repo_url, commit)
+            self.checked_git(repo_name, *(args + [repo_url] + heads))
 
-        return 'git:%s' % commit
+    def _fetch_limited(self, repo_name, repo_url, rev, commit, mode):
+        if mode == 'partial':
+            args = ['fetch', '--filter=blob:none', self._ensure_promisor_remote(repo_name, repo_url)]
+        else:
+            args = ['fetch', '--depth=1', repo_url]
+        # The rev may have moved on since the commit was recorded, so
+        # fall back to asking for the commit by hash (or the other
+        # way around if the server may not allow that)
+        if mode == 'commit' or rev is None:
+            refs = [commit, rev]
+        else:
+            refs = [rev, commit]
+        err = None
+        for ref in refs:
+            if ref is None:
+                continue
+            retcode, out, err = self.git(repo_name, *(args + [ref]))
+            if retcode == 0 and self._has_commit(repo_name, commit):
+                return
+        if err:
+            msg = 'git fetch (%s) of %s from %s failed:\n%s' % (mode, commit, repo_url, err)
+            self.logger.error(msg)
+            raise RemoteFetchError(msg)
 
-    def unpack(self, type, hash, target_path):
+    def _ensure_promisor_remote(self, repo_name, repo_url):
+        """Configures `repo_url` as a remote that missing blobs of a partial
+        clone may be fetched from on demand, and returns the remote name
+        """
+        remote = 'promisor-%s' % hashlib.sha1(repo_url).hexdigest()[:12]
+        if self.git(repo_name, 'config', 'remote.%s.url' % remote)[0] != 0:
+            # extensions are only honoured with repository format version 1
+            self.checked_git(repo_name, 'config', 'core.repositoryformatversion', '1')
+            self.checked_git(repo_name, 'config', 'remote.%s.url' % remote, repo_url)
+            self.checked_git(repo_name, 'config', 'remote.%s.promisor' % remote, 'true')
+            self.checked_git(repo_name, 'config', 'remote.%s.partialclonefilter' % remote, 'blob:none')
+            if self.git(repo_name, 'config', 'extensions.partialClone')[0] != 0:
+                self.checked_git(repo_name, 'config', 'extensions.partialClone', remote)
+        return remote
+
+    def unpack(self, type, hash, target_path, checkout='clone'):
         assert type == 'git'
+        if checkout not in GIT_CHECKOUT_MODES:
+            raise ValueError('Unknown git checkout mode: %s' % checkout)
 
-        # We don't want to require supplying a repo name, so for now
-        # we simply iterate through all git repos
-        try:
-            repo_names = os.listdir(self.repo_path)
-        except OSError, e:
-            if e.errno != errno.ENOENT:
-                raise
-            repo_names = []
-        for repo_name in repo_names:
-            retcode, out, err = self.git(repo_name, 'rev-list', '-n1', '--quiet', hash)
-            if retcode == 0:
-                break
-        else:
+        # We don't want to require supplying a repo name, so look up
+        # the repo holding the commit in the index
+        entry = self._find_commit(hash)
+        if entry is None:
             raise KeyNotFoundError('Source item not present: git:%s' % hash)
+        repo_name = entry['repo_name']
+        fetch_mode = entry.get('fetch', 'full')
+        if fetch_mode == 'partial' and checkout != 'archive':
+            # Missing blobs can only be fetched on demand by the cache
+            # repo itself, so we can't make a repository out of it
+            self.logger.info('git:%s was fetched partially, unpacking it with git archive' % hash)
+            checkout = 'archive'
+
+        if checkout == 'archive':
+            self._unpack_archive(repo_name, hash, target_path)
+            return
 
-        # We clone the repo with 'git clone --shared' and check out the hash
         repo_path = self.get_bare_repo_path(repo_name)
-
-        with self._marked_commit(repo_name, hash) as branch:
+        if checkout == 'shared':
+            # Borrow the objects of the source cache repo rather than
+            # copying them; the inuse/* branch keeps them from being
+            # garbage collected
             with working_directory(target_path):
                 self.checked_git(None, 'init')
-                self.checked_git(None, 'fetch', repo_path, branch)
+                with open(pjoin('.git', 'objects', 'info', 'alternates'), 'w') as f:
+                    f.write(pjoin(repo_path, 'objects') + '\n')
+                if os.path.exists(pjoin(repo_path, 'shallow')):
+                    # history is cut off in the same place
+                    shutil.copy(pjoin(repo_path, 'shallow'), pjoin('.git', 'shallow'))
                 self.checked_git(None, 'checkout', hash)
+        else:
+            with self._marked_commit(repo_name, hash) as branch:
+                with working_directory(target_path):
+                    self.checked_git(None, 'init')
+                    self.checked_git(None, 'fetch', repo_path, branch)
+                    self.checked_git(None, 'checkout', hash)
 
         # Check out any submodules:
         # a) Pare .gitmodules
@@ -586,7 +1457,33 @@ class GitSourceCache(object):
                 submodules = self._parse_submodule_config(repo_name, '.gitmodules')
                 for key, submod in submodules.items():
                     self.checked_git(None, 'config', 'submodule.%s.url' % key, self.get_bare_repo_path(submod['name']))
-                self.checked_git(None, 'submodule', 'update', '--init')
+                # the submodule URLs are our own repos, which git >= 2.38.1
+                # refuses to clone from by default
+                self.checked_git(None, '-c', 'protocol.file.allow=always', 'submodule', 'update', '--init',
+                                 '--jobs', str(self.jobs))
+
+    def _unpack_archive(self, repo_name, commit, target_path):
+        """Streams the tree of `commit` into `target_path` with ``git archive``,
+        recursing into submodules"""
+        self.logger.info('running: git archive %s | tar -x -C %s' % (commit, target_path))
+        archive = subprocess.Popen(['git', 'archive', '--format=tar', commit],
+                                   env=self.get_repo_env(repo_name),
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        tar = subprocess.Popen(['tar', '-x', '-f', '-', '-C', target_path],
+                               stdin=archive.stdout, stderr=subprocess.PIPE)
+        archive.stdout.close()  # so that git gets SIGPIPE if tar exits
+        tar_err = tar.communicate()[1]
+        archive_err = archive.stderr.read()
+        if archive.wait() != 0 or tar.returncode != 0:
+            msg = 'git archive of %s failed:\n%s%s' % (commit, archive_err, tar_err)
+            self.logger.error(msg)
+            raise RuntimeError(msg)
+        def unpack_submodule(item):
+            submod, commit_hash = item
+            submod_path = pjoin(target_path, submod['path'])
+            silent_makedirs(submod_path)
+            self._unpack_archive(submod['name'], commit_hash, submod_path)
+        self._map_jobs(unpack_submodule, self._get_submodules(repo_name, commit))
 
     #
     # Submodule support
@@ -624,12 +1521,16 @@ class GitSourceCache(object):
             submod['name'] = root_repo_name + '.' + submod['path'].replace('/', '.').replace('\\', '.')
         return submodules
 
-    def _fetch_submodules(self, repo_name, repo_url, commit):
+    def _get_submodules(self, repo_name, commit):
+        """Returns a list of ``(submod, commit_hash)`` for the submodules
+        of `commit` in the bare repo, where `submod` is as returned
+        by :meth:`_parse_submodule_config`
+        """
         # use 'git show' to extract .gitmodules from the right commit
         retcode, out, err = self.git(repo_name, 'show', '%s:.gitmodules' % commit)
         if retcode != 0:
             # No .gitmodules found
-            return
+            return []
         # the 'git config' tool needs to read the input from a file though...
         temp_dir = tempfile.mkdtemp()
         try:
@@ -640,19 +1541,60 @@ class GitSourceCache(object):
         finally:
             shutil.rmtree(temp_dir)
 
-        # Recursively fetch the submodules. We need to look up the
-        # commit using 'git ls-tree', since 'git submodule status'
-        # doesn't work on bare repositories.
+        # We need to look up the commit using 'git ls-tree', since
+        # 'git submodule status' doesn't work on bare repositories.
+        result = []
         for submod in submodules.values():
             out = self.checked_git(repo_name, 'ls-tree', commit, submod['path'])
             mode, type, commit_hash, file = out.split()
             if type != 'commit':
-                msg = 'Expected a submodule, not a %s at %s' (type, submod['path'])
+                msg = 'Expected a submodule, not a %s at %s' % (type, submod['path'])
                 self.logger.error(msg)
                 raise RuntimeError(msg)
+            result.append((submod, commit_hash))
+        return result
+
+    def _fetch_submodules(self, repo_name, repo_url, commit, mode='full'):
+        # Recursively fetch the submodules; each into its own repo, so
+        # they can be fetched concurrently
+        def fetch_submodule(item):
+            submod, commit_hash = item
             # safely turn relative URLs into absolute URLs (idempotent on absolute URLs)
-            absolute_submod_url = urlparse.urljoin(repo_url+'/', submod['url'])
-            self.fetch_git(absolute_submod_url, rev=None, repo_name=submod['name'], commit=commit_hash)
+            if repo_url is not None:
+                absolute_submod_url = urlparse.urljoin(repo_url+'/', submod['url'])
+            else:
+                absolute_submod_url = None
+            self.fetch(absolute_submod_url, 'git', commit_hash, submod['name'], mode)
+        self._map_jobs(fetch_submodule, self._get_submodules(repo_name, commit))
+
+    _in_job = threading.local()
+
+    def _map_jobs(self, func, items):
+        """Calls `func` on each of `items` using up to ``git_jobs`` threads
+
+        Calls made from within a job run serially, so that nested
+        submodules do not multiply the number of threads.
+        """
+        if self.jobs <= 1 or len(items) <= 1 or getattr(self._in_job, 'active', False):
+            for item in items:
+                func(item)
+            return
+
+        def job(item):
+            self._in_job.active = True
+            try:
+                func(item)
+            finally:
+                self._in_job.active = False
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(self.jobs, len(items)))
+        try:
+            # map re-raises the first exception raised by a job
+            pool.map(job, items)
+        finally:
+            pool.close()
+            pool.join()
 
 
 SIMPLE_FILE_URL_RE = re.compile(r'^file:/?[^/]+.*$')
@@ -671,17 +1613,88 @@ class ArchiveSourceCache(object):
         self.packs_path = source_cache._ensure_subdir(PACKS_DIRNAME)
         self.local_mirrors = source_cache.local_mirrors
         self.mirrors = source_cache.mirrors
+        self.mirror_ranking = source_cache.mirror_ranking
+        self.mirror_race = source_cache.mirror_race
+        self.shadow_packs = source_cache.shadow_packs
+        self.external_decompress = source_cache.external_decompress
         self.logger = self.source_cache.logger
 
+    def _create_handler(self, type):
+        return create_archive_handler(type, self.logger, self.external_decompress)
+
     def get_pack_filename(self, type, hash):
-        d = self.files_path if type == 'files' else self.packs_path
-        type_dir = pjoin(d, type)
-        mkdir_if_not_exists(type_dir)
+        """Returns where to store the given pack, creating its directory
+        """
+        if type == 'files':
+            type_dir = pjoin(self.files_path, type)
+        else:
+            type_dir = pjoin(self.packs_path, type, hash[:SHARD_LEN])
+        silent_makedirs(type_dir)
         return pjoin(type_dir, hash)
 
-    def _download_and_hash(self, url, type):
+    def _get_pack_candidates(self, type, hash):
+        if type == 'files':
+            return [pjoin(self.files_path, type, hash)]
+        return get_pack_candidates(self.packs_path, type, hash)
+
+    def find_pack_filename(self, type, hash):
+        """Returns the filename of the given pack in either layout, or `None`
+        """
+        for filename in self._get_pack_candidates(type, hash):
+            if os.path.exists(filename):
+                return filename
+        return None
+
+    def migrate_layout(self):
+        """Moves packs from the flat ``packs/<type>/<hash>`` layout to the
+        sharded one; safe to run while the cache is in use. Returns the
+        number of packs moved.
+        """
+        count = 0
+        for type in os.listdir(self.packs_path):
+            if type not in archive_types:
+                continue
+            type_dir = pjoin(self.packs_path, type)
+            for hash in os.listdir(type_dir):
+                if len(hash) <= SHARD_LEN or '.' in hash:
+                    continue  # shard directory or temporary file
+                legacy = pjoin(type_dir, hash)
+                target = self.get_pack_filename(type, hash)
+                if os.path.exists(target):
+                    silent_unlink(legacy)
+                else:
+                    try:
+                        os.rename(legacy, target)
+                    except OSError, e:
+                        if e.errno != errno.ENOENT:
+                            raise
+                        continue  # moved by a concurrent migration
+                count += 1
+        return count
+
+    def _get_partial_filename(self, url, type, expected_hash):
+        # Partial downloads are named by the key they are expected to
+        # produce, so that an interrupted download can be resumed from
+        # any mirror; when the key is unknown we fall back to the URL
+        if expected_hash is None:
+            name = 'url-%s' % format_digest(hashlib.sha256(url))
+        else:
+            name = '%s-%s' % (type, expected_hash)
+        return pjoin(self.source_cache._ensure_subdir(pjoin(PACKS_DIRNAME, PARTIAL_DIRNAME)), name)
+
+    def _download_and_hash(self, url, type, expected_hash=None, mirror=None, opened=None):
         """Downloads file at url to a temporary location and hashes it
 
+        Remote downloads are written to a partial file named after
+        `expected_hash` (or the URL if it is not known). If the download
+        is interrupted the partial file is kept, and the next attempt
+        resumes it using an HTTP range request. The partial file is
+        locked while downloading (see :func:`locked_partial_file`).
+
+        If `mirror` is given, the transfer rate (or a connection
+        failure) is recorded for it in the mirror ranking. `opened` is
+        an already opened response to use, see :func:`download_resumable`.
+
         Returns
         -------
 
@@ -689,63 +1702,70 @@ class ArchiveSourceCache(object):
         """
         # Provide a special case for local files
         use_urllib = not SIMPLE_FILE_URL_RE.match(url)
-        if not use_urllib:
+        if use_urllib:
+            partial_path = self._get_partial_filename(url, type, expected_hash)
+            self.logger.info("Downloading '%s'" % url)
+            t0 = clock()
+            with locked_partial_file(partial_path) as download_path:
+                try:
+                    hasher, transferred = download_resumable(url, download_path, self.logger,
+                                                             self.chunk_size, opened)
+                except urllib2.HTTPError, e:
+                    msg = "urllib failed to download (code: %d): %s" % (e.code, url)
+                    self.logger.info(msg)
+                    raise RemoteFetchError(msg)
+                except urllib2.URLError, e:
+                    if mirror is not None:
+                        self.mirror_ranking.record_failure(mirror)
+                    msg = "urllib failed to download (reason: %s): %s" % (e.reason, url)
+                    self.logger.info(msg)
+                    raise RemoteFetchError(msg)
+                except (IOError, httplib.HTTPException) as e:
+                    # Keep the partial file around so that a retry can resume it
+                    msg = "Unhandled Exception in Download: %s" % e
+                    self.logger.error(msg)
+                    raise RemoteFetchError(msg)
+                # Move the complete file out of the way while still holding the lock
+                temp_fd, temp_path = tempfile.mkstemp(prefix='downloading-', dir=self.packs_path)
+                os.close(temp_fd)
+                os.rename(download_path, temp_path)
+            if mirror is not None:
+                self.mirror_ranking.record_success(mirror, transferred, clock() - t0)
+        else:
             try:
                 stream = open(url[len('file:'):])
             except IOError as e:
                 raise SourceNotFoundError(str(e))
-        else:
-            # Make request.
-            try:
-                stream = urllib2.urlopen(url)
-            except urllib2.HTTPError, e:
-                msg = "urllib failed to download (code: %d): %s" % (e.code, url)
-                self.logger.info(msg)
-                raise RemoteFetchError(msg)
-            except urllib2.URLError, e:
-                msg = "urllib failed to download (reason: %s): %s" % (e.reason, url)
-                self.logger.info(msg)
-                raise RemoteFetchError(msg)
 
-        # Download file to a temporary file within self.packs_path, while hashing
-        # it.
-        self.logger.info("Downloading '%s'" % url)
-        temp_fd, temp_path = tempfile.mkstemp(prefix='downloading-', dir=self.packs_path)
-        try:
-            f = os.fdopen(temp_fd, 'wb')
-            tee = HashingWriteStream(hashlib.sha256(), f)
-            if use_urllib:
-                if self.logger.level > logging.DEBUG:
-                    if 'Content-Length' in stream.headers:
-                        progress = ProgressBar(int(stream.headers["Content-Length"]),logger=self.logger)
-                    else:
-                        progress = ProgressSpinner(logger=self.logger)
+            # Copy file to a temporary file within self.packs_path, while hashing
+            # it.
+            self.logger.info("Downloading '%s'" % url)
+            temp_fd, temp_path = tempfile.mkstemp(prefix='downloading-', dir=self.packs_path)
             try:
-                n = 0
-                while True:
-                    chunk = stream.read(self.chunk_size)
-                    if not chunk: break
-                    if use_urllib:
-                        n += len(chunk)
-                        progress.update(n)
-                    tee.write(chunk)
-            finally:
-                stream.close()
-                f.close()
-                if use_urllib:
-                    progress.finish()
-        except Exception as e:
-            # Remove temporary file if there was a failure
-            os.unlink(temp_path)
-            msg = "Unhandled Exception in Download: %s" % e
-            self.logger.error(msg)
-            raise RemoteFetchError(msg)
+                f = os.fdopen(temp_fd, 'wb')
+                hasher = hashlib.sha256()
+                tee = HashingWriteStream(hasher, f)
+                try:
+                    while True:
+                        chunk = stream.read(self.chunk_size)
+                        if not chunk: break
+                        tee.write(chunk)
+                finally:
+                    stream.close()
+                    f.close()
+            except Exception as e:
+                # Remove temporary file if there was a failure
+                os.unlink(temp_path)
+                msg = "Unhandled Exception in Download: %s" % e
+                self.logger.error(msg)
+                raise RemoteFetchError(msg)
 
-        if not create_archive_handler(type, self.logger).verify(temp_path):
+        if not self._create_handler(type).verify(temp_path):
+            silent_unlink(temp_path)
             self.logger.error("File downloaded from '%s' is not a valid archive" % url)
             raise SourceNotFoundError("File downloaded from '%s' is not a valid archive" % url)
 
-        return temp_path, format_digest(tee)
+        return temp_path, format_digest(hasher)
 
     def _ensure_type(self, url, type):
         if type is not None:
@@ -759,14 +1779,29 @@ class ArchiveSourceCache(object):
             raise ValueError('Unable to guess archive type of "%s"' % url)
 
     def contains(self, type, hash):
-        return os.path.exists(self.get_pack_filename(type, hash))
+        if self.find_pack_filename(type, hash) is not None:
+            return True
+        return type == 'files' and hash in self.source_cache.get_segment_store()
 
     def fetch_from_local_mirrors(self, type, hash):
         for mirror in self.local_mirrors:
-            local_pack = '%s/%s/%s/%s' % (mirror, PACKS_DIRNAME, type, hash)
+            for local_pack in get_pack_candidates(pjoin(mirror, PACKS_DIRNAME), type, hash):
+                if os.path.exists(local_pack):
+                    break
+            else:
+                msg = "Could not fetch source from local mirror, continuing"
+                self.logger.debug(msg)
+                continue
+            # Packs are read-only, so hard-linking them is safe; copy to a
+            # temporary name first so a partial copy is never mistaken for
+            # a pack
+            target = self.get_pack_filename(type, hash)
+            temp_path = '%s.copying-%d' % (target, os.getpid())
             try:
-                shutil.copy(local_pack,self.get_pack_filename(type, hash))
-            except SourceNotFoundError:
+                copy_file(local_pack, temp_path, allow_hardlink=True)
+                os.rename(temp_path, target)
+            except (IOError, OSError):
+                silent_unlink(temp_path)
                 msg = "Could not fetch source from local mirror, continuing"
                 self.logger.debug(msg)
                 continue
@@ -778,11 +1813,42 @@ class ArchiveSourceCache(object):
         self.logger.debug(msg)
         return False
 
+    def _race_mirrors(self, mirrors, type, hash):
+        """Sends the first request to the top ``mirror_race`` mirrors at once
+
+        Returns the mirror that responded first and its opened response
+        (see :func:`open_url`), or ``(None, None)``.
+        """
+        candidates = [mirror for mirror in mirrors
+                      if not SIMPLE_FILE_URL_RE.match(mirror)][:self.mirror_race]
+        if len(candidates) < 2:
+            return None, None
+        partial_path = self._get_partial_filename(None, type, hash)
+        offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+        openers = [lambda mirror=mirror: open_url('%s/%s/%s/%s' % (mirror, PACKS_DIRNAME, type, hash), offset)
+                   for mirror in candidates]
+        i, opened, failures = race(openers, close=lambda opened: opened[0].close())
+        for j, e in failures:
+            if isinstance(e, urllib2.URLError) and not isinstance(e, urllib2.HTTPError):
+                self.mirror_ranking.record_failure(candidates[j])
+        if i is None:
+            return None, None
+        self.logger.debug("Mirror %s responded first" % candidates[i])
+        return candidates[i], opened
+
     def fetch_from_mirrors(self, type, hash):
-        for mirror in self.mirrors:
+        mirrors = self.mirror_ranking.order(self.mirrors)
+        winner, opened = None, None
+        if self.mirror_race > 1:
+            winner, opened = self._race_mirrors(mirrors, type, hash)
+            if winner is not None:
+                mirrors.remove(winner)
+                mirrors.insert(0, winner)
+        for mirror in mirrors:
             url = '%s/%s/%s/%s' % (mirror, PACKS_DIRNAME, type, hash)
             try:
-                self._download_archive(url, type, hash)
+                self._download_archive(url, type, hash, mirror=mirror,
+                                       opened=opened if mirror == winner else None)
             except SourceNotFoundError:
                 msg = "Could not fetch source from remote mirror, continuing"
                 self.logger.debug(msg)
@@ -816,9 +1882,9 @@ class ArchiveSourceCache(object):
                 return '%s:%s' % (type, expected_hash)
         return self._download_archive(url, type, expected_hash)
 
-    def _download_archive(self, url, type, expected_hash):
+    def _download_archive(self, url, type, expected_hash, mirror=None, opened=None):
         type = self._ensure_type(url, type)
-        temp_file, hash = self._download_and_hash(url, type)
+        temp_file, hash = self._download_and_hash(url, type, expected_hash, mirror, opened)
         try:
             if expected_hash is not None and expected_hash != hash:
                 raise RuntimeError('File downloaded from "%s" has hash %s but expected %s' %
@@ -835,34 +1901,175 @@ class ArchiveSourceCache(object):
     def put(self, files):
         if isinstance(files, dict):
             files = files.items()
-        key = hit_pack(files)
+        # pack and hash in a single pass
+        buf = StringIO()
+        key = hit_pack(files, buf)
         type, hash = key.split(':')
-        pack_filename = self.get_pack_filename(type, hash)
-        if not os.path.exists(pack_filename):
-            with file(pack_filename, 'w') as f:
-                hit_pack(files, f)
+        if self.contains(type, hash):
+            return key
+        data = buf.getvalue()
+        if len(data) < MAX_SEGMENT_PACK_SIZE:
+            self.source_cache.get_segment_store().put(hash, data)
+        else:
+            pack_filename = self.get_pack_filename(type, hash)
+            fd, temp_file = tempfile.mkstemp(prefix='putting-', dir=os.path.dirname(pack_filename))
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(data)
+                os.rename(temp_file, pack_filename)
+            except:
+                silent_unlink(temp_file)
+                raise
         return key
 
     def unpack(self, type, hash, target_dir):
-        infile = self.open_file(type, hash)
-        with infile:
-            if type == 'files':
+        if type == 'files':
+            with self.open_file(type, hash) as infile:
                 files = hit_unpack(infile, 'files:%s' % hash)
-                scatter_files(files, target_dir)
-            else:
-                try:
-                    create_archive_handler(type, self.logger).unpack(infile, target_dir, hash)
-                except SourceCacheError, e:
-                    self.logger.error(str(e))
-                    raise
+            scatter_files(files, target_dir)
+            return
+        handler = self._create_handler(type)
+        shadow = self.shadow_packs is not None and can_shadow(handler)
+        if shadow and self._unpack_shadow(handler, type, hash, target_dir):
+            return
+        with self.open_file(type, hash) as infile:
+            try:
+                handler.unpack(infile, target_dir, hash)
+            except SourceCacheError, e:
+                self.logger.error(str(e))
+                raise
+        if shadow:
+            self.source_cache.run_in_background(lambda: self._make_shadow_quietly(type, hash))
 
-    def open_file(self, type, hash):
+    #
+    # Shadow copies
+    #
+    # Decompressing a tar.bz2 or tar.xz on each unpack may take longer
+    # than building the package. Optionally, an uncompressed copy is
+    # stored as packs/shadow/<type>/<xx>/<hash>.tar once a pack has
+    # been unpacked, together with its own SHA-256 in <hash>.tar.sha256
+    # (the key of the pack only covers the compressed data).
+
+    def list_entries(self):
+        """Returns ``(key, size, mtime, remove)`` for every pack; calling
+        `remove` removes the pack (see :meth:`SourceCache.gc`)
+        """
+        entries = []
+        for type in archive_types:
+            for hash, filename in iter_pack_files(self.packs_path, type):
+                shadow = self.get_shadow_filename(type, hash)
+                size = _get_size(filename) + _get_size(shadow)
+                def remove(filename=filename, shadow=shadow):
+                    silent_unlink(shadow + '.sha256')
+                    silent_unlink(shadow)
+                    silent_unlink(filename)
+                entries.append(('%s:%s' % (type, hash), size, _get_mtime(filename), remove))
+        files_dir = pjoin(self.files_path, 'files')
+        for hash in (os.listdir(files_dir) if os.path.isdir(files_dir) else []):
+            filename = pjoin(files_dir, hash)
+            if '-' in hash or '.' in hash or not os.path.isfile(filename):
+                continue  # segment store or temporary file
+            entries.append(('files:%s' % hash, _get_size(filename), _get_mtime(filename),
+                            lambda filename=filename: silent_unlink(filename)))
+        segment_store = self.source_cache.get_segment_store()
+        mtime = _get_mtime(pjoin(segment_store.path, 'index'))
+        for hash, size in segment_store.sizes().items():
+            entries.append(('files:%s' % hash, size, mtime,
+                            lambda hash=hash: segment_store.remove(hash)))
+        return entries
+
+    def finish_gc(self):
+        self.source_cache.get_segment_store().compact()
+
+    def get_shadow_filename(self, type, hash):
+        return pjoin(self.packs_path, SHADOW_DIRNAME, type, hash[:SHARD_LEN],
+                     '%s.%s' % (hash, self.shadow_packs or SHADOW_FORMATS[0]))
+
+    def _unpack_shadow(self, handler, type, hash, target_dir):
+        filename = self.get_shadow_filename(type, hash)
         try:
-            f = file(self.get_pack_filename(type, hash))
+            with file(filename + '.sha256') as f:
+                shadow_hash = f.read().strip()
+            f = open(filename, 'rb')
         except IOError, e:
-            if e.errno == errno.ENOENT:
-                raise KeyNotFoundError("%s:%s" % (type, hash))
-        return f
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        import tarfile
+        # Hash the shadow copy while extracting it, so that it is read once
+        stream = HashingReadStream(hashlib.sha256(), f)
+        def check():
+            # the end of the archive may be padded beyond what tarfile reads
+            while stream.read(self.chunk_size):
+                pass
+            if format_digest(stream) != shadow_hash:
+                raise CorruptSourceCacheError('Corrupt shadow copy of %s:%s' % (type, hash))
+        with f:
+            try:
+                handler.extract(stream, target_dir, 'r|', check)
+            except (CorruptSourceCacheError, tarfile.TarError):
+                # extract() left target_dir alone; unpack the pack instead
+                self.logger.warning('Removing corrupt shadow copy of %s:%s' % (type, hash))
+                silent_unlink(filename + '.sha256')
+                silent_unlink(filename)
+                return False
+        return True
+
+    def make_shadow(self, type, hash):
+        """Creates the shadow copy of a pack; returns `False` if it already exists
+        """
+        handler = self._create_handler(type)
+        if not can_shadow(handler):
+            raise ValueError('Cannot make shadow copies of %s packs' % type)
+        filename = self.get_shadow_filename(type, hash)
+        if os.path.exists(filename + '.sha256'):
+            return False
+        shadow_dir = os.path.dirname(filename)
+        silent_makedirs(shadow_dir)
+        fd, temp_file = tempfile.mkstemp(prefix='shadowing-', dir=shadow_dir)
+        fd2, temp_hash_file = tempfile.mkstemp(prefix='shadowing-', dir=shadow_dir)
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                tee = HashingWriteStream(hashlib.sha256(), outfile)
+                with self.open_file(type, hash) as infile:
+                    pack_hasher = handler.decompress_to(infile, tee)
+            if format_digest(pack_hasher) != hash:
+                raise CorruptSourceCacheError("Corrupted file: '%s:%s'" % (type, hash))
+            with os.fdopen(fd2, 'w') as f:
+                f.write(format_digest(tee) + '\n')
+            for x in (temp_file, temp_hash_file):
+                os.chmod(x, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            # the digest file marks the shadow copy as complete
+            os.rename(temp_file, filename)
+            os.rename(temp_hash_file, filename + '.sha256')
+        finally:
+            silent_unlink(temp_file)
+            silent_unlink(temp_hash_file)
+        return True
+
+    def _make_shadow_quietly(self, type, hash):
+        try:
+            self.make_shadow(type, hash)
+        except Exception, e:
+            # the shadow copy is a convenience only
+            self.logger.warning('Could not make shadow copy of %s:%s: %s' % (type, hash, e))
+
+    def open_file(self, type, hash):
+        candidates = self._get_pack_candidates(type, hash)
+        # look in the sharded layout again last, in case the pack was
+        # migrated between the first two attempts
+        for filename in candidates + candidates[:1]:
+            try:
+                return file(filename)
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        data = None
+        if type == 'files':
+            data = self.source_cache.get_segment_store().get(hash)
+        if data is None:
+            raise KeyNotFoundError("%s:%s" % (type, hash))
+        return BytesIO(data)
 
     #
     # hit packs
@@ -895,14 +2102,62 @@ def common_path_prefix(paths):
     else:
         return sep.join(common_prefix) + sep
 
+# Programs decompressing to stdout, preferred in this order; the
+# parallel ones come first
+EXTERNAL_DECOMPRESSORS = {
+    'tar.gz': [['pigz', '-dc']],
+    'tar.bz2': [['lbzip2', '-dc'], ['pbzip2', '-dc']],
+    'tar.xz': [['xz', '-dc', '-T0']],
+    'tar.zst': [['zstd', '-dc', '-T0']],
+    }
+
+def find_external_decompressor(type):
+    """Returns the command line of a program on PATH able to decompress
+    tarballs of the given type, or `None`
+    """
+    path = os.environ.get('PATH', '').split(os.pathsep)
+    for cmd in EXTERNAL_DECOMPRESSORS.get(type, []):
+        for d in path:
+            exe = pjoin(d, cmd[0])
+            if os.path.isfile(exe) and os.access(exe, os.X_OK):
+                return [exe] + cmd[1:]
+    return None
+
+
 class TarballHandler(object):
+    """
+    Unpacks tarballs
+
+    If `external_decompress` is set, and a program for the compression
+    format is found on PATH (see :data:`EXTERNAL_DECOMPRESSORS`), it is
+    used for decompressing instead of doing it in-process. Either way
+    the hash is verified on the compressed data before unpacking.
+    """
     chunk_size = 16 * 1024
 
-    def __init__(self, logger):
+    def __init__(self, logger, external_decompress=False):
         self.logger = logger
+        self.decompress_command = None
+        if external_decompress or self.make_decompressor() is None:
+            self.decompress_command = find_external_decompressor(self.type)
 
     def verify(self, filename):
         import tarfile
+        if self.decompress_command is not None:
+            with open(filename, 'rb') as f:
+                p, wait = self._run_decompressor(f, hashlib.sha256())
+                try:
+                    with closing(tarfile.open(fileobj=p.stdout, mode='r|')) as archive:
+                        for member in archive:
+                            pass
+                    ok = True
+                except tarfile.ReadError:
+                    ok = False
+                try:
+                    wait()
+                except CorruptSourceCacheError:
+                    ok = False
+            return ok
         try:
             with closing(self.tarfileobj_from_name(filename)) as tarfileobj:
                 with closing(tarfile.open(fileobj=tarfileobj, mode=self.read_mode)) as archive:
@@ -913,35 +2168,174 @@ class TarballHandler(object):
             return False
 
     def unpack(self, infile, target_dir, hash):
-        import tarfile
-        target_dir = os.path.abspath(target_dir)
-
+        if self.decompress_command is not None:
+            import tarfile
+            # Stream the pack through the decompressor into tarfile,
+            # checking the hash once it has been read completely
+            hasher = hashlib.sha256()
+            p, wait = self._run_decompressor(infile, hasher)
+            def check():
+                wait()
+                if format_digest(hasher) != hash:
+                    raise CorruptSourceCacheError("Corrupted file: '%s'" % infile.name)
+            try:
+                self.extract(p.stdout, target_dir, 'r|', check)
+            except tarfile.TarError:
+                check()  # report a corrupt pack as such
+                raise
+            finally:
+                wait(abort=True)
+            return
         archive_data = infile.read()
         if format_digest(hashlib.sha256(archive_data)) != hash:
             raise CorruptSourceCacheError("Corrupted file: '%s'" % infile.name)
-
         with closing(self.tarfileobj_from_data(archive_data)) as tarfileobj:
-            with closing(tarfile.open(fileobj=tarfileobj, mode=self.read_mode)) as archive:
-                members = archive.getmembers()
-                prefix_len = len(common_path_prefix([member.name for member in members
-                                                     if member.type != tarfile.DIRTYPE]))
-                filtered_members = []
-                for member in members:
-                    if len(member.name) <= prefix_len:
-                        continue
+            self.extract(tarfileobj, target_dir, self.read_mode)
+
+    def extract(self, tarfileobj, target_dir, mode='r|', check=None):
+        """Extracts the tarball in `tarfileobj`, stripping the common prefix
+
+        The archive is read once from front to back, so `tarfileobj` may
+        be a pipe. As the common prefix is only known at the end, the
+        members are extracted to a staging directory within `target_dir`
+        and moved into place afterwards. If `check` is given, it is
+        called once the archive has been read; if it raises, nothing is
+        moved into `target_dir`.
+        """
+        import tarfile
+        silent_makedirs(target_dir)
+        target_dir = os.path.realpath(target_dir)
+        staging_dir = tempfile.mkdtemp(prefix='.unpacking-', dir=target_dir)
+        try:
+            with closing(tarfile.open(fileobj=tarfileobj, mode=mode)) as archive:
+                names = []
+                directories = []
+                for member in archive:
                     try:
                         member.name.decode('ascii', 'strict')
                     except UnicodeDecodeError:
                         self.logger.warning("Archive contained a non-ascii path: %s.  Skipping."
                                             % member.name.decode('ascii', 'replace'))
                         continue
-
-                    if not os.path.abspath(pjoin(target_dir, member.name)).startswith(target_dir):
+                    path = os.path.abspath(pjoin(staging_dir, member.name))
+                    # nor may a path lead through a symlink extracted before
+                    parent = os.path.realpath(os.path.dirname(path))
+                    if not (path == staging_dir or
+                            (path.startswith(staging_dir + os.sep) and
+                             (parent + os.sep).startswith(staging_dir + os.sep))):
                         raise SecurityError("Archive attempted to break out of target dir "
                                             "with filename: %s" % member.name)
-                    member.name = member.name[prefix_len:]
-                    filtered_members.append(member)
-                archive.extractall(target_dir, filtered_members)
+                    if member.isdir():
+                        # like extractall, set the attributes of directories
+                        # once their contents are in place
+                        directories.append(member)
+                        member = copy.copy(member)
+                        member.mode = 0o700
+                    else:
+                        names.append(member.name)
+                    archive.extract(member, staging_dir)
+                if check is not None:
+                    check()
+                prefix = common_path_prefix(names) if names else ''
+                _move_tree_into(pjoin(staging_dir, prefix), target_dir)
+                directories.sort(key=lambda member: member.name, reverse=True)
+                for member in directories:
+                    if len(member.name) <= len(prefix):
+                        continue
+                    path = pjoin(target_dir, member.name[len(prefix):])
+                    archive.chown(member, path)
+                    archive.chmod(member, path)
+                    archive.utime(member, path)
+        finally:
+            shutil.rmtree(staging_dir)
+
+    def make_decompressor(self):
+        """Returns an incremental decompressor object for the archive format,
+        or `None` if it cannot be decompressed in-process
+        """
+        return None
+
+    def decompress_to(self, infile, outfile):
+        """Writes the uncompressed tarball in `infile` to `outfile`
+
+        Returns a SHA-256 hasher of the compressed data read.
+        """
+        hasher = hashlib.sha256()
+        if self.decompress_command is not None:
+            return self._decompress_externally_to(infile, outfile, hasher)
+        decompressor = self.make_decompressor()
+        while True:
+            chunk = infile.read(self.chunk_size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            while chunk:
+                outfile.write(decompressor.decompress(chunk))
+                # the data may consist of several concatenated streams
+                chunk = getattr(decompressor, 'unused_data', '')
+                if chunk:
+                    decompressor = self.make_decompressor()
+        return hasher
+
+    def _decompress_externally_to(self, infile, outfile, hasher):
+        p, wait = self._run_decompressor(infile, hasher)
+        try:
+            while True:
+                chunk = p.stdout.read(self.chunk_size)
+                if not chunk:
+                    break
+                outfile.write(chunk)
+        finally:
+            wait()
+        return hasher
+
+    def _run_decompressor(self, infile, hasher):
+        """Starts the external decompressor, fed with `infile` by a thread
+        that also updates `hasher` with it
+
+        Returns the process, whose stdout must be read by the caller, and
+        a function reading any remaining output and waiting for it, which
+        raises :exc:`CorruptSourceCacheError` if it failed (unless called
+        with ``abort=True`` to stop the decompressor). stderr goes
+        to a temporary file, as a full pipe would block the decompressor
+        while stdout is being read.
+        """
+        stderr = tempfile.TemporaryFile()
+        p = subprocess.Popen(self.decompress_command, stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE, stderr=stderr)
+        def feed():
+            try:
+                while True:
+                    chunk = infile.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    p.stdin.write(chunk)
+            except IOError:
+                pass  # decompressor quit; reported below
+            finally:
+                p.stdin.close()
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        def wait(abort=False):
+            if p.returncode is None:
+                try:
+                    if abort:
+                        # the decompressor fails writing to the closed pipe
+                        p.stdout.close()
+                    while p.stdout.read(self.chunk_size):
+                        pass
+                finally:
+                    p.stdout.close()
+                    feeder.join()
+                    p.wait()
+                    stderr.seek(0)
+                    p.err = stderr.read()
+                    stderr.close()
+            if p.returncode != 0 and not abort:
+                raise CorruptSourceCacheError('%s failed: %s' % (self.decompress_command[0],
+                                                                 p.err.strip()))
+        return p, wait
 
     def tarfileobj_from_name(self, filename):
         return open(filename, 'r');
@@ -963,11 +2357,13 @@ class TarSubprocessHandler(TarballHandler):
         return True
 
     def unpack(self, infile, target_dir, hash):
+        if self.decompress_command is not None:
+            return TarballHandler.unpack(self, infile, target_dir, hash)
         self.logger.debug('Calling tar to unpack %s -> %s', infile, target_dir)
         try:
             subprocess.check_call(['tar', 'xf', infile.name, '-C', target_dir, '--strip-components=1'])
         except subprocess.CalledProcessError:
-            raise CorruptSourceCacheError("Archive corrupt and/or cannot be unpacked: '%s'" % filename)
+            raise CorruptSourceCacheError("Archive corrupt and/or cannot be unpacked: '%s'" % infile.name)
 
 
 class TarGzHandler(TarballHandler):
@@ -975,12 +2371,20 @@ class TarGzHandler(TarballHandler):
     exts = ['tar.gz', 'tgz']
     read_mode = 'r:gz'
 
+    def make_decompressor(self):
+        import zlib
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
 
 class TarBz2Handler(TarballHandler):
     type = 'tar.bz2'
     exts = ['tar.bz2', 'tb2', 'tbz2']
     read_mode = 'r:bz2'
 
+    def make_decompressor(self):
+        import bz2
+        return bz2.BZ2Decompressor()
+
 
 class TarXzHandler(TarballHandler):
     type = 'tar.xz'
@@ -990,6 +2394,9 @@ class TarXzHandler(TarballHandler):
     # XXX: tarfile has built-in 'r:xz' support only in Python 3,
     # XXX: so we use lzma module for Python 2 compatibility.
 
+    def make_decompressor(self):
+        return lzma.LZMADecompressor()
+
     def tarfileobj_from_name(self, filename):
         return lzma.LZMAFile(filename)
 
@@ -1000,6 +2407,25 @@ class TarXzHandler(TarballHandler):
         return StringIO(lzma.LZMADecompressor().decompress(archive_data))
 
 
+class TarZstHandler(TarballHandler):
+    # there is no zstd module for Python 2, so the zstd program is
+    # always used
+    type = 'tar.zst'
+    exts = ['tar.zst', 'tzst']
+    read_mode = 'r'
+
+    def unpack(self, infile, target_dir, hash):
+        if self.decompress_command is None:
+            raise SourceCacheError('Unpacking %s needs the zstd program' % infile.name)
+        TarballHandler.unpack(self, infile, target_dir, hash)
+
+    def verify(self, filename):
+        if self.decompress_command is None:
+            self.logger.warning('Cannot verify %s without the zstd program' % filename)
+            return True
+        return TarballHandler.verify(self, filename)
+
+
 try:
     import lzma
 except ImportError:
@@ -1043,7 +2469,7 @@ class ZipHandler(object):
 archive_ext_to_type = {}
 archive_handler_classes = {}
 archive_types = []
-for cls in [TarGzHandler, TarBz2Handler, TarXzHandler, ZipHandler]:
+for cls in [TarGzHandler, TarBz2Handler, TarXzHandler, TarZstHandler, ZipHandler]:
     for ext in cls.exts:
         archive_ext_to_type[ext] = cls.type
     archive_handler_classes[cls.type] = cls
@@ -1051,8 +2477,38 @@ for cls in [TarGzHandler, TarBz2Handler, TarXzHandler, ZipHandler]:
 archive_types = sorted(archive_types)
 
 
-def create_archive_handler(type, logger):
-    return archive_handler_classes[type](logger)
+def can_shadow(handler):
+    """Whether packs unpacked by `handler` may have shadow copies"""
+    return (isinstance(handler, TarballHandler) and
+            (handler.make_decompressor() is not None or handler.decompress_command is not None))
+
+def get_pack_candidates(packs_dir, type, hash):
+    """Returns the possible filenames of a pack below `packs_dir`,
+    in the sharded layout first and the flat one second
+    """
+    return [pjoin(packs_dir, type, hash[:SHARD_LEN], hash), pjoin(packs_dir, type, hash)]
+
+def iter_pack_files(packs_dir, type):
+    """Yields ``(hash, filename)`` for the packs of the given type below
+    `packs_dir`, in either layout
+    """
+    type_dir = pjoin(packs_dir, type)
+    if not os.path.isdir(type_dir):
+        return
+    for name in sorted(os.listdir(type_dir)):
+        path = pjoin(type_dir, name)
+        if len(name) == SHARD_LEN and os.path.isdir(path):
+            for hash in sorted(os.listdir(path)):
+                if '.' not in hash:
+                    yield hash, pjoin(path, hash)
+        elif '.' not in name:
+            yield name, path
+
+def create_archive_handler(type, logger, external_decompress=False):
+    cls = archive_handler_classes[type]
+    if issubclass(cls, TarballHandler):
+        return cls(logger, external_decompress)
+    return cls(logger)
 
 def hit_pack(files, stream=None):
     """
@@ -1129,6 +2585,18 @@ def hit_unpack(stream, key):
         raise CorruptSourceCacheError('hit-pack does not match key "%s"' % key)
     return files
 
+def _move_tree_into(src, dst):
+    """Moves the entries of the directory `src` into `dst`, merging
+    directories present in both
+    """
+    for name in os.listdir(src):
+        src_path, dst_path = pjoin(src, name), pjoin(dst, name)
+        if (os.path.isdir(src_path) and not os.path.islink(src_path) and
+            os.path.isdir(dst_path) and not os.path.islink(dst_path)):
+            _move_tree_into(src_path, dst_path)
+        else:
+            os.rename(src_path, dst_path)
+
 def scatter_files(files, target_dir):
     """
     Given a list of filenames and their contents, write them to the file system.
@@ -1160,8 +2628,27 @@ def scatter_files(files, target_dir):
         with os.fdopen(fd, 'w') as f:
             f.write(contents)
 
+def _get_size(path):
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+def _get_mtime(path):
+    try:
+        return int(os.stat(path).st_mtime)
+    except OSError:
+        return 0
+
+def _get_tree_size(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            total += _get_size(pjoin(dirpath, filename))
+    return total
+
 def silent_unlink(path):
     try:
-        os.unlink(temp_file)
+        os.unlink(path)
     except:
         pass
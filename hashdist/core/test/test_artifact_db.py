@@ -0,0 +1,64 @@
+import sqlite3
+from os.path import join as pjoin
+
+from nose.tools import eq_
+
+from .utils import temp_dir
+from ..artifact_db import ArtifactDB
+
+
+def test_artifact_db():
+    with temp_dir() as d:
+        filename = pjoin(d, 'artifacts.sqlite')
+        db = ArtifactDB(filename)
+        assert db.is_new
+        db.add_artifact('zlib/4niostz3iktlg67najtxuwwgss5vl6k4', 'zlib/4niostz3iktl',
+                        size=100, build_time=1.5)
+        db.add_artifact('zlib/4niozzzzzzzzzzzzzzzzzzzzzzzzzzzz', 'zlib/4niozzzzzzzz')
+        db.add_artifact('python/2qbgsltd4mwzauf6ywg3olmhzhrnbaw2', 'python/2qbgsltd4mwz',
+                        ['zlib/4niostz3iktlg67najtxuwwgss5vl6k4'])
+        db.add_gc_root('_root', '/home/user/profile', 'python/2qbgsltd4mwzauf6ywg3olmhzhrnbaw2')
+        db.close()
+
+        db = ArtifactDB(filename)
+        assert not db.is_new
+        eq_('zlib/4niostz3iktl', db.get_path('zlib/4niostz3iktlg67najtxuwwgss5vl6k4'))
+        eq_(None, db.get_path('zlib/4niostz3iktlg67najtxuwwgss5vl6k5'))
+        record = db.get_artifact('zlib/4niostz3iktlg67najtxuwwgss5vl6k4')
+        eq_((100, 1.5), (record['size'], record['build_time']))
+        eq_('python/2qbgsltd4mwzauf6ywg3olmhzhrnbaw2', db.find_by_path('python/2qbgsltd4mwz'))
+        eq_(['zlib/4niostz3iktlg67najtxuwwgss5vl6k4'],
+            db.get_dependencies('python/2qbgsltd4mwzauf6ywg3olmhzhrnbaw2'))
+
+        eq_(['zlib/4niostz3iktlg67najtxuwwgss5vl6k4', 'zlib/4niozzzzzzzzzzzzzzzzzzzzzzzzzzzz'],
+            db.resolve_prefix('zlib/4nio'))
+        eq_(['zlib/4niozzzzzzzzzzzzzzzzzzzzzzzzzzzz'], db.resolve_prefix('zlib/4nioz'))
+        eq_([], db.resolve_prefix('zlib/5'))
+        eq_(3, len(db.resolve_prefix('')))
+
+        db.remove_artifact('python/2qbgsltd4mwzauf6ywg3olmhzhrnbaw2')
+        eq_([], db.get_dependencies('python/2qbgsltd4mwzauf6ywg3olmhzhrnbaw2'))
+        eq_([('_root', '/home/user/profile', 'python/2qbgsltd4mwzauf6ywg3olmhzhrnbaw2')],
+            db.list_gc_roots())
+        db.remove_gc_root('_root')
+        eq_([], db.list_gc_roots())
+        db.remove_all_artifacts()
+        eq_([], db.list_artifacts())
+
+
+def test_upgrade():
+    with temp_dir() as d:
+        filename = pjoin(d, 'artifacts.sqlite')
+        conn = sqlite3.connect(filename)
+        conn.executescript('CREATE TABLE artifacts (id TEXT PRIMARY KEY, name TEXT NOT NULL, '
+                           'path TEXT NOT NULL, size INTEGER, build_time REAL, created REAL NOT NULL);'
+                           'PRAGMA user_version = 1;')
+        conn.execute("INSERT INTO artifacts VALUES ('zlib/4nio', 'zlib', 'zlib/4nio', 10, NULL, 5)")
+        conn.commit()
+        conn.close()
+        db = ArtifactDB(filename)
+        assert not db.is_new
+        eq_([('zlib/4nio', 'zlib/4nio', 10, 5)], db.list_by_last_use())
+        db.touch('zlib/4nio', 7)
+        eq_(7, db.get_artifact('zlib/4nio')['last_used'])
+        eq_(10, db.get_total_size())
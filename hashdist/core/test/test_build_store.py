@@ -7,8 +7,11 @@ from textwrap import dedent
 from pprint import pprint
 import gzip
 import json
-from contextlib import closing
+from contextlib import closing, contextmanager
 import subprocess
+import time
+import sys
+import imp
 from pprint import pprint
 
 from nose.tools import eq_
@@ -18,7 +21,11 @@ from .utils import which, logger, temp_dir, temp_working_dir, assert_raises
 from . import utils
 
 from .. import source_cache, build_store, InvalidBuildSpecError, BuildFailedError, InvalidJobSpecError
+from ..build_store import shorten_artifact_id
 from ..common import SHORT_ARTIFACT_ID_LEN, IllegalBuildStoreError
+from ..manifest import read_manifest
+from ..dedup import hash_file
+from ..relocation import read_relocation_index, RELOCATION_INDEX_FILENAME
 
 
 #
@@ -75,12 +82,14 @@ def fixture():
                 os.makedirs(pjoin(tempdir, 'tmp'))
                 os.makedirs(pjoin(tempdir, 'bld'))
                 os.makedirs(pjoin(tempdir, 'gcroots'))
+                os.makedirs(pjoin(tempdir, 'db'))
 
                 config = {
                     'source_caches': [{'dir': pjoin(tempdir, 'src')}],
                     'build_stores': [{'dir': pjoin(tempdir, 'bld')}],
                     'build_temp': pjoin(tempdir, 'tmp'),
                     'gc_roots': pjoin(tempdir, 'gcroots'),
+                    'db': pjoin(tempdir, 'db'),
                     }
 
                 sc = source_cache.SourceCache.create_from_config(config, logger)
@@ -118,8 +127,14 @@ def test_basic(tempdir, sc, bldr, config):
     assert not bldr.is_present(spec)
     name, path = bldr.ensure_present(spec, config, extra_env={'EXTRA': 'extra'})
     assert bldr.is_present(spec)
-    eq_(['artifact.json', 'bar', 'build.json', 'build.log.gz', 'hello', 'id'],
-        sorted(os.listdir(path)))
+    eq_(['artifact.json', 'bar', 'build.json', 'build.log.gz', 'hello', 'id', 'manifest.gz',
+         'relocations.json'], sorted(os.listdir(path)))
+    manifest = read_manifest(path)
+    eq_(['artifact.json', 'bar', 'bar/foo', 'build.json', 'build.log.gz', 'hello',
+         'relocations.json'], [entry.path for entry in manifest])
+    eq_(('d', 'f'), (manifest[1].type, manifest[2].type))
+    eq_((9, hash_file(pjoin(path, 'bar', 'foo'))), (manifest[2].size, manifest[2].digest))
+    eq_(set([script_key]), bldr.get_source_keys())
     with file(pjoin(path, 'hello')) as f:
         got = sorted(f.readlines())
         eq_(''.join(got), dedent('''\
@@ -274,6 +289,26 @@ def build_mock_packages(builder, config, packages, virtuals={}, name_to_artifact
                 assert abspath == name_to_artifact[d][1]
     return name_to_artifact
 
+@contextmanager
+def store_fetching_from_mirror(builder, artifact_id, mirror_dir, subdir=''):
+    """Publishes an artifact of `builder` in `mirror_dir` and yields a new,
+    temporary build store (under `subdir` of a temporary directory) that
+    fetches from it
+    """
+    name, short_digest = shorten_artifact_id(artifact_id).split('/')
+    archive = pjoin(mirror_dir, name, short_digest + '.tar.gz')
+    if not os.path.exists(archive):
+        if not os.path.isdir(pjoin(mirror_dir, name)):
+            os.makedirs(pjoin(mirror_dir, name))
+        subprocess.check_call(['tar', 'czf', archive, '-C', builder.artifact_root,
+                               pjoin(name, short_digest)])
+    with temp_dir() as d:
+        d = pjoin(d, subdir)
+        for x in ['tmp', 'bld', 'gcroots']:
+            os.makedirs(pjoin(d, x))
+        yield build_store.BuildStore(pjoin(d, 'tmp'), pjoin(d, 'bld'), pjoin(d, 'gcroots'), logger,
+                                     mirrors=['file:' + mirror_dir])
+
 @fixture()
 def test_dependency_substitution(tempdir, sc, bldr, config):
     # Test that environment variables for dependencies are present in build environment
@@ -296,3 +331,281 @@ def test_virtual_dependencies(tempdir, sc, bldr, config):
     build_mock_packages(bldr, config, [numpy], virtuals={"virtual:blas/1.2.3": blas_id},
                         name_to_artifact={"blas": ("virtual:blas/1.2.3", blas_path)})
 
+
+@fixture()
+def test_artifact_db(tempdir, sc, bldr, config):
+    libc = MockPackage("libc", [])
+    blas = MockPackage("blas", [libc])
+    numpy = MockPackage("numpy", [blas, libc])
+    artifacts = build_mock_packages(bldr, config, [libc, blas, numpy])
+    libc_id, libc_path = artifacts["libc"]
+    blas_id, blas_path = artifacts["blas"]
+    numpy_id, numpy_path = artifacts["numpy"]
+
+    record = bldr.db.get_artifact(blas_id)
+    eq_(os.path.relpath(blas_path, bldr.artifact_root), record['path'])
+    assert record['size'] > 0 and record['build_time'] >= 0
+    eq_([libc_id], bldr.db.get_dependencies(blas_id))
+    eq_([blas_id], bldr.resolve_prefix(blas_id[:8]))
+    eq_([], bldr.resolve_prefix('blas/x'))
+
+    # an index built from scratch agrees with the one kept up to date
+    profile = pjoin(tempdir, 'profile')
+    bldr.create_symlink_to_artifact(blas_id, profile)
+    db_dir = pjoin(tempdir, 'db2')
+    os.mkdir(db_dir)
+    other = build_store.BuildStore.create_from_config(dict(config, db=db_dir), logger)
+    eq_(bldr.db.list_artifacts(), other.db.list_artifacts())
+    eq_(bldr.db.list_gc_roots(), other.db.list_gc_roots())
+    eq_(bldr.list_artifacts(), list(bldr._walk_artifacts()))
+
+    eq_(([numpy_id], bldr.db.get_artifact(numpy_id)['size']), bldr.gc(dry_run=True))
+    assert os.path.exists(numpy_path)
+    bldr.gc()
+    assert not os.path.exists(numpy_path)
+    assert bldr.resolve(numpy_id, build_store_only=True) is None
+    eq_(sorted([libc_id, blas_id]), bldr.resolve_prefix(''))
+
+    # the index still knows what a removed profile pointed to
+    os.unlink(profile)
+    eq_([(profile, blas_path)], bldr.list_gc_roots())
+    bldr.remove_symlink_to_artifact(profile)
+    eq_([], bldr.list_gc_roots())
+
+    eq_(libc_path, bldr.delete(libc_id))
+    eq_([blas_id], bldr.resolve_prefix(''))
+
+@fixture()
+def test_gc(tempdir, sc, bldr, config):
+    # without the artifact database
+    del config['db']
+    bldr = build_store.BuildStore.create_from_config(config, logger)
+    libc = MockPackage("libc", [])
+    blas = MockPackage("blas", [libc])
+    artifacts = build_mock_packages(bldr, config, [libc, blas])
+    bldr.create_symlink_to_artifact(artifacts["libc"][0], pjoin(tempdir, 'profile'))
+
+    # trash left by an interrupted run
+    trash_dir = pjoin(bldr.artifact_root, build_store.TRASH_DIRNAME)
+    os.makedirs(pjoin(trash_dir, 'foo-x', 'artifact'))
+    with open(pjoin(trash_dir, 'foo-x', 'artifact', 'id'), 'w') as f:
+        f.write('foo/x\n')
+    eq_(sorted([artifacts["libc"][0], artifacts["blas"][0]]),
+        bldr.resolve_prefix('blas/') + bldr.resolve_prefix('libc/'))
+
+    removed, freed = bldr.gc(dry_run=True)
+    eq_([artifacts["blas"][0]], removed)
+    assert freed > 0
+    eq_((removed, freed), bldr.gc(jobs=2))
+    assert not os.path.exists(artifacts["blas"][1])
+    assert os.path.exists(artifacts["libc"][1])
+    eq_([], os.listdir(trash_dir))
+
+@fixture()
+def test_quota(tempdir, sc, bldr, config):
+    libc = MockPackage("libc", [])
+    blas = MockPackage("blas", [libc])
+    zlib = MockPackage("zlib", [])
+    python = MockPackage("python", [zlib])
+    artifacts = build_mock_packages(bldr, config, [libc, blas, zlib, python])
+    ids = dict((name, artifact_id) for name, (artifact_id, path) in artifacts.items())
+    bldr.create_symlink_to_artifact(ids["blas"], pjoin(tempdir, 'profile'))
+    long_ago = time.time() - 2 * build_store.EVICTION_GRACE
+    for i, name in enumerate(["libc", "zlib", "blas", "python"]):
+        bldr.db.touch(ids[name], long_ago + i)
+
+    # within quota, or everything unrooted in use
+    bldr.quota = bldr.db.get_total_size()
+    eq_(([], 0), bldr.enforce_quota())
+    bldr.quota = 0
+    eq_([ids["zlib"]], bldr.enforce_quota(keep=[ids["python"], ids["zlib"]])[0] +
+        bldr.enforce_quota(keep=[ids["python"]])[0])
+    assert bldr.resolve(ids["python"], build_store_only=True) is not None
+
+    # resolving records use; recently used artifacts are not evicted
+    bldr._last_touched.clear()
+    bldr.resolve(ids["python"])
+    spec = {"name": "foo", "build": {"commands": []}}
+    bldr.ensure_present(spec, config)
+    assert bldr.resolve(ids["python"], build_store_only=True) is not None
+
+    bldr.db.touch(ids["python"], long_ago)
+    bldr.ensure_present({"name": "bar", "build": {"commands": []}}, config)
+    assert bldr.resolve(ids["python"], build_store_only=True) is None
+    assert bldr.resolve(ids["libc"], build_store_only=True) is not None
+
+@fixture()
+def test_dedup(tempdir, sc, bldr, config):
+    def build(name):
+        spec = {"name": name,
+                "build": {"commands": [
+                    {"cmd": ["/bin/sh", "-c", "echo hello > $ARTIFACT/a && %s a-w $ARTIFACT/a && "
+                                              "echo hello > $ARTIFACT/w" % which("chmod")]}]}}
+        return bldr.ensure_present(spec, config)
+
+    bldr.dedup = True
+    foo_id, foo_path = build("foo")
+    bar_id, bar_path = build("bar")
+    eq_(os.stat(pjoin(foo_path, 'a')).st_ino, os.stat(pjoin(bar_path, 'a')).st_ino)
+    assert os.stat(pjoin(foo_path, 'w')).st_ino != os.stat(pjoin(bar_path, 'w')).st_ino
+    with open(pjoin(bar_path, 'a')) as f:
+        eq_('hello\n', f.read())
+    eq_((0, 0), bldr.dedup_artifact(bar_path))
+
+    # existing artifacts ('hit dedup')
+    bldr.dedup = False
+    baz_id, baz_path = build("baz")
+    eq_(3, os.stat(pjoin(foo_path, 'a')).st_nlink)
+    # 'a' and relocations.json (the same when there is nothing to relocate)
+    eq_(2, bldr.dedup_artifact(baz_path)[0])
+    eq_(4, os.stat(pjoin(foo_path, 'a')).st_nlink)
+
+    # the pool keeps objects as long as an artifact uses them
+    def objects():
+        pool_dir = bldr.object_pool.path
+        return sum([os.listdir(pjoin(pool_dir, shard)) for shard in os.listdir(pool_dir)], [])
+    # 'a' and relocations.json, and build.json, build.log.gz and manifest.gz
+    # of each artifact
+    eq_(11, len(objects()))
+    bldr.delete(foo_id, prune=False)
+    bldr.delete(bar_id, prune=False)
+    eq_(11, len(objects()))
+    bldr.prune_objects()
+    eq_(5, len(objects()))
+    bldr.gc()
+    eq_([], objects())
+    eq_([], bldr.list_artifacts())
+
+def test_dedup_across_file_systems():
+    from ..dedup import ObjectPool
+    if not os.path.isdir('/dev/shm'):
+        raise SkipTest('no /dev/shm')
+    with temp_dir() as d:
+        pool_dir = tempfile.mkdtemp(dir='/dev/shm')
+        try:
+            if os.stat(pool_dir).st_dev == os.stat(d).st_dev:
+                raise SkipTest('/dev/shm is on the same file system')
+            filename = pjoin(d, 'a')
+            with open(filename, 'w') as f:
+                f.write('hello')
+            os.chmod(filename, 0o444)
+            # the file is skipped rather than failing
+            eq_((0, 0), ObjectPool(pool_dir, logger).dedup_tree(d))
+            eq_([], sum([os.listdir(pjoin(pool_dir, shard)) for shard in os.listdir(pool_dir)], []))
+        finally:
+            shutil.rmtree(pool_dir)
+
+@fixture()
+def test_relocation_index(tempdir, sc, bldr, config):
+    spec = {"name": "foo",
+            "build": {"commands": [
+                {"cmd": ["/bin/sh", "-c", "echo $ARTIFACT/bin > $ARTIFACT/paths && "
+                                          "echo $ARTIFACT/bin > $ARTIFACT/unindexed && "
+                                          "echo hello > $ARTIFACT/hello && "
+                                          "printf %s $ARTIFACT > $ARTIFACT/location"]}]}}
+    artifact_id, path = bldr.ensure_present(spec, config)
+    index = read_relocation_index(path)
+    eq_(os.path.dirname(bldr.artifact_root), index['prefix'])
+    eq_(['paths', 'unindexed'], [entry['path'] for entry in index['files']])
+    eq_([0], index['files'][0]['offsets'])
+
+    # publish the artifact on a mirror, pretending 'unindexed' was not found at build time
+    index['files'] = index['files'][:1]
+    os.chmod(path, 0o755)
+    os.chmod(pjoin(path, RELOCATION_INDEX_FILENAME), 0o644)
+    with open(pjoin(path, RELOCATION_INDEX_FILENAME), 'w') as f:
+        json.dump(index, f)
+    with store_fetching_from_mirror(bldr, artifact_id, pjoin(tempdir, 'mirror')) as other:
+        other_path = other.resolve(artifact_id)
+        eq_(pjoin(other.artifact_root, shorten_artifact_id(artifact_id)), other_path)
+        with open(pjoin(other_path, 'paths')) as f:
+            eq_(pjoin(other_path, 'bin') + '\n', f.read())
+        with open(pjoin(other_path, 'unindexed')) as f:
+            eq_(pjoin(path, 'bin') + '\n', f.read())
+        # the manifest was updated for the relocated file
+        entries = dict((entry.path, entry) for entry in read_manifest(other_path))
+        eq_(hash_file(pjoin(other_path, 'paths')), entries['paths'].digest)
+        eq_(os.path.getsize(pjoin(other_path, 'paths')), entries['paths'].size)
+
+@fixture()
+def test_fixed_artifact_root(tempdir, sc, bldr, config):
+    from ..namespace import is_supported, run_with_fixed_root, NamespaceError
+    fixed_root = pjoin(tempdir, 'fixed', 'bld')
+    os.makedirs(fixed_root)
+    if not is_supported():
+        raise SkipTest('no user namespaces')
+    try:
+        run_with_fixed_root(bldr.artifact_root, fixed_root, lambda: None)
+    except NamespaceError, e:
+        raise SkipTest(str(e))
+
+    config = dict(config, fixed_artifact_root=fixed_root)
+    bldr = build_store.BuildStore.create_from_config(config, logger)
+    bar_id, bar_path = bldr.ensure_present({"name": "bar", "build": {"commands": []}}, config)
+    spec = {"name": "foo",
+            "build": {
+                "import": [{"ref": "BAR", "id": bar_id}],
+                "commands": [
+                    {"cmd": ["/bin/sh", "-c", "echo $ARTIFACT $BAR_DIR > $ARTIFACT/paths && "
+                                              "%s $BAR_DIR > $ARTIFACT/bar-listing" % which('ls')]}]}}
+    foo_id, foo_path = bldr.ensure_present(spec, config)
+    # built at the real path, but seeing only the fixed one
+    eq_(bldr.artifact_root, os.path.dirname(os.path.dirname(foo_path)))
+    with open(pjoin(foo_path, 'paths')) as f:
+        eq_('%s %s\n' % (bldr.to_fixed_path(foo_path), bldr.to_fixed_path(bar_path)), f.read())
+    with open(pjoin(foo_path, 'bar-listing')) as f:
+        assert 'artifact.json' in f.read()
+    assert not os.listdir(fixed_root)
+    eq_(pjoin(tempdir, 'fixed'), read_relocation_index(foo_path)['prefix'])
+
+def test_make_padded_root():
+    with temp_dir() as d:
+        for length in [len(d) + 20, 256, 600]:
+            padded_root = build_store.make_padded_root(d, length)
+            eq_(length, len(padded_root))
+            eq_(os.path.realpath(d), os.path.realpath(padded_root))
+            # idempotent
+            eq_(padded_root, build_store.make_padded_root(d, length))
+        with assert_raises(ValueError):
+            build_store.make_padded_root(d, len(d) + 5)
+
+@fixture()
+def test_padded_root(tempdir, sc, bldr, config):
+    config = dict(config, padded_root_length=200)
+    bldr = build_store.BuildStore.create_from_config(config, logger)
+    spec = {"name": "foo",
+            "build": {"commands": [
+                {"cmd": ["/bin/sh", "-c", "echo $ARTIFACT > $ARTIFACT/text && "
+                                          "printf 'x\\000%s/lib\\000y' $ARTIFACT > $ARTIFACT/binary && "
+                                          "echo 'def f(): return 42' > $ARTIFACT/a.py && " +
+                                          sys.executable + " -m py_compile $ARTIFACT/a.py"]}]}}
+    artifact_id, path = bldr.ensure_present(spec, config)
+    padded_path = bldr.to_fixed_path(path)
+    eq_(200, len(bldr.padded_artifact_root))
+    with open(pjoin(path, 'text')) as f:
+        eq_(padded_path + '\n', f.read())
+    index = read_relocation_index(path)
+    eq_(bldr.padded_artifact_root, index['padded_root'])
+    # the .pyc contains the path, but is not relocated
+    with open(pjoin(path, 'a.pyc'), 'rb') as f:
+        assert padded_path in f.read()
+    eq_(['binary', 'text'], [entry['path'] for entry in index['files']])
+    # the padding is not an artifact
+    eq_([artifact_id], [x for x, _ in bldr.list_artifacts()])
+
+    mirror_dir = pjoin(tempdir, 'mirror')
+    with store_fetching_from_mirror(bldr, artifact_id, mirror_dir) as other:
+        other_path = other.resolve(artifact_id)
+        pad = '\0' * (len(padded_path) - len(other_path))
+        with open(pjoin(other_path, 'text')) as f:
+            eq_(other_path + '\n', f.read())
+        with open(pjoin(other_path, 'binary')) as f:
+            eq_('x\0%s/lib%s\0y' % (other_path, pad), f.read())
+        eq_(42, imp.load_compiled('a', pjoin(other_path, 'a.pyc')).f())
+        entries = dict((entry.path, entry) for entry in read_manifest(other_path))
+        eq_(hash_file(pjoin(other_path, 'binary')), entries['binary'].digest)
+
+    # a store whose root is longer than the padding can't use the artifact
+    with store_fetching_from_mirror(bldr, artifact_id, mirror_dir, 'x' * 200) as other:
+        eq_(None, other.resolve(artifact_id))
+        eq_([], os.listdir(other.artifact_root))
@@ -0,0 +1,71 @@
+import os
+import subprocess
+from os.path import join as pjoin
+
+from nose import SkipTest
+from nose.tools import eq_
+
+from .utils import temp_dir, which, logger, assert_raises
+from ..elf import ElfFile, ElfError, is_elf, shrink_rpath, set_rpath
+from ..relocation import relocate_files
+
+
+def compile_library(d, rpath, new_dtags=False):
+    gcc = which('gcc')
+    if gcc is None:
+        raise SkipTest('gcc not available')
+    with open(pjoin(d, 'x.c'), 'w') as f:
+        f.write('#include <stdio.h>\nint x(void) { return puts("x"); }\n')
+    filename = pjoin(d, 'libx.so')
+    subprocess.check_call([gcc, '-shared', '-fPIC', '-o', filename, pjoin(d, 'x.c'),
+                           '-Wl,-rpath,' + rpath,
+                           '-Wl,--enable-new-dtags' if new_dtags else '-Wl,--disable-new-dtags'])
+    return filename
+
+
+def test_read_and_set_rpath():
+    for new_dtags in [False, True]:
+        with temp_dir() as d:
+            filename = compile_library(d, '/some/long/path/lib:/other/lib', new_dtags)
+            assert is_elf(filename)
+            elf = ElfFile(filename)
+            eq_('/some/long/path/lib:/other/lib', elf.rpath)
+            assert 'libc.so.6' in elf.needed
+
+            # fits in place
+            assert not set_rpath(filename, '${ORIGIN}/../lib')
+            eq_('${ORIGIN}/../lib', ElfFile(filename).rpath)
+            # would need patchelf
+            with assert_raises(ElfError):
+                set_rpath(filename, '/a/much/longer/path/than/before/lib')
+            eq_('${ORIGIN}/../lib', ElfFile(filename).rpath)
+
+
+def test_not_elf():
+    with temp_dir() as d:
+        with open(pjoin(d, 'script'), 'w') as f:
+            f.write('#!/bin/sh\n')
+        assert not is_elf(pjoin(d, 'script'))
+        with assert_raises(ElfError):
+            ElfFile(pjoin(d, 'script'))
+
+
+def test_shrink_rpath():
+    with temp_dir() as d:
+        for x in ['a', 'b', 'c']:
+            os.mkdir(pjoin(d, x))
+        open(pjoin(d, 'a', 'libfoo.so'), 'w').close()
+        open(pjoin(d, 'b', 'libfoo.so'), 'w').close()
+        open(pjoin(d, 'c', 'libbar.so'), 'w').close()
+        rpath = ':'.join([pjoin(d, 'a'), pjoin(d, 'b'), '$ORIGIN/../lib', pjoin(d, 'c')])
+        eq_(':'.join([pjoin(d, 'a'), '$ORIGIN/../lib', pjoin(d, 'c')]),
+            shrink_rpath(rpath, ['libfoo.so', 'libbar.so']))
+        eq_('$ORIGIN/../lib', shrink_rpath(rpath, ['libbaz.so']))
+
+
+def test_relocate_elf():
+    with temp_dir() as d:
+        filename = compile_library(d, '/old/bld/zlib/abc/lib')
+        changed = relocate_files(d, ['libx.so', 'x.c'], [('/old', '/new')], logger, jobs=1)
+        eq_(['libx.so'], changed)
+        eq_('/new/bld/zlib/abc/lib', ElfFile(filename).rpath)
@@ -23,3 +23,56 @@ def test_rmtree_up_to():
         # Parent is exclusive
         fileutils.rmtree_up_to(d, d)
         assert os.path.exists(d)
+
+def test_copy_file():
+    with temp_dir() as d:
+        src = pjoin(d, 'src')
+        with open(src, 'w') as f:
+            f.write('x' * 100000)
+        os.chmod(src, 0o755)
+        method = fileutils.copy_file(src, pjoin(d, 'a'), allow_hardlink=True)
+        assert method in ('reflink', 'kernel', 'copy')
+        with open(pjoin(d, 'a')) as f:
+            assert f.read() == 'x' * 100000
+        assert os.stat(pjoin(d, 'a')).st_mode & 0o777 == 0o755
+        assert os.stat(pjoin(d, 'a')).st_ino != os.stat(src).st_ino
+
+        # Write-protected files may be hard-linked, if allowed
+        os.chmod(src, 0o444)
+        assert fileutils.copy_file(src, pjoin(d, 'b'), allow_hardlink=True) == 'hardlink'
+        assert os.stat(pjoin(d, 'b')).st_ino == os.stat(src).st_ino
+        assert fileutils.copy_file(src, pjoin(d, 'c')) != 'hardlink'
+
+        # Replacing a hard link leaves the other links alone
+        os.chmod(src, 0o644)
+        with open(pjoin(d, 'other'), 'w') as f:
+            f.write('other')
+        assert fileutils.copy_file(pjoin(d, 'other'), pjoin(d, 'b')) != 'hardlink'
+        with open(src) as f:
+            assert f.read() == 'x' * 100000
+        with open(pjoin(d, 'b')) as f:
+            assert f.read() == 'other'
+
+def test_copy_tree():
+    with temp_dir() as d:
+        src = pjoin(d, 'src')
+        os.makedirs(pjoin(src, 'sub'))
+        with open(pjoin(src, 'sub', 'file'), 'w') as f:
+            f.write('contents')
+        os.symlink('sub/file', pjoin(src, 'link'))
+        os.symlink('sub', pjoin(src, 'dirlink'))
+        for path in [pjoin(src, 'sub', 'file'), pjoin(src, 'sub'), src]:
+            fileutils.write_protect(path)
+        try:
+            fileutils.copy_tree(src, pjoin(d, 'dst'), allow_hardlink=True)
+            dst = pjoin(d, 'dst')
+            assert os.readlink(pjoin(dst, 'link')) == 'sub/file'
+            assert os.readlink(pjoin(dst, 'dirlink')) == 'sub'
+            assert os.stat(pjoin(dst, 'sub')).st_mode & 0o222 == 0
+            with open(pjoin(dst, 'sub', 'file')) as f:
+                assert f.read() == 'contents'
+            # Removing the copy must leave the shared inode write-protected
+            fileutils.rmtree_write_protected(dst)
+            assert os.stat(pjoin(src, 'sub', 'file')).st_mode & 0o222 == 0
+        finally:
+            fileutils.rmtree_write_protected(src)
@@ -0,0 +1,71 @@
+import os
+import time
+import threading
+
+from ..mirrors import MirrorRanking, race, FAILURE_BACKOFF, MIRROR_STATS_FILENAME
+from .utils import temp_dir
+
+from nose.tools import eq_
+
+pjoin = os.path.join
+
+
+def test_order():
+    ranking = MirrorRanking()
+    mirrors = ['a', 'b', 'c', 'd']
+    eq_(mirrors, ranking.order(mirrors))
+    ranking.record_failure('a')
+    ranking.record_success('c', 1000, 1.0)
+    ranking.record_success('d', 4000, 1.0)
+    eq_(['d', 'c', 'b', 'a'], ranking.order(mirrors))
+    # failures expire
+    ranking.stats['a']['failed_at'] -= FAILURE_BACKOFF + 1
+    eq_(['d', 'c', 'a', 'b'], ranking.order(mirrors))
+    # a success clears a failure
+    ranking.record_failure('d')
+    ranking.record_success('d', 4000, 1.0)
+    eq_('d', ranking.order(mirrors)[0])
+
+def test_persistence():
+    with temp_dir() as d:
+        ranking = MirrorRanking.create_from_config({'cache': d})
+        ranking.record_success('a', 1000, 1.0)
+        assert os.path.exists(pjoin(d, MIRROR_STATS_FILENAME))
+        # a second instance must not lose what the first one recorded
+        other = MirrorRanking.create_from_config({'cache': d})
+        other.record_success('b', 2000, 1.0)
+        ranking.record_failure('c')
+        eq_(['b', 'a', 'c'], MirrorRanking.create_from_config({'cache': d}).order(['a', 'b', 'c']))
+
+def test_race():
+    release = threading.Event()
+    closed = []
+
+    class Result(object):
+        def __init__(self, name):
+            self.name = name
+        def close(self):
+            closed.append(self.name)
+
+    def slow():
+        release.wait()
+        return Result('slow')
+
+    def fail():
+        raise IOError()
+
+    def fast():
+        return Result('fast')
+
+    i, result, failures = race([slow, fail, fast])
+    eq_(2, i)
+    eq_('fast', result.name)
+    release.set()
+    for _ in range(100):
+        if closed: break
+        time.sleep(0.01)
+    eq_(['slow'], closed)
+
+    i, result, failures = race([fail, fail])
+    eq_(None, i)
+    eq_([0, 1], sorted(j for j, e in failures))
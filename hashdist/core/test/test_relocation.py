@@ -0,0 +1,87 @@
+import os
+from os.path import join as pjoin
+
+from nose.tools import eq_
+
+from .utils import temp_dir, logger, assert_raises
+from ..relocation import replace_paths, relocate_files
+
+
+def test_replace_paths():
+    replacements = [('/a/bld', '/bb/opt'), ('/a', '/bb')]
+    eq_('x /bb/opt/foo /bb/src /b', replace_paths('x /a/bld/foo /a/src /b', replacements))
+
+
+def test_relocate_files():
+    with temp_dir() as d:
+        os.mkdir(pjoin(d, 'bin'))
+        contents = {'script': '#!/old/bld/python/abc/bin/python\n/old/src\n',
+                    'bin/config': 'prefix=/old/bld\n' * 3,
+                    'none': 'nothing to see\n',
+                    'elf': '\x7fELF/old/bld/lib\n'}
+        for relpath, data in contents.items():
+            with open(pjoin(d, relpath), 'w') as f:
+                f.write(data)
+            os.chmod(pjoin(d, relpath), 0o444)
+        os.chmod(pjoin(d, 'bin'), 0o555)
+
+        def read(relpath):
+            with open(pjoin(d, relpath)) as f:
+                return f.read()
+
+        # Paths of the same length are patched in place
+        inode = os.stat(pjoin(d, 'script')).st_ino
+        changed = relocate_files(d, contents.keys(), [('/old/bld', '/xyz/bld'), ('/old', '/xyz')],
+                                 logger, jobs=1)
+        eq_(['bin/config', 'script'], changed)
+        eq_('#!/xyz/bld/python/abc/bin/python\n/xyz/src\n', read('script'))
+        eq_(inode, os.stat(pjoin(d, 'script')).st_ino)
+
+        # Otherwise, and for hard-linked files, the file is replaced
+        os.link(pjoin(d, 'script'), pjoin(d, 'script-link'))
+        changed = relocate_files(d, contents.keys(), [('/xyz/bld', '/longer/opt'), ('/xyz', '/longer')],
+                                 logger, jobs=2)
+        eq_(['bin/config', 'script'], changed)
+        eq_('#!/longer/opt/python/abc/bin/python\n/longer/src\n', read('script'))
+        eq_('#!/xyz/bld/python/abc/bin/python\n/xyz/src\n', read('script-link'))
+        eq_('prefix=/longer/opt\n' * 3, read('bin/config'))
+        eq_(contents['none'], read('none'))
+        # no patchelf given
+        eq_(contents['elf'], read('elf'))
+
+        eq_(0o444, os.stat(pjoin(d, 'bin', 'config')).st_mode & 0o777)
+        eq_(0o555, os.stat(pjoin(d, 'bin')).st_mode & 0o777)
+        eq_(['config'], os.listdir(pjoin(d, 'bin')))
+        os.chmod(pjoin(d, 'bin'), 0o755)
+
+
+def test_relocate_binary_files():
+    old, new = '/padded/root/____', '/new/root'
+    with temp_dir() as d:
+        data = 'head\0%s/foo/lib:%s/bar/lib\0tail %s/x\0' % (old, old, old)
+        for name in ['lib.so', 'linked.so']:
+            with open(pjoin(d, name), 'w') as f:
+                f.write(data)
+            os.chmod(pjoin(d, name), 0o444)
+        os.link(pjoin(d, 'linked.so'), pjoin(d, 'other-link.so'))
+        with open(pjoin(d, 'text'), 'w') as f:
+            f.write('prefix=%s/foo\n' % old)
+
+        with assert_raises(ValueError):
+            relocate_files(d, ['lib.so'], [(new, old)], logger, binary=True)
+        changed = relocate_files(d, ['lib.so', 'linked.so', 'text'], [(old, new)], logger,
+                                 binary=True)
+        eq_(['lib.so', 'linked.so', 'text'], changed)
+
+        pad = len(old) - len(new)
+        expected = 'head\0%s/foo/lib:%s/bar/lib%s\0tail %s/x%s\0' % (new, new, '\0' * 2 * pad,
+                                                                    new, '\0' * pad)
+        eq_(len(data), len(expected))
+        for name in ['lib.so', 'linked.so']:
+            with open(pjoin(d, name)) as f:
+                eq_(expected, f.read())
+            eq_(0o444, os.stat(pjoin(d, name)).st_mode & 0o777)
+        with open(pjoin(d, 'other-link.so')) as f:
+            eq_(data, f.read())
+        with open(pjoin(d, 'text')) as f:
+            eq_('prefix=%s/foo\n' % new, f.read())
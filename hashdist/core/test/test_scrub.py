@@ -0,0 +1,78 @@
+import os
+from os.path import join as pjoin
+import json
+import stat
+import time
+
+from nose.tools import eq_
+
+from ..scrub import Scrubber, RateLimiter
+from ..build_store import shorten_artifact_id
+from .test_build_store import fixture
+from .test_source_cache import make_mock_git_repo
+from . import utils
+
+
+def corrupt(filename, contents='corrupt'):
+    os.chmod(filename, stat.S_IRUSR | stat.S_IWUSR)
+    with open(filename, 'w') as f:
+        f.write(contents)
+
+
+@fixture()
+def test_scrub(tempdir, sc, bldr, config):
+    container_dir, tarball, key = utils.make_temporary_tarball([('a/README', 'contents')])
+    repo, commit, devel_commit = make_mock_git_repo()
+    try:
+        sc.fetch('file:' + tarball, key)
+        sc.fetch_git(repo, 'master', 'repo')
+    finally:
+        utils.shutil.rmtree(container_dir)
+        utils.shutil.rmtree(repo)
+    script_key = sc.put({'build.sh': 'echo hi > $ARTIFACT/hello\n'})
+    spec = {"name": "foo",
+            "sources": [{"key": script_key}],
+            "build": {"commands": [{"cmd": ["/bin/bash", "build.sh"]}]}}
+    artifact_id, path = bldr.ensure_present(spec, config)
+    sc.close()
+
+    config['cache'] = pjoin(tempdir, 'cache')
+    os.mkdir(config['cache'])
+    scrubber = Scrubber.create_from_config(config, sc, bldr, utils.logger, jobs=2)
+    report = scrubber.scrub()
+    eq_([], report['problems'])
+    eq_(4, report['checked'])
+    assert report['complete']
+
+    # corrupt a pack and the recorded state of the artifact
+    hash = key.split(':')[1]
+    corrupt(pjoin(sc.cache_path, 'packs', 'tar.gz', hash[:2], hash))
+    with open(pjoin(path, 'build.json')) as f:
+        doc = json.load(f)
+    doc['name'] = 'bar'
+    corrupt(pjoin(path, 'build.json'), json.dumps(doc))
+
+    # a scrub limited to one item leaves a cursor to continue from
+    artifact_item = 'artifact:%s' % shorten_artifact_id(artifact_id)
+    report = scrubber.scrub(max_items=1)
+    # build.json no longer hashes to the id, nor matches the manifest
+    eq_([artifact_item, artifact_item], [p['item'] for p in report['problems']])
+    eq_(pjoin(path, 'build.json'), report['problems'][1]['path'])
+    assert not report['complete']
+    report = scrubber.scrub()
+    assert report['complete']
+    eq_(artifact_item, report['resumed_after'])
+    eq_(4, report['checked'])
+    eq_([artifact_item, artifact_item, key], [p['item'] for p in report['problems']])
+    # the next scrub starts over
+    eq_(None, scrubber.scrub()['resumed_after'])
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(1000)
+    t0 = time.time()
+    for i in range(3):
+        limiter.consume(100)
+    assert time.time() - t0 >= 0.2
+    # no limit
+    RateLimiter(None).consume(10 ** 9)
@@ -0,0 +1,92 @@
+import os
+
+from .. import segment_store
+from ..segment_store import SegmentStore, INDEX_FILENAME
+from .utils import temp_dir
+
+from nose.tools import eq_
+
+pjoin = os.path.join
+
+
+def test_put_get():
+    with temp_dir() as d:
+        store = SegmentStore(pjoin(d, 'segments'))
+        store.put('a', 'first object')
+        store.put('b', '')
+        store.put('a', 'ignored, already present')
+        eq_('first object', store.get('a'))
+        eq_('', store.get('b'))
+        eq_(None, store.get('c'))
+        assert 'b' in store and 'c' not in store
+        # another instance (process) sees the same objects, also those
+        # appended after it loaded the index
+        other = SegmentStore(pjoin(d, 'segments'))
+        eq_(['a', 'b'], sorted(other.digests()))
+        store.put('c', 'third object')
+        eq_('third object', other.get('c'))
+
+def test_partial_index_line():
+    with temp_dir() as d:
+        store = SegmentStore(d)
+        store.put('a', 'first object')
+        # simulate a writer killed while appending to the index
+        with open(pjoin(d, INDEX_FILENAME), 'ab') as f:
+            f.write('b seg-0-0 12')
+        eq_(['a'], SegmentStore(d).digests())
+
+def test_remove_and_compact():
+    with temp_dir() as d:
+        store = SegmentStore(d)
+        for i in range(10):
+            store.put(str(i), 'object %d' % i)
+        for i in range(0, 10, 2):
+            store.remove(str(i))
+        other = SegmentStore(d)
+        eq_(None, other.get('4'))
+        eq_('object 5', other.get('5'))
+        old_size = os.path.getsize(pjoin(d, 'seg-0-0'))
+        store.compact()
+        eq_(['seg-1-0'], [x for x in os.listdir(d) if x.startswith('seg-')])
+        assert os.path.getsize(pjoin(d, 'seg-1-0')) < old_size
+        # the reader notices the index was replaced
+        eq_(sorted(str(i) for i in range(1, 10, 2)), sorted(other.digests()))
+        eq_('object 7', other.get('7'))
+        store.put('10', 'object 10')
+        eq_('object 10', other.get('10'))
+
+def test_segment_rollover():
+    old_max = segment_store.MAX_SEGMENT_SIZE
+    segment_store.MAX_SEGMENT_SIZE = 10
+    try:
+        with temp_dir() as d:
+            store = SegmentStore(d)
+            for i in range(3):
+                store.put(str(i), 'object %d..' % i)
+            eq_(['seg-0-0', 'seg-0-1', 'seg-0-2'],
+                sorted(x for x in os.listdir(d) if x.startswith('seg-')))
+            eq_('object 1..', SegmentStore(d).get('1'))
+    finally:
+        segment_store.MAX_SEGMENT_SIZE = old_max
+
+def test_many_segments():
+    old_max = segment_store.MAX_SEGMENT_SIZE
+    segment_store.MAX_SEGMENT_SIZE = 10
+    try:
+        with temp_dir() as d:
+            store = SegmentStore(d)
+            for i in range(12):
+                store.put(str(i), 'object %d..' % i)
+            # 'seg-0-10' comes after 'seg-0-9', so each object got its own segment
+            eq_(['seg-0-%d' % i for i in range(12)], store._segments())
+            for i in range(12):
+                eq_('object %d..' % i, SegmentStore(d).get(str(i)))
+            store.compact()
+            eq_(['seg-1-%d' % i for i in range(12)], store._segments())
+            reader = SegmentStore(d)
+            eq_(['object %d..' % i for i in range(12)], [reader.get(str(i)) for i in range(12)])
+            # compaction kept the order in which the objects were written
+            eq_([('seg-1-%d' % i, 0) for i in range(12)],
+                [reader._entries[str(i)][:2] for i in range(12)])
+    finally:
+        segment_store.MAX_SEGMENT_SIZE = old_max
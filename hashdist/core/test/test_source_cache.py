@@ -7,14 +7,17 @@ import hashlib
 from StringIO import StringIO
 import stat
 import errno
+import time
+import json
 import logging
 from contextlib import closing
 
 pjoin = os.path.join
 
-from ..source_cache import (ArchiveSourceCache, SourceCache,
+from ..source_cache import (ArchiveSourceCache, GitSourceCache, SourceCache,
         CorruptSourceCacheError, hit_pack, hit_unpack, scatter_files,
-        KeyNotFoundError, SourceNotFoundError, SecurityError, RemoteFetchError)
+        KeyNotFoundError, SourceNotFoundError, SecurityError, RemoteFetchError,
+        iter_pack_files, locked_partial_file)
 from ..hasher import Hasher, format_digest
 
 from .utils import temp_dir, working_directory, VERBOSE, logger, assert_raises
@@ -37,9 +40,11 @@ mock_git_commit = None
 @contextlib.contextmanager
 def temp_source_cache(logger=logger):
     tempdir = tempfile.mkdtemp()
+    sc = SourceCache(tempdir, logger)
     try:
-        yield SourceCache(tempdir, logger)
+        yield sc
     finally:
+        sc.close()
         shutil.rmtree(tempdir)
 
 
@@ -68,12 +73,19 @@ def make_mock_tarball():
          ('a/b/1/README', 'file contents')])
 
     import tarfile
-    mock_dangerous_tarballs = [pjoin(mock_container_dir, 'danger%d.tar.gz' % i) for i in range(2)]
+    mock_dangerous_tarballs = [pjoin(mock_container_dir, 'danger%d.tar.gz' % i) for i in range(3)]
     contentsfile = pjoin(mock_container_dir, 'tmp')
     with open(contentsfile, 'w') as f:
         f.write('hello')
-    for attackname, filename in zip(['/escapes', '../escapes'], mock_dangerous_tarballs):
+    for attackname, filename in zip(['/escapes', '../escapes', 'link/escapes'],
+                                    mock_dangerous_tarballs):
         with closing(tarfile.open(filename, 'w:gz')) as f:
+            if attackname.startswith('link/'):
+                # a file written through a symlink pointing outside
+                info = tarfile.TarInfo('link')
+                info.type = tarfile.SYMTYPE
+                info.linkname = mock_container_dir
+                f.addfile(info)
             info = tarfile.TarInfo(attackname)
             info.size = len('hello')
             with open(pjoin(mock_container_dir, 'tmp')) as f2:
@@ -124,7 +136,7 @@ def make_mock_git_repo(submodules=None):
             #cat('.gitmodules', config)
             #git('add', '.gitmodules')
             for name, url in submodules.items():
-                git('submodule', 'add', url, name, repo=repo)
+                git('-c', 'protocol.file.allow=always', 'submodule', 'add', url, name, repo=repo)
         git('commit', '-m', 'First revision', repo=repo)
         master_commit = git('rev-list', '-n1', 'HEAD', repo=repo).strip()
         cat('README', 'Second revision')
@@ -238,14 +250,145 @@ def test_git_fetch_submodules():
         assert (os.listdir(pjoin(sc.cache_path, 'git')).sort() ==
                 ['rootproject', 'rootproject.submod', 'rootproject.subdir.submod'].sort())
         # An unpack should include the submodules
+        for checkout in ['clone', 'shared', 'archive']:
+            with temp_dir() as d:
+                sc.unpack('git:' + master_commit, d, checkout)
+                for path, content in {('README',): 'First revision',
+                                      ('submod', 'README'): 'Second revision',
+                                      ('subdir', 'submod', 'README'): 'Second revision'}.items():
+                    with open(pjoin(d, *path)) as f:
+                        s = f.read()
+                        assert s == content
+
+def test_git_checkout_modes():
+    with temp_source_cache() as sc:
+        key = sc.fetch_git(mock_git_repo, 'master', 'foo')
+        with temp_dir() as d:
+            sc.unpack(key, pjoin(d, 'archive'), git_checkout='archive')
+            with file(pjoin(d, 'archive', 'README')) as f:
+                assert f.read() == 'First revision'
+            assert not os.path.exists(pjoin(d, 'archive', '.git'))
+
+            sc.unpack(key, pjoin(d, 'shared'), git_checkout='shared')
+            with file(pjoin(d, 'shared', 'README')) as f:
+                assert f.read() == 'First revision'
+            with file(pjoin(d, 'shared', '.git', 'objects', 'info', 'alternates')) as f:
+                eq_(pjoin(sc.cache_path, 'git', 'foo', 'objects'), f.read().strip())
+
+            with assert_raises(ValueError):
+                sc.unpack(key, pjoin(d, 'bad'), git_checkout='bad')
+
+def test_git_broker():
+    from ..source_cache import GitSourceCache
+    with temp_source_cache() as sc:
+        sc.fetch_git(mock_git_repo, 'master', 'foo')
+        broker = GitSourceCache(sc).get_broker('foo')
+        assert broker.has_commit(mock_git_commit)
+        assert not broker.has_commit('0' * 40)
+        eq_(mock_git_commit, broker.get_ref('refs/heads/inuse/%s' % mock_git_commit))
+
+        # Ref updates are queued, but visible through the broker
+        def show_ref(ref):
+            return subprocess.call(['git', 'show-ref', '--verify', '--quiet', ref],
+                                   env=dict(os.environ, GIT_DIR=pjoin(sc.cache_path, 'git', 'foo')))
+        broker.update_ref('refs/heads/a', mock_git_commit)
+        eq_(mock_git_commit, broker.get_ref('refs/heads/a'))
+        assert show_ref('refs/heads/a') != 0
+        broker.flush()
+        eq_(0, show_ref('refs/heads/a'))
+        broker.update_ref('refs/heads/a', None)
+        eq_(None, broker.get_ref('refs/heads/a'))
+        sc.close()
+        assert show_ref('refs/heads/a') != 0
+
+def test_git_local_mirror():
+    with temp_source_cache() as mirror:
+        mirror.fetch_git(mock_git_repo, 'devel', 'foo')
+        with temp_source_cache() as sc:
+            sc.local_mirrors = [mirror.cache_path]
+            # The remote is not contacted when the mirror has the commit
+            sc.fetch('git://not-valid', 'git:' + mock_git_devel_branch_commit, 'foo')
+            # The objects were copied, so the mirror may go away
+            assert not os.path.exists(pjoin(sc.cache_path, 'git', 'foo', 'objects', 'info', 'alternates'))
+            mirror.close()
+            shutil.rmtree(pjoin(mirror.cache_path, 'git'))
+            with temp_dir() as d:
+                sc.unpack('git:' + mock_git_devel_branch_commit, d)
+                with file(pjoin(d, 'README')) as f:
+                    eq_('Second revision', f.read())
+            with assert_raises(RemoteFetchError):
+                sc.fetch('git://not-valid', 'git:' + '0' * 40, 'foo')
+
+def test_git_fetch_modes():
+    def count_commits(sc, repo_name, commit):
+        return int(subprocess.check_output(['git', 'rev-list', '--count', commit],
+                                           env=dict(os.environ, GIT_DIR=pjoin(sc.cache_path, 'git', repo_name))))
+
+    def fetch_mode(sc, commit):
+        with open(pjoin(sc.cache_path, 'git-index', commit[:2], commit[2:])) as f:
+            return json.load(f)['fetch']
+
+    subprocess.check_call(['git', 'config', 'uploadpack.allowFilter', 'true'],
+                          env=dict(os.environ, GIT_DIR=pjoin(mock_git_repo, '.git')))
+    with temp_source_cache() as sc:
+        key = sc.fetch_git(mock_git_repo, 'devel', 'shallow', git_fetch='shallow')
+        eq_('git:' + mock_git_devel_branch_commit, key)
+        eq_(1, count_commits(sc, 'shallow', mock_git_devel_branch_commit))
+        eq_('shallow', fetch_mode(sc, mock_git_devel_branch_commit))
         with temp_dir() as d:
-            sc.unpack('git:' + master_commit, d)
-            for path, content in {('README',): 'First revision',
-                                  ('submod', 'README'): 'Second revision',
-                                  ('subdir', 'submod', 'README'): 'Second revision'}.items():
-                with open(pjoin(d, *path)) as f:
-                    s = f.read()
-                    assert s == content
+            for checkout in ['clone', 'shared']:
+                sc.unpack(key, pjoin(d, checkout), checkout)
+                with file(pjoin(d, checkout, 'README')) as f:
+                    eq_('Second revision', f.read())
+        # Asking for full history deepens the repo
+        sc.fetch(mock_git_repo, key, 'shallow', git_fetch='full')
+        eq_(2, count_commits(sc, 'shallow', mock_git_devel_branch_commit))
+        eq_('full', fetch_mode(sc, mock_git_devel_branch_commit))
+
+        sc.fetch(mock_git_repo, 'git:' + mock_git_commit, 'commit', git_fetch='commit')
+        eq_(1, count_commits(sc, 'commit', mock_git_commit))
+        eq_('commit', fetch_mode(sc, mock_git_commit))
+        # a complete commit in a repo set up for partial clones is 'full'
+        git = GitSourceCache(sc)
+        git.checked_git('shallow', 'config', 'extensions.partialClone', 'origin')
+        eq_('full', git._guess_fetch_mode('shallow', mock_git_devel_branch_commit))
+
+    with temp_source_cache() as sc:
+        key = sc.fetch_git(mock_git_repo, 'devel', 'partial', git_fetch='partial')
+        eq_('partial', fetch_mode(sc, mock_git_devel_branch_commit))
+        eq_('partial', GitSourceCache(sc)._guess_fetch_mode('partial', mock_git_devel_branch_commit))
+        with temp_dir() as d:
+            # Partially fetched commits can only be unpacked as archives
+            sc.unpack(key, d, 'clone')
+            with file(pjoin(d, 'README')) as f:
+                eq_('Second revision', f.read())
+            assert not os.path.exists(pjoin(d, '.git'))
+
+def test_git_index():
+    with temp_source_cache() as sc:
+        sc.fetch_git(mock_git_repo, 'master', 'foo')
+        index_file = pjoin(sc.cache_path, 'git-index', mock_git_commit[:2], mock_git_commit[2:])
+        assert os.path.exists(index_file)
+        # A repo not under the indexed name is only found by searching...
+        sc.close()
+        os.rename(pjoin(sc.cache_path, 'git', 'foo'), pjoin(sc.cache_path, 'git', 'bar'))
+        with temp_dir() as d:
+            sc.unpack('git:' + mock_git_commit, pjoin(d, 'foo'))
+        with open(index_file) as f:
+            assert 'bar' in f.read()
+        # ...or by rebuilding the index
+        shutil.rmtree(pjoin(sc.cache_path, 'git-index'))
+        eq_(1, sc.rebuild_git_index())
+        with open(index_file) as f:
+            assert 'bar' in f.read()
+        # An entry naming a repo that doesn't have the commit is not trusted
+        subprocess.check_call(['git', 'init', '-q', '--bare', pjoin(sc.cache_path, 'git', 'empty')])
+        with open(index_file, 'w') as f:
+            json.dump({'repo_name': 'empty', 'fetch': 'full'}, f)
+        with temp_dir() as d:
+            sc.unpack('git:' + mock_git_commit, pjoin(d, 'foo'))
+        with open(index_file) as f:
+            assert 'bar' in f.read()
 
 def test_unpack_nonexisting_git():
     with temp_source_cache() as sc:
@@ -280,12 +423,15 @@ def test_corrupt_download():
             corrupt_hash = mock_zipfile_hash[:-8] + 'aaaaaaaa'
             sc.fetch('file:' + mock_zipfile, corrupt_hash)
         # Check that no temporary files are left
-        assert len(os.listdir(pjoin(sc.cache_path, 'packs', 'tar.gz'))) == 0
+        packs_dir = pjoin(sc.cache_path, 'packs')
+        assert not [x for x in os.listdir(packs_dir) if x.startswith('downloading-')]
+        eq_([], list(iter_pack_files(packs_dir, 'tar.gz')))
 
 def test_corrupt_store():
     with temp_source_cache() as sc:
         key = sc.fetch_archive('file:' + mock_tarball)
-        pack_filename = pjoin(sc.cache_path, 'packs', 'tar.gz', mock_tarball_hash.split(':')[1])
+        hash = mock_tarball_hash.split(':')[1]
+        pack_filename = pjoin(sc.cache_path, 'packs', 'tar.gz', hash[:2], hash)
         os.chmod(pack_filename, stat.S_IRUSR | stat.S_IWUSR)
         with file(pack_filename, 'w') as f:
             f.write('corrupt archive')
@@ -320,6 +466,24 @@ def test_put():
             sc.unpack(key, d)
             with file(pjoin(d, 'foofile')) as f:
                 assert f.read() == 'the contents'
+        # small packs go to the segment store rather than a file of their own
+        assert os.listdir(pjoin(sc.cache_path, 'files')) == ['segments']
+        eq_(key, sc.put({'foofile': 'the contents'}))
+
+def test_put_large():
+    from .. import source_cache
+    old_max = source_cache.MAX_SEGMENT_PACK_SIZE
+    source_cache.MAX_SEGMENT_PACK_SIZE = 10
+    try:
+        with temp_source_cache() as sc:
+            key = sc.put({'foofile': 'the contents'})
+            assert os.path.exists(pjoin(sc.cache_path, 'files', key.split(':')[1]))
+            with temp_dir() as d:
+                sc.unpack(key, d)
+                with file(pjoin(d, 'foofile')) as f:
+                    assert f.read() == 'the contents'
+    finally:
+        source_cache.MAX_SEGMENT_PACK_SIZE = old_max
 
 def test_simple_file_url_re():
     from ..source_cache import SIMPLE_FILE_URL_RE
@@ -393,5 +557,221 @@ def test_mirrors():
 
                 sc = SourceCache(sc_dir, logger, mirrors=['file:' + mirror1, 'file:' + mirror2])
                 sc.fetch('http://nonexisting.com', mock_tarball_hash)
-                assert [sha] == os.listdir(pjoin(sc_dir, 'packs', 'tar.gz'))
+                # mirrors use the flat layout, the cache the sharded one
+                assert [sha] == os.listdir(pjoin(sc_dir, 'packs', 'tar.gz', sha[:2]))
+
+def test_shadow_packs():
+    tempdir = tempfile.mkdtemp()
+    sc = SourceCache(tempdir, logger, shadow_packs='tar')
+    try:
+        sc.fetch('file:' + mock_tarball, mock_tarball_hash)
+        type, hash = mock_tarball_hash.split(':')
+        asc = ArchiveSourceCache(sc)
+        pack_filename = asc.find_pack_filename(type, hash)
+        shadow_filename = asc.get_shadow_filename(type, hash)
+        with temp_dir() as d:
+            sc.unpack(mock_tarball_hash, d)
+            eq_(['0', '1'], sorted(os.listdir(d)))
+        sc.wait_for_background_jobs()
+        assert os.path.exists(shadow_filename)
+        # unpacking no longer needs the original
+        os.rename(pack_filename, pack_filename + '.moved')
+        with temp_dir() as d:
+            sc.unpack(mock_tarball_hash, d)
+            with file(pjoin(d, '0', 'README')) as f:
+                eq_('file contents', f.read())
+        os.rename(pack_filename + '.moved', pack_filename)
+        # a corrupt shadow copy is ignored, and made again
+        os.chmod(shadow_filename, stat.S_IRUSR | stat.S_IWUSR)
+        with file(shadow_filename, 'w') as f:
+            f.write('corrupt')
+        with temp_dir() as d:
+            sc.unpack(mock_tarball_hash, d)
+            eq_(['0', '1'], sorted(os.listdir(d)))
+        sc.wait_for_background_jobs()
+        assert os.path.getsize(shadow_filename) > len('corrupt')
+        eq_(False, asc.make_shadow(type, hash))
+        # so is one with valid tar structure but modified contents, which is
+        # only noticed after extraction
+        os.chmod(shadow_filename, stat.S_IRUSR | stat.S_IWUSR)
+        with file(shadow_filename) as f:
+            data = f.read()
+        with file(shadow_filename, 'w') as f:
+            f.write(data.replace('file contents', 'FILE contents'))
+        with temp_dir() as d:
+            sc.unpack(mock_tarball_hash, d)
+            with file(pjoin(d, '0', 'README')) as f:
+                eq_('file contents', f.read())
+        sc.wait_for_background_jobs()
+        with file(shadow_filename) as f:
+            eq_(data, f.read())
+    finally:
+        sc.close()
+        shutil.rmtree(tempdir)
 
+def test_external_decompress():
+    import gzip
+    from nose import SkipTest
+    from ..source_cache import find_external_decompressor, create_archive_handler
+    with temp_dir() as d:
+        tar_filename = pjoin(d, 'archive.tar')
+        with closing(gzip.open(mock_tarball)) as f:
+            with file(tar_filename, 'w') as g:
+                g.write(f.read())
+        tested = 0
+        for type, compress in [('tar.xz', ['xz', '-k']), ('tar.zst', ['zstd', '-q']),
+                               ('tar.gz', ['pigz', '-k'])]:
+            if find_external_decompressor(type) is None:
+                continue
+            subprocess.check_call(compress + [tar_filename])
+            ext = type.split('.')[1]
+            with file('%s.%s' % (tar_filename, ext)) as f:
+                data = f.read()
+            key = '%s:%s' % (type, format_digest(hashlib.sha256(data)))
+            archive = pjoin(d, 'archive.%s' % type)
+            os.rename('%s.%s' % (tar_filename, ext), archive)
+            with temp_source_cache() as sc:
+                eq_(key, sc.fetch_archive('file:' + archive))
+                with temp_dir() as target:
+                    sc.unpack(key, target)
+                    eq_(['0', '1'], sorted(os.listdir(target)))
+                # the hash is checked on the compressed data
+                pack_filename = ArchiveSourceCache(sc).find_pack_filename(type, key.split(':')[1])
+                os.chmod(pack_filename, stat.S_IRUSR | stat.S_IWUSR)
+                with file(pack_filename, 'w') as f:
+                    f.write(data[:-1] + chr(ord(data[-1]) ^ 1))
+                with temp_dir() as target:
+                    with assert_raises(CorruptSourceCacheError):
+                        sc.unpack(key, target)
+                    # nothing is left of what was unpacked before the check
+                    eq_([], os.listdir(target))
+            tested += 1
+        assert create_archive_handler('tar.gz', logger).decompress_command is None
+        if not tested:
+            raise SkipTest('no external decompressors found')
+
+def test_gc():
+    with temp_source_cache() as sc:
+        sc.fetch('file:' + mock_tarball, mock_tarball_hash)
+        sc.fetch('file:' + mock_zipfile, mock_zipfile_hash)
+        files_key = sc.put({'build.sh': 'echo hi'})
+        git_key = sc.fetch_git(mock_git_repo, 'master', 'repo')
+        # the tarball was used long ago, the zip file recently
+        tar_filename = ArchiveSourceCache(sc).find_pack_filename(*mock_tarball_hash.split(':'))
+        os.utime(tar_filename, (time.time() - 3600, time.time() - 3600))
+        with temp_dir() as d:
+            sc.unpack(mock_zipfile_hash, d)
+        sc.unpack(git_key, pjoin(d, 'git'))
+        total = sum(entry[1] for entry in ArchiveSourceCache(sc).list_entries() +
+                    GitSourceCache(sc).list_entries())
+        # removing the least recently used source is enough
+        keep = set([files_key])
+        removed, freed = sc.gc(keep, quota=total - 1)
+        eq_([mock_tarball_hash], removed)
+        eq_(os.path.getsize(mock_tarball), freed)
+        assert not os.path.exists(tar_filename)
+        # no quota: remove everything not kept
+        removed, freed = sc.gc(keep)
+        eq_(sorted([mock_zipfile_hash, git_key]), sorted(removed))
+        assert not os.path.exists(pjoin(sc.cache_path, 'git', 'repo'))
+        with temp_dir() as d:
+            sc.unpack(files_key, d)
+        eq_([], sc.gc(keep)[0])
+        # removing files: packs from the segment store
+        eq_([files_key], sc.gc(set())[0])
+        assert not ArchiveSourceCache(sc).contains(*files_key.split(':'))
+
+def test_pack_layout():
+    sha = mock_tarball_hash.split(':')[1]
+    with temp_source_cache() as sc:
+        # a pack in the flat layout of older source caches
+        legacy_dir = pjoin(sc.cache_path, 'packs', 'tar.gz')
+        os.makedirs(legacy_dir)
+        shutil.copy(mock_tarball, pjoin(legacy_dir, sha))
+        sc.fetch(None, mock_tarball_hash)
+        with temp_dir() as d:
+            sc.unpack(mock_tarball_hash, d)
+        eq_(1, sc.migrate_packs())
+        eq_(0, sc.migrate_packs())
+        eq_([sha[:2]], os.listdir(legacy_dir))
+        eq_([(sha, pjoin(legacy_dir, sha[:2], sha))],
+            list(iter_pack_files(pjoin(sc.cache_path, 'packs'), 'tar.gz')))
+        with temp_dir() as d:
+            sc.unpack(mock_tarball_hash, d)
+        # local mirrors may use either layout
+        with temp_source_cache() as sc2:
+            sc2.local_mirrors = [sc.cache_path]
+            sc2.fetch(None, mock_tarball_hash)
+            assert os.path.exists(pjoin(sc2.cache_path, 'packs', 'tar.gz', sha[:2], sha))
+
+
+def test_resume_download():
+    with open(mock_tarball) as f:
+        data = f.read()
+    sha = mock_tarball_hash.split(':')[1]
+    with utils.serve_http({'/archive.tar.gz': data}, truncate=len(data) // 2) as (url, requests):
+        with temp_source_cache() as sc:
+            asc = ArchiveSourceCache(sc)
+            with assert_raises(RemoteFetchError):
+                asc.fetch_archive(url + '/archive.tar.gz', 'tar.gz', sha)
+            partial_dir = pjoin(sc.cache_path, 'packs', 'partial')
+            eq_(['tar.gz-' + sha], os.listdir(partial_dir))
+            key = asc.fetch_archive(url + '/archive.tar.gz', 'tar.gz', sha)
+            eq_(mock_tarball_hash, key)
+            eq_([None, 'bytes=%d-' % (len(data) // 2)], [r for path, r in requests])
+            eq_([], os.listdir(partial_dir))
+            assert asc.contains('tar.gz', sha)
+
+def test_locked_partial_file():
+    with temp_dir() as d:
+        partial_path = pjoin(d, 'tar.gz-abc')
+        with locked_partial_file(partial_path) as path:
+            eq_(partial_path, path)
+            # a concurrent download gets a file of its own
+            with locked_partial_file(partial_path) as other_path:
+                assert other_path != partial_path
+                eq_(d, os.path.dirname(other_path))
+            assert not os.path.exists(other_path)
+            # the file was moved away by the first download
+            os.rename(partial_path, pjoin(d, 'done'))
+        with locked_partial_file(partial_path) as path:
+            eq_(partial_path, path)
+            assert os.path.exists(partial_path)
+
+def test_mirror_ranking():
+    with open(mock_tarball) as f:
+        data = f.read()
+    sha = mock_tarball_hash.split(':')[1]
+    files = {'/packs/tar.gz/%s' % sha: data}
+    dead = 'http://127.0.0.1:1'
+    with utils.serve_http(files) as (mirror, requests):
+        with temp_source_cache() as sc:
+            sc.mirrors = [dead, mirror]
+            asc = ArchiveSourceCache(sc)
+            eq_(mock_tarball_hash, asc.fetch_archive(dead + '/archive.tar.gz', 'tar.gz', sha))
+            assert 'failed_at' in sc.mirror_ranking.stats[dead]
+            assert sc.mirror_ranking.stats[mirror]['throughput'] > 0
+            eq_([mirror, dead], sc.mirror_ranking.order(sc.mirrors))
+
+def test_mirror_race():
+    with open(mock_tarball) as f:
+        data = f.read()
+    sha = mock_tarball_hash.split(':')[1]
+    files = {'/packs/tar.gz/%s' % sha: data}
+    with utils.serve_http(files) as (mirror_a, requests_a):
+        with utils.serve_http(files) as (mirror_b, requests_b):
+            with temp_source_cache() as sc:
+                sc.mirrors = [mirror_a, mirror_b, 'http://127.0.0.1:1']
+                sc.mirror_race = 3
+                asc = ArchiveSourceCache(sc)
+                eq_(mock_tarball_hash, asc.fetch_archive(None, 'tar.gz', sha))
+                assert asc.contains('tar.gz', sha)
+                # both live mirrors were asked, but only one was downloaded from
+                for i in range(100):
+                    if len(requests_a) + len(requests_b) == 2: break
+                    time.sleep(0.01)
+                eq_(1, len(requests_a))
+                eq_(1, len(requests_b))
+                measured = [m for m in [mirror_a, mirror_b]
+                            if 'throughput' in sc.mirror_ranking.stats.get(m, {})]
+                eq_(1, len(measured))
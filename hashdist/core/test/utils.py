@@ -164,3 +164,59 @@ def make_temporary_tarball(files):
     with file(archive_filename) as f:
         key = 'tar.gz:' + format_digest(hashlib.sha256(f.read()))
     return container_dir, archive_filename, key
+
+#
+# Mock HTTP server
+#
+@contextlib.contextmanager
+def serve_http(files, truncate=None):
+    """Serves `files`, a dict of path -> contents, over HTTP on localhost
+
+    Range requests are honoured. If `truncate` is given, the first
+    response is cut off after that many bytes. Yields ``(url, requests)``
+    where `requests` is a list of the ``(path, range_header)`` received.
+    """
+    import threading
+    import BaseHTTPServer
+
+    requests = []
+    state = {'truncate': truncate}
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            range_header = self.headers.getheader('Range')
+            requests.append((self.path, range_header))
+            if self.path not in files:
+                self.send_error(404)
+                return
+            data = files[self.path]
+            start = 0
+            if range_header is not None:
+                start = int(range_header[len('bytes='):].split('-')[0])
+                if start >= len(data):
+                    self.send_error(416)
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(data) - 1, len(data)))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(len(data) - start))
+            self.end_headers()
+            body = data[start:]
+            if state['truncate'] is not None:
+                body = body[:state['truncate']]
+                state['truncate'] = None
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:%d' % server.server_address[1], requests
+    finally:
+        server.shutdown()
+        server.server_close()
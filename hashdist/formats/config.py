@@ -46,6 +46,18 @@ config_schema = {
         "build_temp": {"type": "string"},
         "cache": {"type": "string"},
         "gc_roots": {"type": "string"},
+        "db": {"type": "string"},
+        "mirror_race": {"type": "integer", "minimum": 0},
+        "git_checkout": {"enum": ["clone", "shared", "archive"]},
+        "git_fetch": {"enum": ["full", "shallow", "partial", "commit"]},
+        "git_jobs": {"type": "integer", "minimum": 1},
+        "shadow_packs": {"enum": ["tar"]},
+        "external_decompress": {"type": "boolean"},
+        "source_cache_quota": {"type": ["integer", "string"]},
+        "build_store_quota": {"type": ["integer", "string"]},
+        "dedup": {"type": "boolean"},
+        "fixed_artifact_root": {"type": "string"},
+        "padded_root_length": {"type": "integer"},
     },
     "required": ["build_stores", "source_caches", "build_temp", "cache", "gc_roots"]
 }
@@ -81,8 +93,9 @@ def load_config_file(filename, logger):
             raise ValidationError(entry.start_mark, 'Exactly one of "url" and "dir" must be specified')
         if 'dir' in entry:
             entry['dir'] = _ensure_dir(_make_abs(basedir, entry['dir']), logger)
-    for key in ['build_temp', 'cache', 'gc_roots']:
-        doc[key] = _ensure_dir(_make_abs(basedir, doc[key]), logger)
+    for key in ['build_temp', 'cache', 'gc_roots', 'db']:
+        if key in doc:
+            doc[key] = _ensure_dir(_make_abs(basedir, doc[key]), logger)
     return doc
 
 def get_config_example_filename():
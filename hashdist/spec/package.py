@@ -58,7 +58,8 @@ class PackageSpec(object):
 
     def fetch_sources(self, source_cache):
         for source_clause in self.doc.get('sources', []):
-            source_cache.fetch(source_clause['url'], source_clause['key'], self.name)
+            source_cache.fetch(source_clause['url'], source_clause['key'], self.name,
+                               source_clause.get('git_fetch', None))
 
     def assemble_build_script(self, ctx):
         """
@@ -228,7 +229,10 @@ class PackageSpec(object):
         sources = list(extra_sources)
         for source_clause in self.doc.get("sources", []):
             target = source_clause.get("target", ".")
-            sources.append({"target": target, "key": source_clause["key"]})
+            source = {"target": target, "key": source_clause["key"]}
+            if "git_checkout" in source_clause:
+                source["git_checkout"] = source_clause["git_checkout"]
+            sources.append(source)
 
         # build commands
         commands = list(dependency_commands)